@@ -0,0 +1,134 @@
+"""
+Password logins against a local stand-in for the Supabase auth (GoTrue) token endpoint: a fresh supabase client per
+login, as user_login used to do, against the shared connection pool. Reports latency, allocations and how many TCP
+connections the stand-in saw.
+
+    python -m benchmarks.auth_login [logins]
+"""
+import asyncio
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import kapi.auth.auth
+from kapi.auth.auth import user_login, close_auth_http_client
+
+ANON_KEY = "anon-key"
+
+
+def make_session(email: str) -> dict:
+    return {
+        "access_token": "access-token",
+        "refresh_token": "refresh-token",
+        "token_type": "bearer",
+        "expires_in": 3600,
+        "expires_at": int(time.time()) + 3600,
+        "user": {
+            "id": "8f0a3b8e-2c4c-4bbf-9d8e-4b7f6f1c2a11",
+            "aud": "authenticated",
+            "role": "authenticated",
+            "email": email,
+            "app_metadata": {},
+            "user_metadata": {},
+            "created_at": "2026-10-18T12:00:00Z",
+        },
+    }
+
+
+class GoTrueHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self.path.startswith("/auth/v1/token") or self.headers.get("apikey") != ANON_KEY:
+            status, payload = 404, {"msg": "not found"}
+        elif body.get("password") != "password":
+            status, payload = 400, {"error": "invalid_grant", "error_description": "Invalid login credentials"}
+        else:
+            status, payload = 200, make_session(body["email"])
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GoTrueStub:
+    """Serves /auth/v1/token?grant_type=password on a free local port, any email with the password "password"."""
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), GoTrueHandler)
+        self.server.connections = 0
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def connections(self) -> int:
+        return self.server.connections
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def patch(self):
+        """Points user_login at the stand-in."""
+        return mock.patch.multiple(kapi.auth.auth, url=self.url, key=ANON_KEY)
+
+
+async def create_client_login(supabase_url: str, email: str, password: str):
+    # the previous user_login
+    from supabase import create_client
+    from kapi.db.db import run_sync
+    new_client = create_client(supabase_url, ANON_KEY)
+    return await run_sync(new_client.auth.sign_in_with_password, {"email": email, "password": password})
+
+
+async def measure(login, logins: int, stub: GoTrueStub) -> dict:
+    await login(0)
+    connections = stub.connections
+    tracemalloc.start()
+    started = time.perf_counter()
+    # a shift change, logins arrive in bursts
+    for burst in range(0, logins, 10):
+        await asyncio.gather(*[login(i) for i in range(burst, min(burst + 10, logins))])
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "ms_per_login": elapsed / logins * 1000,
+        "peak_kib": peak / 1024,
+        "connections": stub.connections - connections,
+    }
+
+
+async def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with GoTrueStub() as stub, stub.patch():
+        results = {
+            "create_client per login": await measure(lambda i: create_client_login(stub.url, f"user{i}@test.com", "password"), logins, stub),
+            "shared pool": await measure(lambda i: user_login(f"user{i}@test.com", "password"), logins, stub),
+        }
+        await close_auth_http_client()
+
+    print(f"{logins} logins in bursts of 10")
+    for name, result in results.items():
+        print(f"{name:>24}: {result['ms_per_login']:6.2f} ms per login, {result['peak_kib']:8.0f} KiB peak, {result['connections']:4} connections")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""
+Per-request overhead of the auth layer, the old @app.middleware("http") API key check against AuthMiddleware, on a
+small JSON route and a streamed 1 MiB file. Requests are driven straight through the ASGI interface.
+
+    python -m benchmarks.auth_middleware [requests]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from typing import Optional
+
+import jwt
+from fastapi import FastAPI
+from fastapi.responses import FileResponse, JSONResponse
+
+from kapi.auth.constants import API_KEY, KAPI_PRIVATE_KEY
+from kapi.auth.middleware import AuthMiddleware
+
+
+def make_app(file_path: str, middleware: Optional[str]) -> FastAPI:
+    app = FastAPI()
+
+    if middleware == "base_http":
+        # what main.py did before
+        @app.middleware("http")
+        async def api_key_middleware(request, call_next):
+            if not (request.url.path.startswith("/auth") or request.url.path.startswith("/health") or request.url.path.startswith("/files")):
+                api_key = request.headers.get("X-API-KEY")
+                if api_key != API_KEY:
+                    return JSONResponse(content={"message": "Invalid API Key"}, status_code=403)
+            response = await call_next(request)
+            return response
+    elif middleware == "asgi":
+        app.add_middleware(AuthMiddleware)
+
+    @app.get("/buildings")
+    async def buildings():
+        return {"data": [], "count": 0}
+
+    @app.get("/uploads/photo.png")
+    async def photo():
+        return FileResponse(file_path)
+
+    return app
+
+
+async def request(app, path: str, headers: list[tuple[bytes, bytes]]):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"", "headers": headers,
+        "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 8000),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    status = None
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    assert status == 200, status
+
+
+async def measure(app, path: str, headers, requests: int) -> float:
+    for _ in range(50):
+        await request(app, path, headers)
+    started = time.perf_counter()
+    for _ in range(requests):
+        await request(app, path, headers)
+    return (time.perf_counter() - started) / requests * 1_000_000
+
+
+async def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    token = jwt.encode({"email": "bench@test.com", "api_key": API_KEY, "exp": int(time.time() + 3600)}, KAPI_PRIVATE_KEY, algorithm="HS256")
+    api_key_headers = [(b"x-api-key", API_KEY.encode())]
+    bearer_headers = [(b"authorization", f"Bearer {token}".encode())]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = os.path.join(tmp, "photo.png")
+        with open(file_path, "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+
+        apps = {name: make_app(file_path, name) for name in ["none", "base_http", "asgi"]}
+        print(f"{requests} requests per case, us per request")
+        for path, cases in [
+            ("/buildings", [("none", api_key_headers), ("base_http", api_key_headers), ("asgi", api_key_headers), ("asgi", bearer_headers)]),
+            ("/uploads/photo.png", [("none", api_key_headers), ("base_http", api_key_headers), ("asgi", api_key_headers)]),
+        ]:
+            for name, headers in cases:
+                credential = "jwt" if headers is bearer_headers else "api key"
+                print(f"{path:>20} {name:>10} {credential:>8}: {await measure(apps[name], path, headers, requests):8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+"""
+Just enough of a .bru parser to replay the requests in the bruno collection: method, url, headers, query parameters
+and the multipart or json body. Scripts, vars, assertions and docs are ignored.
+"""
+import dataclasses
+import json
+import os
+import re
+from typing import Optional
+from urllib.parse import urlsplit
+
+METHODS = ("get", "post", "put", "patch", "delete", "options", "head")
+# values that are multi-line text, not "key: value" pairs
+TEXT_BLOCKS = ("body:json", "body:text", "body:xml", "docs")
+
+
+@dataclasses.dataclass
+class BrunoRequest:
+    name: str
+    seq: int
+    method: str
+    path: str
+    headers: dict[str, str]
+    query: dict[str, str]
+    body_type: str = "none"
+    # multipart fields in order, keys repeat for list fields
+    form: list[tuple[str, str]] = dataclasses.field(default_factory=list)
+    json: Optional[object] = None
+
+    @property
+    def files(self) -> list[tuple[str, str]]:
+        """The @file(...) fields, they point at files on somebody's laptop."""
+        return [(name, value) for name, value in self.form if value.startswith("@file(")]
+
+
+def parse_blocks(text: str) -> dict[str, object]:
+    """Top level "name { ... }" blocks, as a list of (key, value) pairs or as raw text for the TEXT_BLOCKS."""
+    blocks = {}
+    lines = iter(text.splitlines())
+    for line in lines:
+        match = re.match(r"^([\w:-]+)\s*\{\s*$", line)
+        if match is None:
+            continue
+        name = match.group(1)
+        body = []
+        for line in lines:
+            if line == "}":
+                break
+            body.append(line)
+        if name in TEXT_BLOCKS:
+            blocks[name] = "\n".join(line[2:] if line.startswith("  ") else line for line in body)
+            continue
+        pairs = []
+        for line in body:
+            key, separator, value = line.strip().partition(":")
+            # a leading "~" marks a disabled entry
+            if separator and not key.startswith("~"):
+                pairs.append((key.strip(), value.strip()))
+        blocks[name] = pairs
+    return blocks
+
+
+def parse(text: str) -> BrunoRequest:
+    blocks = parse_blocks(text)
+    meta = dict(blocks.get("meta", []))
+    method = next(method for method in METHODS if method in blocks)
+    request = dict(blocks[method])
+    url = urlsplit(request["url"])
+    body_type = request.get("body", "none")
+
+    body = None
+    if body_type == "json" and blocks.get("body:json", "").strip():
+        body = json.loads(blocks["body:json"])
+
+    return BrunoRequest(
+        name=meta.get("name", ""),
+        seq=int(meta.get("seq", 0)),
+        method=method.upper(),
+        path=url.path or "/",
+        headers=dict(blocks.get("headers", [])),
+        # the url carries the query too, params:query wins
+        query=dict([tuple(pair.split("=", 1)) for pair in url.query.split("&") if "=" in pair] + blocks.get("params:query", [])),
+        body_type=body_type,
+        form=blocks.get("body:multipart-form", []) if body_type == "multipartForm" else [],
+        json=body,
+    )
+
+
+def load_collection(directory: str) -> dict[str, BrunoRequest]:
+    """Every request in the collection by name, collection.bru headers merged into each one."""
+    collection_headers = {}
+    collection_path = os.path.join(directory, "collection.bru")
+    if os.path.exists(collection_path):
+        with open(collection_path) as f:
+            collection_headers = dict(parse_blocks(f.read()).get("headers", []))
+
+    requests = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".bru") or filename == "collection.bru":
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            request = parse(f.read())
+        request.headers = {**collection_headers, **request.headers}
+        requests[request.name] = request
+    return requests
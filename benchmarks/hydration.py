@@ -0,0 +1,131 @@
+"""
+Micro-benchmark of turning joined borrowed_keys rows into response models, the old path (plain dataclasses, Key and
+Borrower ids recomputed in __post_init__) against the slotted models built from rows that already carry their ids.
+
+    python -m benchmarks.hydration [rows] [iterations]
+"""
+import dataclasses
+import sys
+import timeit
+import tracemalloc
+import uuid
+from typing import Optional
+
+from kapi.db.borrowed_keys import BorrowedKeyResponse
+from kapi.db.borrowers import BORROWER_UUID5_NAMESPACE
+
+
+# the models as they were before from_row, kept here only to compare against
+@dataclasses.dataclass
+class LegacyKey:
+    room_number: str
+    building_id: str
+    type: str
+    id: Optional[str] = ""
+
+    def __post_init__(self):
+        self.id = f"{self.building_id}-{self.room_number}-{self.type}"
+
+
+@dataclasses.dataclass
+class LegacyBorrower:
+    name: str
+    type: str
+    company: Optional[str] = ""
+    id: Optional[str] = ""
+    email: Optional[str] = None
+    phone: Optional[str] = None
+
+    def __post_init__(self):
+        s = f"{self.type}"
+        if self.type == "company":
+            s = f"{s}-{self.company}"
+        if self.name:
+            s = f"{s}-{self.name}"
+        if self.email:
+            s = f"{s}-{self.email}"
+        if self.phone:
+            s = f"{s}-{self.phone}"
+        self.id = str(uuid.uuid5(BORROWER_UUID5_NAMESPACE, s))
+
+
+@dataclasses.dataclass
+class LegacyBorrowedKeyResponse:
+    id: str
+    key: LegacyKey
+    borrower: LegacyBorrower
+    image_filename: str
+    building_id: str
+    signature_filename: str
+    borrowed: bool
+    borrowed_at: str
+    returned_at: str
+
+
+def legacy_from_supabase(borrowed_key: dict) -> LegacyBorrowedKeyResponse:
+    return LegacyBorrowedKeyResponse(
+        id=borrowed_key["id"],
+        key=LegacyKey(
+            borrowed_key["keys"]["room_number"],
+            borrowed_key["keys"]["building_id"],
+            borrowed_key["keys"]["type"],
+            borrowed_key["key_id"]
+        ),
+        borrower=LegacyBorrower(
+            name=borrowed_key["borrowers"]["name"],
+            type=borrowed_key["borrowers"]["type"],
+            company=borrowed_key["borrowers"].get("company"),
+            id=borrowed_key["borrower_id"],
+            email=borrowed_key["borrowers"].get("email"),
+            phone=borrowed_key["borrowers"].get("phone")
+        ),
+        image_filename=borrowed_key["image_filename"],
+        signature_filename=borrowed_key["signature_filename"],
+        building_id=borrowed_key["building_id"],
+        borrowed=borrowed_key["borrowed"],
+        borrowed_at=borrowed_key["borrowed_at"],
+        returned_at=borrowed_key["returned_at"]
+    )
+
+
+def make_rows(rows: int) -> list[dict]:
+    return [{
+        "id": str(uuid.uuid4()),
+        "key_id": f"building-1-A{i:03}-room",
+        "borrower_id": str(uuid.uuid4()),
+        "building_id": "building-1",
+        "image_filename": f"{i}.png",
+        "signature_filename": f"{i}-signature.png",
+        "borrowed": True,
+        "borrowed_at": "2026-10-18T12:00:00+00:00",
+        "returned_at": None,
+        "keys": {"id": f"building-1-A{i:03}-room", "room_number": f"A{i:03}", "building_id": "building-1", "type": "room"},
+        "borrowers": {"name": f"Borrower {i}", "type": "employee", "company": None, "email": f"borrower{i}@example.com", "phone": None},
+    } for i in range(rows)]
+
+
+def allocated(hydrate, rows: list[dict]) -> int:
+    tracemalloc.start()
+    page = [hydrate(row) for row in rows]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del page
+    return size
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    page = make_rows(rows)
+
+    print(f"{rows} rows per page, {iterations} iterations")
+    results = {}
+    for name, hydrate in [("dataclass + post_init", legacy_from_supabase), ("slotted from_row", BorrowedKeyResponse.from_supabase)]:
+        seconds = min(timeit.repeat(lambda: [hydrate(row) for row in page], number=iterations, repeat=5))
+        results[name] = seconds / iterations * 1_000_000
+        print(f"{name:>22}: {results[name]:8.1f} us per page, {allocated(hydrate, page) / rows:6.0f} bytes per row")
+    print(f"{'speedup':>22}: {results['dataclass + post_init'] / results['slotted from_row']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""
+Offline load test: replays the request shapes of the bruno collection against the app on the in-memory backend, with
+a weighted mix of borrows, returns, lists, reservations and file downloads at a fixed concurrency. Reports p50/p95/p99
+latency, throughput and database/storage calls per request for every endpoint and writes it all to a JSON file.
+
+    python -m benchmarks.load_test [--requests 2000] [--concurrency 20] [--output load_test.json]
+
+Requests go through httpx.ASGITransport, in process, so the numbers are the app's own overhead without any network
+or database latency. The calls per request column is what tells how a change will do against the real database.
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+os.environ.setdefault("KAPI_DB_BACKEND", "memory")
+
+import httpx
+
+from benchmarks.bruno import BrunoRequest, load_collection
+from kapi.db.borrowed_keys import Files, add_borrowed_key, return_borrowed_keys
+from kapi.db.borrowers import Borrower
+from kapi.db.buildings import add_building, load_all_buildings
+from kapi.db.keys import Key
+from kapi.db.memory_backend import MemoryRepository, MemoryStorage
+from kapi.db.repository import set_repository, set_storage
+from kapi.db.reservations import add_reservation
+from kapi.notifications import notification_dispatcher
+from kapi.util import BUCKET_NAME, UPLOAD_DIR
+
+COLLECTION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bruno")
+
+# relative weights, reads outnumber writes like they do at the front desk
+MIX = {
+    "Get all keys requests": 30,
+    "Get all reservations": 12,
+    "Get borrowed key": 8,
+    "Borrow Key": 12,
+    "Borrow Keys": 2,
+    "Return borrowed key": 10,
+    "Return borrowed keys": 2,
+    "New Reservation Owner": 3,
+    "New Reservation Company": 2,
+    "Delete reservation": 1,
+    "Add building": 1,
+    "List buildings": 6,
+    "List keys that are out": 4,
+    "Get file": 10,
+}
+
+# shapes the collection does not have (yet)
+EXTRA_REQUESTS = {
+    "List buildings": BrunoRequest("List buildings", 0, "GET", "/buildings", {}, {"limit": "20"}),
+    "List keys that are out": BrunoRequest("List keys that are out", 0, "GET", "/borrowed-keys/out", {}, {}),
+    "Get file": BrunoRequest("Get file", 0, "GET", "/files/", {}, {}),
+}
+
+SKIPPED = {
+    "Login": "needs the Supabase auth server, see benchmarks.auth_login",
+    "Create data entry": "/upload is gone, @file fields point at a laptop",
+    "Borrow Key with Reservation": "uses the old field names (key_number, key_building)",
+    "Get buildings": "misnamed, the same request as Get borrowed key",
+}
+
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+# the kinds and counts MetricsMiddleware puts in the Server-Timing header, e.g. db;desc="3 calls";dur=1.2
+SERVER_TIMING = re.compile(r'(\w+);desc="(\d+) calls"')
+
+
+def call_counts(response: httpx.Response) -> dict:
+    counts = {"db": 0, "storage": 0}
+    for kind, count in SERVER_TIMING.findall(response.headers.get("Server-Timing", "")):
+        counts[kind] = int(count)
+    return counts
+
+
+class State:
+    """What the requests need ids for, taken from the repository so the mix keeps working as it changes it."""
+
+    def __init__(self, repository: MemoryRepository, storage: MemoryStorage, rng: random.Random):
+        self.repository = repository
+        self.storage = storage
+        self.rng = rng
+        self.counter = 0
+        # ids some request already picked, so two workers do not return the same borrow
+        self.claimed: set[str] = set()
+
+    def unique(self) -> int:
+        self.counter += 1
+        return self.counter
+
+    def building_id(self) -> str:
+        return self.rng.choice(list(self.repository.buildings))
+
+    def claim(self, ids: list[str], count: int) -> list[str]:
+        ids = [row_id for row_id in ids if row_id not in self.claimed]
+        picked = self.rng.sample(ids, min(count, len(ids)))
+        self.claimed.update(picked)
+        return picked
+
+    def open_borrows(self, count: int) -> list[str]:
+        rows = self.repository.borrowed_keys
+        return self.claim([row_id for row_id, row in rows.items() if row["borrowed"]], count)
+
+    def any_borrow(self) -> Optional[str]:
+        return self.rng.choice(list(self.repository.borrowed_keys)) if self.repository.borrowed_keys else None
+
+    def reservation(self) -> Optional[str]:
+        return next(iter(self.claim(list(self.repository.key_reservations), 1)), None)
+
+    def filename(self) -> str:
+        return self.rng.choice(list(self.storage.buckets[BUCKET_NAME]))
+
+
+def with_id(path: str, row_id: str) -> str:
+    """Puts row_id in place of the id at the end of a collection url, or after it when it has none."""
+    head, _, last = path.rstrip("/").rpartition("/")
+    if len(last) == 36 and last.count("-") == 4:
+        return f"{head}/{row_id}"
+    return f"{path.rstrip('/')}/{row_id}"
+
+
+def fill_form(form: list[tuple[str, str]], values: dict[str, Callable[[], str]]) -> list[tuple[str, str]]:
+    """The collection's fields with some replaced by fresh values, called once per occurrence (batch borrows)."""
+    return [(name, values[name]() if name in values else value) for name, value in form]
+
+
+def build(request: BrunoRequest, state: State, api_key: str) -> Optional[dict]:
+    """httpx request arguments for one replay of request, or None when there is nothing to run it against (yet)."""
+    path = request.path
+    query = dict(request.query)
+    form = request.form
+    body = request.json
+    rng = state.rng
+    building_id = state.building_id()
+    room = lambda: f"{state.unique()}{rng.choice('ABCD')}"
+
+    if request.name in ("Borrow Key", "Borrow Keys"):
+        form = fill_form(form, {"building_id": lambda: building_id, "key_room_number": room})
+    elif request.name.startswith("New Reservation"):
+        collection_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=rng.randint(1, 30))
+        form = fill_form(form, {
+            "building_id": lambda: building_id,
+            "key_room_number": room,
+            "collection_at": collection_at.isoformat,
+        })
+    elif request.name == "Add building":
+        form = fill_form(form, {"name": lambda: f"Testgebouw {state.unique()}"})
+    elif request.name == "Return borrowed key":
+        borrow_ids = state.open_borrows(1)
+        if not borrow_ids:
+            return None
+        path = with_id(path, borrow_ids[0])
+    elif request.name == "Return borrowed keys":
+        borrow_ids = state.open_borrows(len(body["borrow_ids"]))
+        if not borrow_ids:
+            return None
+        body = {"borrow_ids": borrow_ids}
+    elif request.name == "Get borrowed key":
+        borrow_id = state.any_borrow()
+        if borrow_id is None:
+            return None
+        path = with_id(path, borrow_id)
+    elif request.name == "Delete reservation":
+        reservation_id = state.reservation()
+        if reservation_id is None:
+            return None
+        path = with_id(path, reservation_id)
+    elif request.name == "Get file":
+        path = with_id(path, state.filename())
+        query["api_key"] = api_key
+
+    arguments = {
+        "method": request.method,
+        "url": path,
+        "params": query,
+        # the collection has a stale key baked in
+        "headers": {**request.headers, "X-API-KEY": api_key},
+    }
+    if request.body_type == "multipartForm":
+        # multipart/form-data, like bruno sends it (repeated fields included)
+        arguments["files"] = [(name, (None, value)) for name, value in form]
+    elif request.body_type == "json":
+        arguments["json"] = body
+    return arguments
+
+
+async def seed(repository: MemoryRepository, buildings: int, borrows: int, reservations: int, files: int, rng: random.Random):
+    """A database that looks like a few months of use: a tenth of the borrows still out."""
+    for i in range(buildings):
+        await add_building(f"Building {i}")
+    building_ids = [building.id for building in await load_all_buildings()]
+
+    filenames = [f"seed-{i}.png" for i in range(files)]
+    storage = MemoryStorage()
+    for filename in filenames:
+        await storage.upload(BUCKET_NAME, filename, PNG, "image/png")
+
+    borrowers = [Borrower(name=f"Borrower {i}", company=None, type="owner", email=f"borrower{i}@example.com", phone=None) for i in range(50)]
+    for i in range(borrows):
+        key = Key(room_number=f"seed-{i}", building_id=rng.choice(building_ids), type="Appartement")
+        await add_borrowed_key(key, rng.choice(borrowers), Files(rng.choice(filenames), rng.choice(filenames)))
+
+    await return_borrowed_keys(rng.sample(list(repository.borrowed_keys), int(borrows * 0.9)))
+
+    for i in range(reservations):
+        key = Key(room_number=f"reserved-{i}", building_id=rng.choice(building_ids), type="Kelder")
+        collection_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=rng.randint(1, 30))
+        await add_reservation(key, rng.choice(borrowers), "Seeded", collection_at.isoformat(), "Load test")
+    return storage
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest rank, values sorted."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(samples: list[tuple[int, float, dict]], seconds: float) -> dict:
+    latencies = sorted(latency for _, latency, _ in samples)
+    statuses = {}
+    for status, _, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for status, _, _ in samples if status >= 500),
+        "statuses": statuses,
+        "throughput_rps": round(len(samples) / seconds, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "db_calls_per_request": round(sum(counts["db"] for _, _, counts in samples) / len(samples), 2),
+        "storage_calls_per_request": round(sum(counts["storage"] for _, _, counts in samples) / len(samples), 2),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=COLLECTION, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(total: int = 2000, concurrency: int = 20, warmup: int = 100, seed_value: int = 1,
+              buildings: int = 10, borrows: int = 2000, reservations: int = 200, files: int = 50) -> dict:
+    # main is only imported here, it creates uploads/ in the working directory (when it is imported first)
+    from main import app
+    from kapi.auth.constants import API_KEY
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+    rng = random.Random(seed_value)
+    repository = MemoryRepository()
+    set_repository(repository)
+    storage = await seed(repository, buildings, borrows, reservations, files, rng)
+    set_storage(storage)
+    # notifications go nowhere, fast
+    notification_dispatcher.url = "http://127.0.0.1:9/"
+
+    collection = {**load_collection(COLLECTION), **EXTRA_REQUESTS}
+    missing = [name for name in MIX if name not in collection]
+    if missing:
+        raise ValueError(f"Not in the bruno collection: {', '.join(missing)}")
+    names = list(MIX)
+    weights = [MIX[name] for name in names]
+    state = State(repository, storage, rng)
+    samples: dict[str, list] = {name: [] for name in names}
+    skipped_runs: dict[str, int] = {}
+    remaining = iter(range(warmup + total))
+
+    async def worker(client: httpx.AsyncClient):
+        for i in remaining:
+            name = rng.choices(names, weights)[0]
+            arguments = build(collection[name], state, API_KEY)
+            if arguments is None:
+                skipped_runs[name] = skipped_runs.get(name, 0) + 1
+                continue
+            started = time.perf_counter()
+            response = await client.request(**arguments)
+            latency = time.perf_counter() - started
+            if i >= warmup:
+                samples[name].append((response.status_code, latency, call_counts(response)))
+            # the memory backend never suspends, without this a worker runs request after request and the background
+            # tasks (cache reloads, file downloads) only get the loop once every worker is done
+            await asyncio.sleep(0)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://kapi") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+            seconds = time.perf_counter() - started
+
+    everything = [sample for endpoint_samples in samples.values() for sample in endpoint_samples]
+    endpoints = {}
+    for name in names:
+        if samples[name]:
+            request = collection[name]
+            endpoints[name] = {"method": request.method, "path": request.path, **summarize(samples[name], seconds)}
+    return {
+        "config": {
+            "requests": total,
+            "warmup": warmup,
+            "concurrency": concurrency,
+            "seed": seed_value,
+            "mix": MIX,
+            "dataset": {"buildings": buildings, "borrows": borrows, "reservations": reservations, "files": files},
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "revision": git_revision(),
+            "backend": "memory",
+        },
+        "total": {"seconds": round(seconds, 3), **summarize(everything, seconds)},
+        "endpoints": endpoints,
+        # runs where there was nothing to return or delete (yet), not requests
+        "not_run": skipped_runs,
+        "skipped": SKIPPED,
+    }
+
+
+def print_report(results: dict):
+    print(f"{'endpoint':<26} {'requests':>8} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db/req':>7} {'errors':>6}")
+    for name, endpoint in [*results["endpoints"].items(), ("total", results["total"])]:
+        print(f"{name:<26} {endpoint['requests']:>8} {endpoint['throughput_rps']:>8} {endpoint['p50_ms']:>8} "
+              f"{endpoint['p95_ms']:>8} {endpoint['p99_ms']:>8} {endpoint['db_calls_per_request']:>7} {endpoint['errors']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--borrows", type=int, default=2000, help="borrowed keys in the seeded database")
+    parser.add_argument("--output", default="load_test.json")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            # the app prints every borrow and notification
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = asyncio.run(run(args.requests, args.concurrency, args.warmup, args.seed, borrows=args.borrows))
+        finally:
+            os.chdir(cwd)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_report(results)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
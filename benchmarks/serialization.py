@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of the list endpoint serialization, dataclasses.asdict + starlette JSONResponse against
+kapi.serialization.JSONResponse, on pages of BorrowedKeyResponse rows.
+
+    python -m benchmarks.serialization [rows] [iterations]
+"""
+import dataclasses
+import sys
+import timeit
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+from kapi.db.borrowed_keys import BorrowedKeyResponse
+from kapi.db.borrowers import Borrower
+from kapi.db.keys import Key
+from kapi.serialization import JSONResponse, orjson
+
+
+def make_page(rows: int) -> list[BorrowedKeyResponse]:
+    page = []
+    for i in range(rows):
+        key = Key(room_number=f"A{i:03}", building_id="building-1", type="room")
+        borrower = Borrower(name=f"Borrower {i}", type="employee", email=f"borrower{i}@example.com", phone="+420123456789")
+        page.append(BorrowedKeyResponse(
+            id=f"borrow-{i}",
+            key=key,
+            borrower=borrower,
+            image_filename=f"{i}.png",
+            building_id="building-1",
+            signature_filename=f"{i}-signature.png",
+            borrowed=True,
+            borrowed_at="2026-10-18T12:00:00+00:00",
+            returned_at="",
+        ))
+    return page
+
+
+def asdict_path(page: list) -> bytes:
+    return StarletteJSONResponse(content={
+        "data": [dataclasses.asdict(borrowed_key) for borrowed_key in page],
+        "count": len(page),
+    }).body
+
+
+def serialization_path(page: list) -> bytes:
+    return JSONResponse(content={"data": page, "count": len(page)}).body
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    page = make_page(rows)
+
+    print(f"{rows} rows per page, {iterations} iterations, orjson {'available' if orjson else 'missing'}")
+    results = {}
+    for name, path in [("asdict + starlette", asdict_path), ("kapi.serialization", serialization_path)]:
+        seconds = min(timeit.repeat(lambda: path(page), number=iterations, repeat=5))
+        results[name] = seconds / iterations * 1_000_000
+        print(f"{name:>20}: {results[name]:8.1f} us per page")
+    print(f"{'speedup':>20}: {results['asdict + starlette'] / results['kapi.serialization']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Cold start: how long `import main` takes and how long until a fresh uvicorn process answers /health, the number that
+matters when the containers scale up. Also lists the slowest imports, from python -X importtime.
+
+    python -m benchmarks.startup [--runs 5] [--backend supabase] [--output startup.json]
+
+Every run is a new interpreter in an empty working directory. The Supabase URL points at a closed port, nothing in
+startup is supposed to wait on it.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_MAIN = "import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)"
+
+
+def environment(backend: str) -> dict:
+    return {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "KAPI_DB_BACKEND": backend,
+        "SUPABASE_URL": "http://127.0.0.1:9",
+        "SUPABASE_ANON_KEY": "anon-key",
+        "PUSH_API_URL": "http://127.0.0.1:9/",
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_interpreter(env: dict, cwd: str) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], env=env, cwd=cwd, check=True)
+    return time.perf_counter() - started
+
+
+def time_import(env: dict, cwd: str) -> float:
+    result = subprocess.run([sys.executable, "-c", IMPORT_MAIN], env=env, cwd=cwd, check=True, capture_output=True, text=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def time_first_response(env: dict, cwd: str, timeout: float = 30) -> float:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=1) as client:
+            while time.perf_counter() - started < timeout:
+                try:
+                    if client.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                        return time.perf_counter() - started
+                except httpx.TransportError:
+                    pass
+                if server.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with {server.returncode}")
+                time.sleep(0.005)
+        raise TimeoutError(f"no answer on /health within {timeout} seconds")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def slowest_imports(env: dict, cwd: str, count: int = 15) -> list[dict]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], env=env, cwd=cwd, check=True, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented two more spaces per level
+        imports.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative) / 1000))
+    main_depth = next(depth for depth, module, _ in imports if module == "main")
+    # what main imports directly, everything below is in their cumulative time
+    direct = [{"module": module, "cumulative_ms": ms} for depth, module, ms in imports if depth == main_depth + 2]
+    return sorted(direct, key=lambda entry: entry["cumulative_ms"], reverse=True)[:count]
+
+
+def summarize(seconds: list[float]) -> dict:
+    return {
+        "median_ms": round(statistics.median(seconds) * 1000, 1),
+        "min_ms": round(min(seconds) * 1000, 1),
+        "max_ms": round(max(seconds) * 1000, 1),
+    }
+
+
+def run(runs: int = 5, backend: str = "supabase") -> dict:
+    env = environment(backend)
+    with tempfile.TemporaryDirectory() as cwd:
+        interpreter = [time_interpreter(env, cwd) for _ in range(runs)]
+        imports = [time_import(env, cwd) for _ in range(runs)]
+        first_response = [time_first_response(env, cwd) for _ in range(runs)]
+        slowest = slowest_imports(env, cwd)
+    return {
+        "config": {"runs": runs, "backend": backend},
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "interpreter": summarize(interpreter),
+        "import_main": summarize(imports),
+        "first_health_response": summarize(first_response),
+        "slowest_imports": slowest,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend", default="supabase", choices=["supabase", "memory"])
+    parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args.runs, args.backend)
+    for name in ["interpreter", "import_main", "first_health_response"]:
+        print(f"{name:<24} median {results[name]['median_ms']:>7} ms   min {results[name]['min_ms']:>7} ms")
+    print("slowest imports:")
+    for entry in results["slowest_imports"]:
+        print(f"  {entry['module']:<40} {entry['cumulative_ms']:>7.1f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
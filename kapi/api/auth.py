@@ -21,14 +21,14 @@ async def user_login_endpoint(
         data: LoginModel
 ):
     try:
-        user = user_login(data.email, data.password)
+        user = await user_login(data.email, data.password)
         # login success
         jwt_token = jwt.encode({
             "email": user.user.email,
             "api_key": API_KEY,
             "exp": int(time.time() + 60 * 60 * 24 * 7) # let's pick a week expiration since internal tool...
         }, KAPI_PRIVATE_KEY, algorithm="HS256")
-        send_push_notification(f"User {data.email} logged in")
+        send_push_notification(f"User {data.email} logged in", group="logins")
         return JSONResponse(content={
             "success": True,
             "access_token": jwt_token,
@@ -1,18 +1,61 @@
-import dataclasses
+import time
 
-from fastapi import APIRouter, Query, Form
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Query, Form, File, UploadFile
+from pydantic import BaseModel
 
 from kapi.db.borrowed_keys import Files, BorrowedKeyResponse, get_borrowed_keys, get_borrowed_key, add_borrowed_key, \
-    is_key_borrowed, return_borrowed_key
+    return_borrowed_key, add_borrowed_keys, return_borrowed_keys, get_out_borrowed_keys, get_due_borrowed_keys, \
+    get_active_borrow_id
+from kapi.db.overdue import DUE_SOON_HOURS
 from kapi.db.keys import Key
+from kapi.db.pagination import next_cursor
+from kapi.db.repository import KeysAlreadyBorrowed
 from kapi.db.borrowers import Borrower
 from kapi.notifications import send_push_notification
-from kapi.util import write_base64_file, upload_file_to_bucket
+from kapi.file_cache import file_cache
+from kapi.images import schedule_variants
+from kapi.uploads import upload_queue
+from kapi.util import write_base64_file, write_upload_file, remove_local_file
+from kapi.serialization import JSONResponse
 
 router = APIRouter()
 
 
+async def store_file(upload: UploadFile, file_base64: str) -> str:
+    # binary multipart parts are preferred, base64 data URLs are still accepted for older clients
+    if upload is not None:
+        return await write_upload_file(upload)
+    if file_base64 is not None:
+        return write_base64_file(file_base64)
+    raise ValueError("Missing file")
+
+
+async def store_borrow_files(image: UploadFile, image_base64: str, signature: UploadFile, signature_base64: str) -> Files:
+    try:
+        image_filename = await store_file(image, image_base64)
+    except ValueError as e:
+        raise ValueError(f"Invalid image: {e}")
+    try:
+        signature_filename = await store_file(signature, signature_base64)
+    except ValueError as e:
+        remove_local_file(image_filename)
+        raise ValueError(f"Invalid signature: {e}")
+    return Files(image_filename=image_filename, signature_filename=signature_filename)
+
+
+def remove_borrow_files(files: Files):
+    remove_local_file(files.image_filename)
+    remove_local_file(files.signature_filename)
+
+
+def publish_borrow_files(files: Files):
+    # uploaded in the background once the borrow went through, /files serves the local copies until then
+    for filename in [files.image_filename, files.signature_filename]:
+        upload_queue.enqueue(filename)
+        file_cache.add(filename)
+        schedule_variants(filename)
+
+
 @router.post("")
 async def borrow_key_endpoint(
         building_id: str = Form(...),
@@ -23,8 +66,10 @@ async def borrow_key_endpoint(
         borrower_phone: str = Form(None),
         key_room_number: str = Form(...),
         key_type: str = Form(...),
-        image_base64: str = Form(...),
-        signature_base64: str = Form(...),
+        image_base64: str = Form(None),
+        signature_base64: str = Form(None),
+        image: UploadFile = File(None),
+        signature: UploadFile = File(None),
         reservation_id: str = Form(None),
 ):
     key = Key(
@@ -33,17 +78,13 @@ async def borrow_key_endpoint(
         type=key_type,
     )
 
-    if is_key_borrowed(key.id):
-        return JSONResponse(content={"message": "Key is already borrowed"}, status_code=400)
-
-    image_filename = write_base64_file(image_base64)
-    upload_file_to_bucket(image_filename)
-    signature_filename = write_base64_file(signature_base64)
-    upload_file_to_bucket(signature_filename)
-
     if borrower_email is None and borrower_phone is None:
         return JSONResponse(content={"message": "Borrower must have either an email or phone number"}, status_code=400)
 
+    try:
+        files = await store_borrow_files(image, image_base64, signature, signature_base64)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
 
     borrower = Borrower(
         name=borrower_name,
@@ -53,47 +94,165 @@ async def borrow_key_endpoint(
         email=borrower_email
     )
 
-    files = Files(
-        image_filename=image_filename,
-        signature_filename=signature_filename
-    )
+    try:
+        await add_borrowed_key(key, borrower, files, reservation_id=reservation_id)
+    except ValueError:
+        remove_borrow_files(files)
+        return JSONResponse(content={"message": "Key is already borrowed"}, status_code=400)
+    except Exception:
+        # never queued for upload, they would stay behind in UPLOAD_DIR
+        remove_borrow_files(files)
+        raise
 
-    add_borrowed_key(key, borrower, files, reservation_id=reservation_id)
-    # Store the form data in memory
+    publish_borrow_files(files)
 
     if reservation_id:
-        send_push_notification(f"Key borrowed by {borrower_name} from reservation")
+        send_push_notification(f"Key borrowed by {borrower_name} from reservation", group="keys borrowed")
     else:
-        send_push_notification(f"Key borrowed by {borrower_name}")
+        send_push_notification(f"Key borrowed by {borrower_name}", group="keys borrowed")
 
     return {"message": "Borrowed key successfully"}
 
+
+@router.post("/batch")
+async def borrow_keys_endpoint(
+        building_id: str = Form(...),
+        borrower_name: str = Form(...),
+        borrower_company: str = Form(None),
+        borrower_type: str = Form(...),
+        borrower_email: str = Form(None),
+        borrower_phone: str = Form(None),
+        # repeated, the n-th room number goes with the n-th type
+        key_room_number: list[str] = Form(...),
+        key_type: list[str] = Form(...),
+        image_base64: str = Form(None),
+        signature_base64: str = Form(None),
+        image: UploadFile = File(None),
+        signature: UploadFile = File(None),
+):
+    if len(key_room_number) != len(key_type):
+        return JSONResponse(content={"message": "Every key needs both a room number and a type"}, status_code=400)
+    keys = [
+        Key(room_number=room_number, building_id=building_id, type=type)
+        for room_number, type in zip(key_room_number, key_type)
+    ]
+
+    if borrower_email is None and borrower_phone is None:
+        return JSONResponse(content={"message": "Borrower must have either an email or phone number"}, status_code=400)
+
+    try:
+        files = await store_borrow_files(image, image_base64, signature, signature_base64)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
+
+    borrower = Borrower(
+        name=borrower_name,
+        company=borrower_company,
+        type=borrower_type,
+        phone=borrower_phone,
+        email=borrower_email
+    )
+
+    try:
+        borrowed_keys = await add_borrowed_keys(keys, borrower, files)
+    except KeysAlreadyBorrowed as e:
+        remove_borrow_files(files)
+        return JSONResponse(content={"message": "Keys are already borrowed", "key_ids": e.key_ids}, status_code=400)
+    except Exception:
+        remove_borrow_files(files)
+        raise
+
+    publish_borrow_files(files)
+
+    send_push_notification(f"{len(borrowed_keys)} keys borrowed by {borrower_name}", group="keys borrowed")
+
+    return {
+        "message": "Borrowed keys successfully",
+        "borrow_ids": [borrowed_key.id for borrowed_key in borrowed_keys],
+    }
+
 @router.post("/return/{borrow_id}")
 async def return_key_endpoint(borrow_id: str):
     try:
-        return_borrowed_key(borrow_id)
+        await return_borrowed_key(borrow_id)
         return JSONResponse(content={"message": "Key returned"})
     except ValueError as e:
         return JSONResponse(content={"message": "Borrowed key not found"}, status_code=404)
 
 
+class ReturnKeysModel(BaseModel):
+    borrow_ids: list[str]
+
+
+@router.post("/return")
+async def return_keys_endpoint(data: ReturnKeysModel):
+    returned_ids = await return_borrowed_keys(data.borrow_ids)
+    returned = set(returned_ids)
+    if not returned_ids:
+        return JSONResponse(content={"message": "Borrowed keys not found"}, status_code=404)
+    return JSONResponse(content={
+        "message": "Keys returned",
+        "returned": returned_ids,
+        # unknown or already returned
+        "not_returned": [borrow_id for borrow_id in dict.fromkeys(data.borrow_ids) if borrow_id not in returned],
+    })
+
 
 @router.get("", response_model=list[BorrowedKeyResponse])
-async def get_borrowed_keys_endpoint(borrowed: bool = Query(None), limit: int = Query(20), offset: int = Query(0), building_id: str = Query(None)):
-    borrowed_keys, total = get_borrowed_keys(limit=limit, offset=offset, borrowed=borrowed, building_id=building_id)
+async def get_borrowed_keys_endpoint(borrowed: bool = Query(None), limit: int = Query(20), offset: int = Query(0), building_id: str = Query(None), cursor: str = Query(None), count: str = Query("exact")):
+    try:
+        borrowed_keys, total = await get_borrowed_keys(limit=limit, offset=offset, borrowed=borrowed, building_id=building_id, cursor=cursor, count=count)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
     return JSONResponse(content={
         "total": total,
         "limit": limit,
         "offset": offset,
-        "data": [dataclasses.asdict(borrowed_key) for borrowed_key in borrowed_keys],
+        "next_cursor": next_cursor(borrowed_keys, limit, "borrowed_at"),
+        "data": borrowed_keys,
+    })
+
+
+@router.get("/out", response_model=list[BorrowedKeyResponse])
+async def get_out_borrowed_keys_endpoint(building_id: str = Query(None)):
+    # served from memory, no count or pagination needed for what is out right now
+    borrowed_keys = await get_out_borrowed_keys(building_id=building_id)
+    return JSONResponse(content={
+        "total": len(borrowed_keys),
+        "data": borrowed_keys,
+    })
+
+
+@router.get("/status")
+async def get_key_status_endpoint(building_id: str = Query(...), key_room_number: str = Query(...), key_type: str = Query(...)):
+    # whether a key is out before trying to borrow it, served from memory like /out
+    key = Key(room_number=key_room_number, building_id=building_id, type=key_type)
+    borrow_id = await get_active_borrow_id(key.id)
+    return JSONResponse(content={
+        "key_id": key.id,
+        "borrowed": borrow_id is not None,
+        "borrow_id": borrow_id,
+    })
+
+
+@router.get("/overdue")
+async def get_overdue_borrowed_keys_endpoint(building_id: str = Query(None), due_within_hours: float = Query(DUE_SOON_HOURS)):
+    # past the return_at of their reservation, or out for longer than KAPI_OVERDUE_HOURS without one
+    if due_within_hours < 0:
+        return JSONResponse(content={"message": "due_within_hours can not be negative"}, status_code=400)
+    now = time.time()
+    due = await get_due_borrowed_keys(now + due_within_hours * 3600, building_id=building_id)
+    return JSONResponse(content={
+        "overdue": [entry.to_json(now) for entry in due if entry.due_at <= now],
+        "due_soon": [entry.to_json(now) for entry in due if entry.due_at > now],
     })
 
 
 @router.get("/{borrow_id}")
 async def get_key(borrow_id: str):
-    borrowed_key = get_borrowed_key(borrow_id)
+    borrowed_key = await get_borrowed_key(borrow_id)
     if borrowed_key is None:
         return JSONResponse(content={"message": "Key not found"}, status_code=404)
 
-    return JSONResponse(content=dataclasses.asdict(borrowed_key))
+    return JSONResponse(content=borrowed_key)
 
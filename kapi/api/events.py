@@ -0,0 +1,28 @@
+from fastapi import APIRouter, Header, Query
+from fastapi.responses import StreamingResponse
+
+from kapi.events import event_broker
+from kapi.serialization import JSONResponse
+
+router = APIRouter()
+
+
+@router.get("")
+async def events_endpoint(building_id: str = Query(None), last_event_id: str = Header(None)):
+    """
+    Server-sent events for borrows, returns and reservations (key.borrowed, key.returned, reservation.created,
+    reservation.collected, reservation.deleted), instead of polling the list endpoints. Reconnecting with the
+    Last-Event-ID header continues after that event, a "reset" event means the client has to refetch the lists.
+    EventSource cannot send headers, so this also takes ?api_key= or ?access_token=, see AuthMiddleware.
+    """
+    try:
+        last_id = int(last_event_id) if last_event_id is not None else None
+    except ValueError:
+        return JSONResponse(content={"message": "Invalid Last-Event-ID"}, status_code=400)
+
+    subscriber = event_broker.subscribe(last_id)
+    return StreamingResponse(event_broker.stream(subscriber, building_id=building_id), media_type="text/event-stream", headers={
+        "cache-control": "no-cache",
+        # nginx would otherwise buffer the stream
+        "x-accel-buffering": "no",
+    })
@@ -1,27 +1,52 @@
-import dataclasses
-
 from fastapi import Query, Form, APIRouter
-from starlette.responses import JSONResponse
 
+from kapi.db.availability import get_building_availability, get_key_availability, parse_range
 from kapi.db.borrowers import Borrower
 from kapi.db.keys import Key
+from kapi.db.pagination import next_cursor
+from kapi.db.repository import ReservationConflict
 
 from kapi.db.reservations import get_reservations, add_reservation, delete_reservation
 from kapi.notifications import send_push_notification
+from kapi.serialization import JSONResponse
 
 router = APIRouter()
 
 @router.get("")
-async def get_reservations_endpoint(limit: int = Query(20), offset: int = Query(0), collected: bool = Query(None), returned: bool = Query(None), building_id: str = Query(None)):
-    reservations, total = get_reservations(limit=limit, offset=offset, collected=collected, returned=returned, building_id=building_id)
+async def get_reservations_endpoint(limit: int = Query(20), offset: int = Query(0), collected: bool = Query(None), returned: bool = Query(None), building_id: str = Query(None), cursor: str = Query(None), count: str = Query("exact")):
+    try:
+        reservations, total = await get_reservations(limit=limit, offset=offset, collected=collected, returned=returned, building_id=building_id, cursor=cursor, count=count)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
     return JSONResponse(content={
         "total": total,
         "limit": limit,
         "offset": offset,
-        "data": [dataclasses.asdict(reservation) for reservation in reservations],
+        "next_cursor": next_cursor(reservations, limit, "created_at"),
+        "data": reservations,
     })
 
 
+@router.get("/availability")
+async def get_key_availability_endpoint(building_id: str = Query(...), key_room_number: str = Query(...), key_type: str = Query(...), start: str = Query(...), end: str = Query(...)):
+    """Whether the key is free for all of [start, end), the reservations in the way and the free slots in between."""
+    try:
+        start, end = parse_range(start, end)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
+    key = Key(room_number=key_room_number, building_id=building_id, type=key_type)
+    return JSONResponse(content=await get_key_availability(key.id, start, end))
+
+
+@router.get("/free-keys")
+async def get_free_keys_endpoint(building_id: str = Query(...), start: str = Query(...), end: str = Query(...)):
+    try:
+        start, end = parse_range(start, end)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
+    return JSONResponse(content=await get_building_availability(building_id, start, end))
+
+
 @router.post("")
 async def create_reservation_endpoint(
         building_id: str = Form(...),
@@ -49,16 +74,21 @@ async def create_reservation_endpoint(
         type=borrower_type
     )
 
-    reservation = add_reservation(key, borrower=borrower, description=description, collection_at=collection_at, reservation_by=reservation_by, return_at=return_at)
+    try:
+        reservation = await add_reservation(key, borrower=borrower, description=description, collection_at=collection_at, reservation_by=reservation_by, return_at=return_at)
+    except ReservationConflict as e:
+        return JSONResponse(content={"message": "Key is already reserved in that period", "reservation_ids": e.reservation_ids}, status_code=409)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
 
-    send_push_notification(f"Reservation created")
+    send_push_notification(f"Reservation created", group="reservations created")
     return {"message": "Reservation created successfully", "data": reservation }
 
 
 @router.delete("/{reservation_id}")
 async def delete_reservation_endpoint(reservation_id: str):
     try:
-        reservation = delete_reservation(reservation_id)
+        reservation = await delete_reservation(reservation_id)
         return JSONResponse(content={"message": "Reservation deleted", "data": reservation})
     except ValueError as e:
         return JSONResponse(content={"message": "Reservation not found"}, status_code=404)
@@ -1,16 +1,50 @@
-import json
+import os
+from typing import TYPE_CHECKING, Optional
 
-from gotrue import AuthResponse
+import httpx
 
-from kapi.db.db import supabase, url, key
+from kapi.db.db import url, key
 
-from supabase import create_client, Client
+if TYPE_CHECKING:
+    from supabase_auth import AuthResponse
 
+AUTH_TIMEOUT = float(os.getenv("KAPI_AUTH_TIMEOUT", "10"))
+AUTH_MAX_CONNECTIONS = int(os.getenv("KAPI_AUTH_MAX_CONNECTIONS", "10"))
 
-def user_login(email: str, password: str) -> AuthResponse:
-    new_client = create_client(url, key)
-    user: AuthResponse = new_client.auth.sign_in_with_password({
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_auth_http_client() -> httpx.AsyncClient:
+    # one connection pool for every login, so a burst of logins reuses the same few TLS connections
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=AUTH_TIMEOUT,
+            limits=httpx.Limits(max_connections=AUTH_MAX_CONNECTIONS, max_keepalive_connections=AUTH_MAX_CONNECTIONS),
+        )
+    return _http_client
+
+
+async def close_auth_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def user_login(email: str, password: str) -> "AuthResponse":
+    # imported on the first login rather than at startup
+    from supabase_auth import AsyncGoTrueClient
+
+    # a throwaway GoTrue client per login keeps the signed in sessions apart, only the connections are shared
+    client = AsyncGoTrueClient(
+        url=f"{url}/auth/v1",
+        headers={"apiKey": key, "Authorization": f"Bearer {key}"},
+        http_client=get_auth_http_client(),
+        auto_refresh_token=False,
+        persist_session=False,
+    )
+    return await client.sign_in_with_password({
         "email": email,
         "password": password,
     })
-    return user
\ No newline at end of file
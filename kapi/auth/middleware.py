@@ -1,16 +1,121 @@
-from fastapi import Request, HTTPException
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import jwt
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
 from kapi.auth.constants import API_KEY, KAPI_PRIVATE_KEY
 
-class ApiKeyMiddleware:
-    def __init__(self, app):
-        self.app = app
+TOKEN_CACHE_SIZE = int(os.getenv("KAPI_TOKEN_CACHE_SIZE", "1024"))
+
+# login, probes and /files (checks its own api_key query parameter, <img> tags cannot send headers)
+PUBLIC_PATHS = ("/auth", "/health", "/ready", "/files")
+# the browser's EventSource cannot send headers either, these take ?api_key= or ?access_token= as well
+QUERY_AUTH_PATHS = ("/events",)
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of tokens whose signature already checked out, each kept until its exp."""
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._tokens: OrderedDict[str, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def is_verified(self, token: str) -> bool:
+        expires_at = self._tokens.get(token)
+        if expires_at is None:
+            self.misses += 1
+            return False
+        if expires_at <= time.time():
+            del self._tokens[token]
+            self.misses += 1
+            return False
+        self._tokens.move_to_end(token)
+        self.hits += 1
+        return True
+
+    def add(self, token: str, expires_at: float):
+        self._tokens[token] = expires_at
+        self._tokens.move_to_end(token)
+        if len(self._tokens) > self.maxsize:
+            self._tokens.popitem(last=False)
+
+    def clear(self):
+        self._tokens.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._tokens),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
 
-    async def __call__(self, request: Request, call_next):
-        if not request.url.path.startswith("/auth"):
-            api_key = request.headers.get("X-API-KEY")
-            if api_key != API_KEY:
-                raise HTTPException(status_code=403, detail="Invalid API Key")
-        response = await call_next(request)
-        return response
+verified_tokens = VerifiedTokenCache()
 
 
+def verify_token(token: str) -> bool:
+    if verified_tokens.is_verified(token):
+        return True
+    try:
+        payload = jwt.decode(token, KAPI_PRIVATE_KEY, algorithms=["HS256"], options={"require": ["exp"]})
+    except jwt.InvalidTokenError:
+        return False
+    # tokens carry the api key they were issued for, rotating the key logs everyone out
+    if payload.get("api_key") != API_KEY:
+        return False
+    verified_tokens.add(token, payload["exp"])
+    return True
+
+
+def get_bearer_token(headers: Headers) -> Optional[str]:
+    authorization = headers.get("authorization")
+    if authorization is None:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token.strip()
+
+
+def is_authorized(headers: Headers) -> bool:
+    if headers.get("x-api-key") == API_KEY:
+        return True
+    token = get_bearer_token(headers)
+    return token is not None and verify_token(token)
+
+
+def is_authorized_query(query: QueryParams) -> bool:
+    if query.get("api_key") == API_KEY:
+        return True
+    token = query.get("access_token")
+    return token is not None and verify_token(token)
+
+
+class AuthMiddleware:
+    """
+    Lets a request through with either the X-API-KEY header or an "Authorization: Bearer" token from /auth/login.
+
+    Plain ASGI instead of @app.middleware("http"), so the response (and streamed file bodies in particular) goes out
+    untouched, there is no extra task or stream per request.
+    """
+
+    def __init__(self, app: ASGIApp, public_paths: tuple = PUBLIC_PATHS, query_auth_paths: tuple = QUERY_AUTH_PATHS):
+        self.app = app
+        self.public_paths = public_paths
+        self.query_auth_paths = query_auth_paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"].startswith(self.public_paths) or is_authorized(Headers(scope=scope)) \
+                or (scope["path"].startswith(self.query_auth_paths) and is_authorized_query(QueryParams(scope["query_string"]))):
+            await self.app(scope, receive, send)
+            return
+        response = JSONResponse(content={"message": "Invalid API Key"}, status_code=403)
+        await response(scope, receive, send)
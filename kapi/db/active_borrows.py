@@ -0,0 +1,67 @@
+import os
+from typing import Awaitable, Callable
+
+from kapi.db.reconciled import ReconciledIndex
+
+ACTIVE_BORROWS_RECONCILE_SECONDS = float(os.getenv("KAPI_ACTIVE_BORROWS_RECONCILE_SECONDS", "60"))
+
+
+class ActiveBorrowIndex(ReconciledIndex):
+    """
+    Process-local index of the borrowed keys that are currently out, by key and by building, see ReconciledIndex.
+
+    Serves reads only, the database stays the authority when borrowing.
+    """
+
+    description = "the borrowed keys"
+
+    def __init__(self, load: Callable[[], Awaitable[list]], reconcile_seconds: float = ACTIVE_BORROWS_RECONCILE_SECONDS):
+        self._by_id: dict = {}
+        self._by_key: dict = {}
+        self._by_building: dict[str, dict] = {}
+        super().__init__(load, reconcile_seconds)
+
+    def _add(self, borrowed_key):
+        self._remove(borrowed_key.id)
+        self._by_id[borrowed_key.id] = borrowed_key
+        self._by_key[borrowed_key.key.id] = borrowed_key
+        self._by_building.setdefault(borrowed_key.building_id, {})[borrowed_key.id] = borrowed_key
+
+    def _remove(self, borrow_id: str):
+        borrowed_key = self._by_id.pop(borrow_id, None)
+        if borrowed_key is None:
+            return
+        if self._by_key.get(borrowed_key.key.id) is borrowed_key:
+            del self._by_key[borrowed_key.key.id]
+        building = self._by_building.get(borrowed_key.building_id)
+        if building is not None:
+            building.pop(borrow_id, None)
+            if not building:
+                del self._by_building[borrowed_key.building_id]
+
+    def _clear(self):
+        self._by_id, self._by_key, self._by_building = {}, {}, {}
+
+    def _ids(self):
+        return self._by_id.keys()
+
+    def is_borrowed(self, key_id: str) -> bool:
+        return key_id in self._by_key
+
+    def get_for_key(self, key_id: str):
+        return self._by_key.get(key_id)
+
+    def out(self, building_id: str = None) -> list:
+        if building_id is None:
+            borrowed_keys = list(self._by_id.values())
+        else:
+            borrowed_keys = list(self._by_building.get(building_id, {}).values())
+        # newest first, like the list endpoint
+        return sorted(borrowed_keys, key=lambda borrowed_key: (borrowed_key.borrowed_at, borrowed_key.id), reverse=True)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "borrowed": len(self._by_id),
+            "buildings": len(self._by_building),
+        }
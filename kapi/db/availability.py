@@ -0,0 +1,284 @@
+import bisect
+import dataclasses
+import datetime
+import os
+from typing import Awaitable, Callable, Optional, Self
+
+from kapi.db.keys import Key
+from kapi.db.reconciled import ReconciledIndex
+from kapi.db.repository import get_repository
+
+RESERVATIONS_RECONCILE_SECONDS = float(os.getenv("KAPI_RESERVATIONS_RECONCILE_SECONDS", "60"))
+# a reservation without return_at keeps the key for a day, the same as reservation_period() in
+# supabase/migrations/*_reservation_overlap.sql
+DEFAULT_RESERVATION_SECONDS = 24 * 3600
+
+
+def parse_time(value: str) -> float:
+    """ISO 8601 to a timestamp, without a timezone it is UTC. Raises ValueError."""
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def format_time(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+
+def parse_range(start: str, end: str) -> tuple[float, float]:
+    """A [start, end) from query parameters. Raises ValueError."""
+    start, end = parse_time(start), parse_time(end)
+    if end <= start:
+        raise ValueError("end has to be after start")
+    return start, end
+
+
+def reservation_period(collection_at: str, return_at: Optional[str] = None) -> tuple[float, float]:
+    """The [start, end) a reservation keeps its key for. Raises ValueError for unparsable or backwards periods."""
+    start = parse_time(collection_at)
+    end = parse_time(return_at) if return_at else start + DEFAULT_RESERVATION_SECONDS
+    if end <= start:
+        raise ValueError("return_at has to be after collection_at")
+    return start, end
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class ReservedPeriod:
+    id: str
+    key_id: str
+    building_id: Optional[str]
+    start: float
+    end: float
+
+    @classmethod
+    def from_row(cls, reservation: dict) -> Optional[Self]:
+        """None for the reservations that do not hold their key (anymore): returned or without a valid period."""
+        if reservation.get("returned") or not reservation.get("collection_at"):
+            return None
+        try:
+            start, end = reservation_period(reservation["collection_at"], reservation.get("return_at"))
+        except ValueError:
+            return None
+        return cls(reservation["id"], reservation["key_id"], reservation.get("building_id"), start, end)
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "key_id": self.key_id,
+            "building_id": self.building_id,
+            "start": format_time(self.start),
+            "end": format_time(self.end),
+        }
+
+
+class KeyPeriods:
+    """
+    The reserved periods of one key, sorted by start, with the running maximum of their ends.
+
+    Whether [start, end) is free is a bisect on the starts plus one look at that running maximum, O(log n). Finding
+    the overlapping periods walks back from there for as long as the running maximum reaches into the range, which
+    is O(log n + k) when the periods do not overlap each other (the constraint makes sure of that).
+    """
+
+    def __init__(self):
+        self.periods: list[ReservedPeriod] = []
+        self.starts: list[float] = []
+        self.max_ends: list[float] = []
+
+    def __len__(self) -> int:
+        return len(self.periods)
+
+    def _update_max_ends(self, index: int):
+        del self.max_ends[index:]
+        running = self.max_ends[-1] if self.max_ends else float("-inf")
+        for period in self.periods[index:]:
+            running = max(running, period.end)
+            self.max_ends.append(running)
+
+    def add(self, period: ReservedPeriod):
+        index = bisect.bisect_right(self.starts, period.start)
+        self.periods.insert(index, period)
+        self.starts.insert(index, period.start)
+        self._update_max_ends(index)
+
+    def remove(self, period: ReservedPeriod):
+        index = bisect.bisect_left(self.starts, period.start)
+        while index < len(self.periods) and self.periods[index].id != period.id:
+            index += 1
+        if index == len(self.periods):
+            return
+        del self.periods[index]
+        del self.starts[index]
+        self._update_max_ends(index)
+
+    def is_free(self, start: float, end: float) -> bool:
+        index = bisect.bisect_left(self.starts, end)
+        return index == 0 or self.max_ends[index - 1] <= start
+
+    def overlapping(self, start: float, end: float) -> list[ReservedPeriod]:
+        index = bisect.bisect_left(self.starts, end) - 1
+        overlapping = []
+        while index >= 0 and self.max_ends[index] > start:
+            if self.periods[index].end > start:
+                overlapping.append(self.periods[index])
+            index -= 1
+        overlapping.reverse()
+        return overlapping
+
+
+def free_periods(periods: list[ReservedPeriod], start: float, end: float) -> list[tuple[float, float]]:
+    """The gaps between the periods (sorted by start) within [start, end)."""
+    free = []
+    cursor = start
+    for period in periods:
+        if period.start > cursor:
+            free.append((cursor, min(period.start, end)))
+        cursor = max(cursor, period.end)
+        if cursor >= end:
+            break
+    if cursor < end:
+        free.append((cursor, end))
+    return free
+
+
+class ReservationIndex(ReconciledIndex):
+    """The reserved periods of every key with an open reservation, by key and by building, see ReconciledIndex."""
+
+    description = "the reservations"
+
+    def __init__(self, load: Callable[[], Awaitable[list]], reconcile_seconds: float = RESERVATIONS_RECONCILE_SECONDS):
+        self._by_id: dict[str, ReservedPeriod] = {}
+        self._by_key: dict[str, KeyPeriods] = {}
+        self._keys_by_building: dict[str, set[str]] = {}
+        super().__init__(load, reconcile_seconds)
+
+    def _add(self, period: ReservedPeriod):
+        self._remove(period.id)
+        self._by_id[period.id] = period
+        key_periods = self._by_key.get(period.key_id)
+        if key_periods is None:
+            key_periods = self._by_key[period.key_id] = KeyPeriods()
+        key_periods.add(period)
+        self._keys_by_building.setdefault(period.building_id, set()).add(period.key_id)
+
+    def _remove(self, reservation_id: str):
+        period = self._by_id.pop(reservation_id, None)
+        if period is None:
+            return
+        key_periods = self._by_key[period.key_id]
+        key_periods.remove(period)
+        if not key_periods:
+            del self._by_key[period.key_id]
+            keys = self._keys_by_building.get(period.building_id)
+            if keys is not None:
+                keys.discard(period.key_id)
+                if not keys:
+                    del self._keys_by_building[period.building_id]
+
+    def _clear(self):
+        self._by_id, self._by_key, self._keys_by_building = {}, {}, {}
+
+    def _ids(self):
+        return self._by_id.keys()
+
+    def get(self, reservation_id: str) -> Optional[ReservedPeriod]:
+        return self._by_id.get(reservation_id)
+
+    def is_free(self, key_id: str, start: float, end: float) -> bool:
+        key_periods = self._by_key.get(key_id)
+        return key_periods is None or key_periods.is_free(start, end)
+
+    def overlapping(self, key_id: str, start: float, end: float) -> list[ReservedPeriod]:
+        key_periods = self._by_key.get(key_id)
+        return key_periods.overlapping(start, end) if key_periods is not None else []
+
+    def reserved_keys(self, building_id: str, start: float, end: float) -> dict[str, list[ReservedPeriod]]:
+        """The keys of the building that are reserved somewhere in [start, end), with the periods that are in the way."""
+        reserved = {}
+        for key_id in self._keys_by_building.get(building_id, ()):
+            if not self._by_key[key_id].is_free(start, end):
+                reserved[key_id] = self._by_key[key_id].overlapping(start, end)
+        return reserved
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "reservations": len(self._by_id),
+            "keys": len(self._by_key),
+        }
+
+
+async def load_reserved_periods(key_id: str = None, building_id: str = None) -> list[ReservedPeriod]:
+    periods = [ReservedPeriod.from_row(reservation) for reservation in await get_repository().list_open_reservations(key_id=key_id, building_id=building_id)]
+    return [period for period in periods if period is not None]
+
+
+# who has which key when, see ReservationIndex
+reservation_index = ReservationIndex(load_reserved_periods)
+
+
+async def load_overlapping_reservations(key_id: str, start: float, end: float) -> list[ReservedPeriod]:
+    key_periods = KeyPeriods()
+    for period in await load_reserved_periods(key_id=key_id):
+        key_periods.add(period)
+    return key_periods.overlapping(start, end)
+
+
+async def get_overlapping_reservations(key_id: str, start: float, end: float) -> list[ReservedPeriod]:
+    """The reservations of the key that overlap [start, end), from memory once the index is warm."""
+    if reservation_index.warm:
+        return reservation_index.overlapping(key_id, start, end)
+    return await load_overlapping_reservations(key_id, start, end)
+
+
+async def check_reservation_conflicts(key_id: str, start: float, end: float) -> list[ReservedPeriod]:
+    """
+    The reservations in the way of reserving the key for [start, end). A free period is answered by the index, a
+    conflict it reports is checked against the database first: reservations other workers deleted or returned are
+    still in the index until the next reconcile.
+    """
+    conflicts = await get_overlapping_reservations(key_id, start, end)
+    if not conflicts or not reservation_index.warm:
+        return conflicts
+    confirmed = await load_overlapping_reservations(key_id, start, end)
+    confirmed_ids = {period.id for period in confirmed}
+    for period in conflicts:
+        if period.id not in confirmed_ids:
+            reservation_index.remove(period.id)
+    return confirmed
+
+
+async def get_key_availability(key_id: str, start: float, end: float) -> dict:
+    # every overlapping period is needed for the free slots anyway
+    overlapping = await get_overlapping_reservations(key_id, start, end)
+    return {
+        "key_id": key_id,
+        "start": format_time(start),
+        "end": format_time(end),
+        "free": not overlapping,
+        "reservations": [period.to_json() for period in overlapping],
+        "free_slots": [{"start": format_time(free_start), "end": format_time(free_end)} for free_start, free_end in free_periods(overlapping, start, end)],
+    }
+
+
+async def get_building_availability(building_id: str, start: float, end: float) -> dict:
+    """Which keys of the building are free for all of [start, end) and which are not."""
+    keys = [Key.from_row(key) for key in await get_repository().list_keys(building_id)]
+    if reservation_index.warm:
+        reserved = reservation_index.reserved_keys(building_id, start, end)
+    else:
+        by_key: dict[str, KeyPeriods] = {}
+        for period in await load_reserved_periods(building_id=building_id):
+            by_key.setdefault(period.key_id, KeyPeriods()).add(period)
+        reserved = {key_id: periods.overlapping(start, end) for key_id, periods in by_key.items() if not periods.is_free(start, end)}
+    return {
+        "building_id": building_id,
+        "start": format_time(start),
+        "end": format_time(end),
+        "free": [key for key in keys if key.id not in reserved],
+        "reserved": [
+            {"key": key, "reservations": [period.to_json() for period in reserved[key.id]]}
+            for key in keys if key.id in reserved
+        ],
+    }
@@ -1,14 +1,22 @@
+import asyncio
 import dataclasses
 import datetime
+import logging
+import time
 from typing import Optional, Self, Tuple
 from uuid import uuid4
 
-from postgrest.types import CountMethod
+from kapi.db.active_borrows import ActiveBorrowIndex
+from kapi.db.availability import ReservedPeriod, reservation_index
+from kapi.db.borrowers import Borrower, known_borrowers
+from kapi.db.reservations import get_reservation_for_borrow_key
+from kapi.db.keys import Key, known_keys
+from kapi.db.overdue import DueBorrow, OverdueIndex, due_borrow
+from kapi.db.pagination import decode_cursor, check_count_method
+from kapi.db.repository import get_repository
+from kapi.events import publish_event
 
-from kapi.db.borrowers import Borrower, does_borrower_exist, add_borrower
-from kapi.db.db import supabase
-from kapi.db.reservations import does_reservation_exist, get_reservation_for_borrow_key
-from kapi.db.keys import Key, does_key_exist, add_key
+logger = logging.getLogger(__name__)
 
 
 @dataclasses.dataclass
@@ -34,7 +42,8 @@ class BorrowedKey:
 
     def __post_init__(self):
         self.id = str(uuid4())
-        self.borrowed_at = datetime.datetime.now().isoformat()
+        # with its offset, a naive local time is read as UTC by the overdue index and PostgREST alike
+        self.borrowed_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
         self.borrowed = True
 
     @classmethod
@@ -47,7 +56,7 @@ class BorrowedKey:
         )
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class BorrowedKeyResponse:
     id: str
     key: Key
@@ -63,20 +72,8 @@ class BorrowedKeyResponse:
     def from_supabase(cls, borrowed_key: dict) -> Self:
         return cls(
             id=borrowed_key["id"],
-            key=Key(
-                borrowed_key["keys"]["room_number"],
-                borrowed_key["keys"]["building_id"],
-                borrowed_key["keys"]["type"],
-                borrowed_key["key_id"]
-            ),
-            borrower=Borrower(
-                name=borrowed_key["borrowers"]["name"],
-                type=borrowed_key["borrowers"]["type"],
-                company=borrowed_key["borrowers"].get("company"),
-                id=borrowed_key["borrower_id"],
-                email=borrowed_key["borrowers"].get("email"),
-                phone=borrowed_key["borrowers"].get("phone")
-            ),
+            key=Key.from_row(borrowed_key["keys"], id=borrowed_key["key_id"]),
+            borrower=Borrower.from_row(borrowed_key["borrowers"], id=borrowed_key["borrower_id"]),
             image_filename=borrowed_key["image_filename"],
             signature_filename=borrowed_key["signature_filename"],
             building_id=borrowed_key["building_id"],
@@ -86,62 +83,125 @@ class BorrowedKeyResponse:
         )
 
 
-def get_borrowed_keys(limit: int = 20, offset: int = 0, borrowed: bool = None, building_id: str = None) -> Tuple[list[BorrowedKeyResponse], int]:
-    query = supabase.table("borrowed_keys").select("*", "keys(*)", "borrowers(*)", count=CountMethod.exact)
-    if borrowed is not None:
-        query = query.eq("borrowed", borrowed)
-    if building_id is not None:
-        query = query.eq("building_id", building_id)
-    # sort by borrowed_at desc default
-    query = query.order("borrowed_at", desc=True)
-    borrowed_keys = query.limit(limit).offset(offset).execute()
+async def load_active_borrows() -> list[BorrowedKeyResponse]:
+    return [BorrowedKeyResponse.from_supabase(borrowed_key) for borrowed_key in await get_repository().list_active_borrows()]
 
-    return [BorrowedKeyResponse.from_supabase(borrowed_key) for borrowed_key in borrowed_keys.data], borrowed_keys.count
 
+# what is out right now, see ActiveBorrowIndex
+active_borrows = ActiveBorrowIndex(load_active_borrows)
 
-def get_borrowed_key(borrow_id: str):
-    borrowed_key = supabase.table("borrowed_keys").select("*", "keys(*)", "borrowers(*)").eq("id", borrow_id).execute()
-    if len(borrowed_key.data) == 0:
-        return None
-    return BorrowedKeyResponse.from_supabase(borrowed_key.data[0])
 
+async def load_due_borrows() -> list[DueBorrow]:
+    repository = get_repository()
+    borrowed_keys, reservations = await asyncio.gather(repository.list_active_borrows(), repository.list_open_reservations())
+    periods = {reservation["borrowed_key_id"]: ReservedPeriod.from_row(reservation) for reservation in reservations if reservation.get("borrowed_key_id")}
+    due = []
+    for borrowed_key in borrowed_keys:
+        entry = due_borrow(BorrowedKeyResponse.from_supabase(borrowed_key), periods.get(borrowed_key["id"]))
+        if entry is None:
+            # one bad row should not keep every other borrow out of the index
+            logger.warning("Skipping borrowed key %s, borrowed_at is not a valid timestamp: %r", borrowed_key["id"], borrowed_key.get("borrowed_at"))
+            continue
+        due.append(entry)
+    return due
 
-def add_borrowed_key(key: Key, borrower_id: Borrower, files: Files, reservation_id: str = None):
-    # get the current time and date in iso format
-    if is_key_borrowed(key.id):
-        raise ValueError("Key already borrowed")
 
-    if not does_key_exist(key.id):
-        add_key(key)
+# what is out by when it is due back, see OverdueIndex
+overdue_borrows = OverdueIndex(load_due_borrows)
 
-    if not does_borrower_exist(borrower_id.id):
-        add_borrower(borrower_id)
 
-    borrowed_key = BorrowedKey.from_objects(key, borrower_id, files)
+def to_response(borrowed_key: BorrowedKey, key: Key, borrower: Borrower) -> BorrowedKeyResponse:
+    return BorrowedKeyResponse(
+        id=borrowed_key.id,
+        key=key,
+        borrower=borrower,
+        image_filename=borrowed_key.image_filename,
+        building_id=key.building_id,
+        signature_filename=borrowed_key.signature_filename,
+        borrowed=True,
+        borrowed_at=borrowed_key.borrowed_at,
+        returned_at=None
+    )
+
+
+async def get_borrowed_keys(limit: int = 20, offset: int = 0, borrowed: bool = None, building_id: str = None, cursor: str = None, count: str = "exact") -> Tuple[list[BorrowedKeyResponse], Optional[int]]:
+    check_count_method(count)
+    borrowed_keys, total = await get_repository().list_borrowed_keys(
+        limit=limit, offset=offset, borrowed=borrowed, building_id=building_id,
+        cursor=decode_cursor(cursor) if cursor else None, count=count
+    )
+
+    return [BorrowedKeyResponse.from_supabase(borrowed_key) for borrowed_key in borrowed_keys], total
 
-    borrowed_key_db = supabase.table("borrowed_keys").insert([
-        {
-            "id": borrowed_key.id,
-            "key_id": borrowed_key.key_id,
-            "borrower_id": borrowed_key.borrower_id,
-            "image_filename": borrowed_key.image_filename,
-            "signature_filename": borrowed_key.signature_filename,
-            "borrowed": borrowed_key.borrowed,
-            "borrowed_at": borrowed_key.borrowed_at,
-            "building_id": key.building_id
-        }
-    ]).execute()
 
+async def get_borrowed_key(borrow_id: str):
+    borrowed_key = await get_repository().get_borrowed_key(borrow_id)
+    if borrowed_key is None:
+        return None
+    return BorrowedKeyResponse.from_supabase(borrowed_key)
+
+
+def to_borrow_row(borrowed_key: BorrowedKey, key: Key) -> dict:
+    return {
+        "id": borrowed_key.id,
+        "key_id": borrowed_key.key_id,
+        "borrower_id": borrowed_key.borrower_id,
+        "image_filename": borrowed_key.image_filename,
+        "signature_filename": borrowed_key.signature_filename,
+        "borrowed": borrowed_key.borrowed,
+        "borrowed_at": borrowed_key.borrowed_at,
+        "building_id": key.building_id
+    }
+
+
+def publish_borrowed(row: dict, reservation_id: str = None):
+    publish_event("key.borrowed", {
+        "borrow_id": row["id"],
+        "key_id": row["key_id"],
+        "borrower_id": row["borrower_id"],
+        "building_id": row["building_id"],
+        "borrowed_at": row["borrowed_at"],
+    })
     if reservation_id:
-        if not does_reservation_exist(reservation_id):
-            print(f"Reservation {reservation_id} does not exist")
-        else:
-            borrowed_key_id = borrowed_key_db.data[0]["id"]
-            print(f"Linking reservation {reservation_id} to borrowed key {borrowed_key_id}")
-            supabase.table("key_reservations").update({
-                "collected": True,
-                "borrowed_key_id": borrowed_key_id
-            }).eq("id", reservation_id).execute()
+        publish_event("reservation.collected", {
+            "id": reservation_id,
+            "borrow_id": row["id"],
+            "key_id": row["key_id"],
+            "building_id": row["building_id"],
+        })
+
+
+def publish_returned(borrow_id: str, key_id: str, building_id: str, returned_at: str):
+    publish_event("key.returned", {
+        "borrow_id": borrow_id,
+        "key_id": key_id,
+        "building_id": building_id,
+        "returned_at": returned_at,
+    })
+
+
+async def add_borrowed_key(key: Key, borrower_id: Borrower, files: Files, reservation_id: str = None):
+    borrowed_key = BorrowedKey.from_objects(key, borrower_id, files)
+
+    # a single round-trip: upserts the key and borrower, inserts the borrow and links the reservation in one
+    # transaction, raises ValueError when the key is already out
+    row = to_borrow_row(borrowed_key, key)
+    try:
+        await get_repository().borrow_key(key.to_supabase(), borrower_id.to_supabase(), row, reservation_id=reservation_id)
+    except ValueError:
+        raise
+    except Exception:
+        known_keys.discard(key.id)
+        known_borrowers.discard(borrower_id.id)
+        raise
+    # both are upserted by the borrow, so later reservations can skip the existence checks
+    known_keys.add(key.id)
+    known_borrowers.add(borrower_id.id)
+    response = to_response(borrowed_key, key, borrower_id)
+    active_borrows.add(response)
+    # a reservation the index does not know (yet) is picked up by the next reconcile
+    overdue_borrows.add(due_borrow(response, reservation_index.get(reservation_id) if reservation_id else None))
+    publish_borrowed(row, reservation_id=reservation_id)
 
     # TODO optional future but needs proper testing, auto-infer reservation from data
     # existing_reservation = get_open_reservation_for_key(key.id, borrower=borrowed_key.borrower_id)
@@ -155,34 +215,116 @@ def add_borrowed_key(key: Key, borrower_id: Borrower, files: Files, reservation_
     return borrowed_key
 
 
-def is_key_borrowed(key_id: str):
-    borrowed_key_with_key_id = supabase.table("borrowed_keys").select("*").eq("key_id", key_id).eq("borrowed", True).execute()
-    if len(borrowed_key_with_key_id.data) > 0:
-        return True
-    return False
-
-
-def return_borrowed_key(borrow_id: str):
-    borrowed_key = get_borrowed_key(borrow_id)
+async def add_borrowed_keys(keys: list[Key], borrower: Borrower, files: Files) -> list[BorrowedKey]:
+    """
+    Borrows all keys to one borrower with the same photo and signature, in a single round-trip. Either all of them are
+    borrowed or none, raises KeysAlreadyBorrowed with the keys that are out.
+    """
+    keys = list({key.id: key for key in keys}.values())
+    borrowed_keys = [BorrowedKey.from_objects(key, borrower, files) for key in keys]
+
+    rows = [to_borrow_row(borrowed_key, key) for borrowed_key, key in zip(borrowed_keys, keys)]
+    try:
+        await get_repository().borrow_keys([key.to_supabase() for key in keys], borrower.to_supabase(), rows)
+    except ValueError:
+        raise
+    except Exception:
+        for key in keys:
+            known_keys.discard(key.id)
+        known_borrowers.discard(borrower.id)
+        raise
+    for key in keys:
+        known_keys.add(key.id)
+    known_borrowers.add(borrower.id)
+    for borrowed_key, key, row in zip(borrowed_keys, keys, rows):
+        response = to_response(borrowed_key, key, borrower)
+        active_borrows.add(response)
+        overdue_borrows.add(due_borrow(response))
+        publish_borrowed(row)
+
+    return borrowed_keys
+
+
+async def get_active_borrow_id(key_id: str) -> Optional[str]:
+    """The open borrow of the key, from memory once the index is warm."""
+    if active_borrows.warm:
+        borrowed_key = active_borrows.get_for_key(key_id)
+        return borrowed_key.id if borrowed_key is not None else None
+    borrowed_key_with_key_id = await get_repository().find_active_borrows(key_id)
+    if len(borrowed_key_with_key_id) > 0:
+        return borrowed_key_with_key_id[0]["id"]
+    return None
+
+
+async def is_key_borrowed(key_id: str):
+    return await get_active_borrow_id(key_id) is not None
+
+
+async def return_borrowed_key(borrow_id: str):
+    borrowed_key = await get_borrowed_key(borrow_id)
     if borrowed_key is None:
         raise ValueError("Borrowed key not found")
     if not borrowed_key.borrowed:
         raise ValueError("Key already returned")
 
-    borrowed_key.returned_at = datetime.datetime.now().isoformat()
-    borrowed_key.borrowed = False
+    borrowed_key = dataclasses.replace(borrowed_key, borrowed=False, returned_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
 
-    supabase.table("borrowed_keys").update({
+    await get_repository().update_borrowed_key(borrow_id, {
         "borrowed": borrowed_key.borrowed,
         "returned_at": borrowed_key.returned_at
-    }).eq("id", borrow_id).execute()
+    })
 
-    reservation = get_reservation_for_borrow_key(borrow_id)
+    reservation = await get_reservation_for_borrow_key(borrow_id)
     if reservation:
-        supabase.table("key_reservations").update({
+        await get_repository().update_reservation(reservation["id"], {
             "returned": True,
-        }).eq("id", reservation["id"]).execute()
-        print(f"Updated reservation {reservation['id']} to returned")
-
-    print(f"Returned borrowed key {borrow_id}")
+        })
+        reservation_index.remove(reservation["id"])
+        logger.info("Updated reservation %s to returned", reservation["id"])
+
+    active_borrows.remove(borrow_id)
+    overdue_borrows.remove(borrow_id)
+    publish_returned(borrow_id, borrowed_key.key.id, borrowed_key.building_id, borrowed_key.returned_at)
+    logger.info("Returned borrowed key %s", borrow_id)
     return borrowed_key
+
+
+async def return_borrowed_keys(borrow_ids: list[str]) -> list[str]:
+    """Returns every open borrow among borrow_ids in one update, gives back the ids that were actually returned."""
+    returned_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    returned = await get_repository().return_borrowed_keys(borrow_ids, returned_at)
+    returned_ids = [borrowed_key["id"] for borrowed_key in returned]
+    if returned_ids:
+        reservations = await get_repository().update_reservations_for_borrowed_keys(returned_ids, {
+            "returned": True,
+        })
+        for reservation in reservations:
+            reservation_index.remove(reservation["id"])
+        logger.info("Returned borrowed keys %s", ", ".join(returned_ids))
+    for borrowed_key in returned:
+        active_borrows.remove(borrowed_key["id"])
+        overdue_borrows.remove(borrowed_key["id"])
+        publish_returned(borrowed_key["id"], borrowed_key["key_id"], borrowed_key["building_id"], returned_at)
+    return returned_ids
+
+
+async def get_out_borrowed_keys(building_id: str = None) -> list[BorrowedKeyResponse]:
+    """Everything that is out right now (in a building), from memory once the index is warm."""
+    if active_borrows.warm:
+        return active_borrows.out(building_id)
+    borrowed_keys = [BorrowedKeyResponse.from_supabase(borrowed_key) for borrowed_key in await get_repository().list_active_borrows()]
+    if building_id is not None:
+        borrowed_keys = [borrowed_key for borrowed_key in borrowed_keys if borrowed_key.building_id == building_id]
+    return sorted(borrowed_keys, key=lambda borrowed_key: (borrowed_key.borrowed_at, borrowed_key.id), reverse=True)
+
+
+async def get_due_borrowed_keys(before: float = None, building_id: str = None) -> list[DueBorrow]:
+    """The borrowed keys (in a building) that are due back by before (default now), soonest first. From memory once
+    the index is warm."""
+    before = time.time() if before is None else before
+    if overdue_borrows.warm:
+        return overdue_borrows.due_before(before, building_id=building_id)
+    due = [entry for entry in await load_due_borrows() if entry.due_at <= before]
+    if building_id is not None:
+        due = [entry for entry in due if entry.borrowed_key.building_id == building_id]
+    return sorted(due, key=lambda entry: (entry.due_at, entry.id))
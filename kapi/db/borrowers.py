@@ -1,14 +1,18 @@
 import dataclasses
 import uuid
-from typing import Optional
+from typing import Optional, Self
 from uuid import uuid5
 
-from kapi.db.db import supabase
+from kapi.db.cache import KnownIdCache
+from kapi.db.repository import get_repository
 
 BORROWER_UUID5_NAMESPACE = uuid.UUID("50ad06e6-5abe-48d2-8912-148077032ae0")
 
+# borrower ids we have already seen in the database
+known_borrowers = KnownIdCache()
 
-@dataclasses.dataclass
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class Borrower:
     name: str
     type: str
@@ -30,26 +34,42 @@ class Borrower:
         return s
 
     def __post_init__(self):
-        self.id = str(uuid5(BORROWER_UUID5_NAMESPACE, self.id_hash_string()))
+        # rows from the database come with their id, no need to hash it again
+        if not self.id:
+            object.__setattr__(self, "id", str(uuid5(BORROWER_UUID5_NAMESPACE, self.id_hash_string())))
+
+    @classmethod
+    def from_row(cls, borrower: dict, id: str = None) -> Self:
+        return cls(borrower["name"], borrower["type"], borrower.get("company"), id or borrower["id"],
+                   borrower.get("email"), borrower.get("phone"))
 
+    def to_supabase(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "company": self.company,
+            "type": self.type,
+            "email": self.email,
+            "phone": self.phone
+        }
 
-def does_borrower_exist(borrower_id: str):
-    borrower = supabase.table("borrowers").select("*").eq("id", borrower_id).execute()
-    if len(borrower.data) == 0:
+
+async def does_borrower_exist(borrower_id: str):
+    if known_borrowers.is_known(borrower_id):
+        return True
+    borrower = await get_repository().get_borrower(borrower_id)
+    if borrower is None:
         return False
+    known_borrowers.add(borrower_id)
     return True
 
 
-def add_borrower(borrower: Borrower):
-    supabase.table("borrowers").insert([
-        {
-            "id": borrower.id,
-            "name": borrower.name,
-            "company": borrower.company,
-            "type": borrower.type,
-            "email": borrower.email,
-            "phone": borrower.phone
-        }
-    ]).execute()
+async def add_borrower(borrower: Borrower):
+    try:
+        await get_repository().insert_borrower(borrower.to_supabase())
+    except Exception:
+        known_borrowers.discard(borrower.id)
+        raise
+    known_borrowers.add(borrower.id)
 
     return borrower
@@ -1,48 +1,65 @@
 import dataclasses
+import os
 import uuid
-from typing import Optional, Tuple
+from typing import Optional, Self, Tuple
 from uuid import uuid5
 
-from postgrest.types import CountMethod
-
-from kapi.db.db import supabase
+from kapi.db.cache import SnapshotCache
+from kapi.db.repository import get_repository
 
 BUILDING_UUID5_NAMESPACE = uuid.UUID("50ad06e6-5abe-48d2-8912-148077032aee")
 
+# other workers can add buildings too, the ttl bounds how long they stay invisible here
+BUILDINGS_CACHE_TTL = float(os.getenv("KAPI_BUILDINGS_CACHE_TTL", "300"))
+
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class Building:
     name: str
     id: Optional[str] = ""
 
     def __post_init__(self):
         if self.id == "":
-            self.id = str(uuid5(BUILDING_UUID5_NAMESPACE, self.name))
+            object.__setattr__(self, "id", str(uuid5(BUILDING_UUID5_NAMESPACE, self.name)))
 
+    @classmethod
+    def from_row(cls, building: dict) -> Self:
+        return cls(building["name"], building["id"])
 
-def does_building_exist(building_name: str):
-    building = supabase.table("buildings").select("*").eq("name", building_name).execute()
-    if len(building.data) == 0:
+
+async def does_building_exist(building_name: str):
+    building = await get_repository().get_building_by_name(building_name)
+    if building is None:
         return False
     return True
 
-def get_all_buildings(limit: int = 20, offset: int=0, search: str = None) -> Tuple[list[Building], int]:
-    query = supabase.table("buildings").select("*", count=CountMethod.exact)
+async def load_all_buildings() -> list[Building]:
+    buildings = await get_repository().list_all_buildings()
+    return sorted((Building.from_row(building) for building in buildings), key=lambda building: building.name.lower())
+
+
+# the whole catalogue, search and pagination are served from memory
+buildings_cache: SnapshotCache[list[Building]] = SnapshotCache(load_all_buildings, ttl=BUILDINGS_CACHE_TTL)
+
+
+async def get_all_buildings(limit: int = 20, offset: int=0, search: str = None) -> Tuple[list[Building], int]:
+    buildings = await buildings_cache.get()
     if search is not None:
-        query = query.ilike("name", f"%{search}%")
-    buildings = query.limit(limit).offset(offset).execute()
-    return [Building(building["name"], id=building["id"]) for building in buildings.data], buildings.count
+        search = search.lower()
+        buildings = [building for building in buildings if search in building.name.lower()]
+    return buildings[offset:offset + limit], len(buildings)
 
 
-def add_building(name: str):
-    if does_building_exist(name):
+async def add_building(name: str):
+    if await does_building_exist(name):
         raise ValueError("Building already exists")
 
     building = Building(name)
-    supabase.table("buildings").insert([
-        {
+    try:
+        await get_repository().insert_building({
             "id": building.id,
             "name": building.name
-        }
-    ]).execute()
+        })
+    finally:
+        buildings_cache.invalidate()
     return building
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+KNOWN_ID_CACHE_SIZE = int(os.getenv("KAPI_KNOWN_ID_CACHE_SIZE", "4096"))
+
+
+class KnownIdCache:
+    """
+    Bounded LRU of ids that are known to exist in the database.
+
+    Key and borrower ids are deterministic, so once we have seen one in the database we can skip the existence
+    check next time. Only positive results are cached, a miss always goes to the database.
+    """
+
+    def __init__(self, maxsize: int = KNOWN_ID_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._ids: OrderedDict[str, None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def is_known(self, id: str) -> bool:
+        if id in self._ids:
+            self._ids.move_to_end(id)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, id: str):
+        self._ids[id] = None
+        self._ids.move_to_end(id)
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+
+    def discard(self, id: str):
+        self._ids.pop(id, None)
+
+    def clear(self):
+        self._ids.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._ids),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class SnapshotCache(Generic[T]):
+    """
+    Keeps the result of load() in memory until it is older than ttl seconds or invalidated.
+
+    Meant for small tables that are read all the time and rarely written, concurrent reloads share a single load.
+    """
+
+    def __init__(self, load: Callable[[], Awaitable[T]], ttl: float):
+        self.load = load
+        self.ttl = ttl
+        self._value: Optional[T] = None
+        self._loaded_at: Optional[float] = None
+        self._loading: Optional[asyncio.Task] = None
+        # bumped on invalidate, a load that started before the invalidation must not be stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def age(self) -> Optional[float]:
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    async def get(self) -> T:
+        age = self.age()
+        if age is not None and age < self.ttl:
+            self.hits += 1
+            return self._value
+
+        self.misses += 1
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._reload(self._generation))
+        loading = self._loading
+        await asyncio.shield(loading)
+        return loading.result()
+
+    async def _reload(self, generation: int) -> T:
+        try:
+            value = await self.load()
+        finally:
+            if self._generation == generation:
+                self._loading = None
+        if self._generation == generation:
+            self._value = value
+            self._loaded_at = time.monotonic()
+        return value
+
+    def invalidate(self):
+        self._generation += 1
+        self._value = None
+        self._loaded_at = None
+        self._loading = None
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "age_seconds": self.age(),
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
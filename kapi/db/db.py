@@ -1,17 +1,44 @@
+import asyncio
+import functools
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
 
-from supabase import create_client, Client
+if TYPE_CHECKING:
+    from supabase import Client
 
 url: str = os.getenv("SUPABASE_URL")
 key: str = os.getenv("SUPABASE_ANON_KEY")
 
-print(f"Connecting to Supabase with {url=}, {key=}")
+_supabase: Optional["Client"] = None
+_supabase_lock = threading.Lock()
 
-supabase: Client = create_client(url, key)
 
-print(f"Connected to Supabase")
+def get_supabase() -> "Client":
+    # only built (and the supabase package only imported, a good part of the startup time) on first use, so the
+    # in-memory backend never needs Supabase at all. connect_backend() does it in a thread at startup.
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                from supabase import create_client
+                print(f"Connecting to Supabase at {url}")
+                _supabase = create_client(url, key)
+    return _supabase
 
-# TODO we could make it more class based instead of current function based, as we already have the classes defined
 
+# The supabase client is blocking, so every round-trip runs on a bounded pool of worker threads
+# instead of stalling the event loop (and with it every other request on the worker).
+DB_MAX_WORKERS = int(os.getenv("KAPI_DB_MAX_WORKERS", "16"))
 
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="kapi-db")
 
+
+async def run_sync(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def execute(query):
+    return await run_sync(query.execute)
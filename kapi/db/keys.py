@@ -1,10 +1,14 @@
 import dataclasses
-from typing import Optional
+from typing import Optional, Self
 
-from kapi.db.db import supabase
+from kapi.db.cache import KnownIdCache
+from kapi.db.repository import get_repository
 
+# key ids we have already seen in the database
+known_keys = KnownIdCache()
 
-@dataclasses.dataclass
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class Key:
     room_number: str
     building_id: str
@@ -12,24 +16,39 @@ class Key:
     id: Optional[str] = ""
 
     def __post_init__(self):
-        self.id = f"{self.building_id}-{self.room_number}-{self.type}"
+        # rows from the database come with their id, no need to derive it again
+        if not self.id:
+            object.__setattr__(self, "id", f"{self.building_id}-{self.room_number}-{self.type}")
+
+    @classmethod
+    def from_row(cls, key: dict, id: str = None) -> Self:
+        return cls(key["room_number"], key["building_id"], key["type"], id or key["id"])
+
+    def to_supabase(self) -> dict:
+        return {
+            "id": self.id,
+            "building_id": self.building_id,
+            "room_number": self.room_number,
+            "type": self.type
+        }
 
 
-def does_key_exist(key_id: str):
-    key = supabase.table("keys").select("*").eq("id", key_id).execute()
-    if len(key.data) == 0:
+async def does_key_exist(key_id: str):
+    if known_keys.is_known(key_id):
+        return True
+    key = await get_repository().get_key(key_id)
+    if key is None:
         return False
+    known_keys.add(key_id)
     return True
 
 
-def add_key(key: Key):
-    supabase.table("keys").insert([
-        {
-            "id": key.id,
-            "building_id": key.building_id,
-            "room_number": key.room_number,
-            "type": key.type
-        }
-    ]).execute()
+async def add_key(key: Key):
+    try:
+        await get_repository().insert_key(key.to_supabase())
+    except Exception:
+        known_keys.discard(key.id)
+        raise
+    known_keys.add(key.id)
 
     return key
@@ -0,0 +1,237 @@
+import copy
+import datetime
+from typing import Optional, Tuple
+from uuid import uuid4
+
+from kapi.db.availability import reservation_period
+from kapi.db.repository import Repository, Storage, KeysAlreadyBorrowed, ReservationConflict
+
+
+def _page(rows: list[dict], limit: int, offset: int) -> Tuple[list[dict], int]:
+    return rows[offset:offset + limit], len(rows)
+
+
+def _sorted_page(rows: list[dict], sort_column: str, limit: int, offset: int, cursor: Tuple[str, str], count: str) -> Tuple[list[dict], Optional[int]]:
+    rows.sort(key=lambda row: (row[sort_column], row["id"]), reverse=True)
+    if cursor is not None:
+        rows = [row for row in rows if (row[sort_column], row["id"]) < cursor]
+        offset = 0
+    # counted after the cursor filter, like PostgREST counts what matches the or= filter
+    return rows[offset:offset + limit], None if count == "none" else len(rows)
+
+
+class MemoryRepository(Repository):
+    """
+    In-process stand-in for the Supabase tables, for tests, load tests and offline development.
+
+    Every method runs without awaiting anything, so each one is atomic with respect to the event loop.
+    """
+
+    def __init__(self):
+        self.keys: dict[str, dict] = {}
+        self.borrowers: dict[str, dict] = {}
+        self.buildings: dict[str, dict] = {}
+        self.borrowed_keys: dict[str, dict] = {}
+        self.key_reservations: dict[str, dict] = {}
+
+    @staticmethod
+    def _insert(table: dict[str, dict], row: dict) -> dict:
+        if row["id"] in table:
+            raise ValueError(f"Duplicate key value {row['id']}")
+        table[row["id"]] = dict(row)
+        return dict(row)
+
+    @staticmethod
+    def _update(table: dict[str, dict], row_id: str, values: dict) -> Optional[dict]:
+        if row_id not in table:
+            return None
+        table[row_id].update(values)
+        return dict(table[row_id])
+
+    def _joined(self, row: dict) -> dict:
+        joined = dict(row)
+        joined["keys"] = copy.copy(self.keys.get(row["key_id"]))
+        joined["borrowers"] = copy.copy(self.borrowers.get(row.get("borrower_id")))
+        return joined
+
+    # keys
+    async def get_key(self, key_id: str) -> Optional[dict]:
+        return copy.copy(self.keys.get(key_id))
+
+    async def list_keys(self, building_id: str) -> list[dict]:
+        return [dict(key) for key in self.keys.values() if key["building_id"] == building_id]
+
+    async def insert_key(self, row: dict) -> dict:
+        return self._insert(self.keys, row)
+
+    # borrowers
+    async def get_borrower(self, borrower_id: str) -> Optional[dict]:
+        return copy.copy(self.borrowers.get(borrower_id))
+
+    async def insert_borrower(self, row: dict) -> dict:
+        return self._insert(self.borrowers, row)
+
+    # buildings
+    async def get_building_by_name(self, name: str) -> Optional[dict]:
+        for building in self.buildings.values():
+            if building["name"] == name:
+                return dict(building)
+        return None
+
+    async def list_buildings(self, limit: int, offset: int, search: str = None) -> Tuple[list[dict], int]:
+        buildings = [dict(building) for building in self.buildings.values()
+                     if search is None or search.lower() in building["name"].lower()]
+        return _page(buildings, limit, offset)
+
+    async def list_all_buildings(self) -> list[dict]:
+        return [dict(building) for building in self.buildings.values()]
+
+    async def insert_building(self, row: dict) -> dict:
+        return self._insert(self.buildings, row)
+
+    # borrowed_keys
+    async def list_borrowed_keys(self, limit: int, offset: int, borrowed: bool = None, building_id: str = None, cursor: Tuple[str, str] = None, count: str = "exact") -> Tuple[list[dict], Optional[int]]:
+        borrowed_keys = [
+            self._joined(borrowed_key) for borrowed_key in self.borrowed_keys.values()
+            if (borrowed is None or borrowed_key["borrowed"] == borrowed)
+            and (building_id is None or borrowed_key["building_id"] == building_id)
+        ]
+        return _sorted_page(borrowed_keys, "borrowed_at", limit, offset, cursor, count)
+
+    async def get_borrowed_key(self, borrow_id: str) -> Optional[dict]:
+        borrowed_key = self.borrowed_keys.get(borrow_id)
+        if borrowed_key is None:
+            return None
+        return self._joined(borrowed_key)
+
+    async def find_active_borrows(self, key_id: str) -> list[dict]:
+        return [dict(borrowed_key) for borrowed_key in self.borrowed_keys.values()
+                if borrowed_key["key_id"] == key_id and borrowed_key["borrowed"]]
+
+    async def list_active_borrows(self) -> list[dict]:
+        return [self._joined(borrowed_key) for borrowed_key in self.borrowed_keys.values() if borrowed_key["borrowed"]]
+
+    async def insert_borrowed_key(self, row: dict) -> dict:
+        return self._insert(self.borrowed_keys, {"returned_at": None, **row})
+
+    async def update_borrowed_key(self, borrow_id: str, values: dict) -> Optional[dict]:
+        return self._update(self.borrowed_keys, borrow_id, values)
+
+    async def borrow_key(self, key: dict, borrower: dict, borrowed_key: dict, reservation_id: str = None) -> dict:
+        if await self.find_active_borrows(key["id"]):
+            raise ValueError("Key already borrowed")
+        self.keys.setdefault(key["id"], dict(key))
+        self.borrowers.setdefault(borrower["id"], dict(borrower))
+        row = await self.insert_borrowed_key(borrowed_key)
+        if reservation_id:
+            self._update(self.key_reservations, reservation_id, {
+                "collected": True,
+                "borrowed_key_id": row["id"]
+            })
+        return row
+
+    async def borrow_keys(self, keys: list[dict], borrower: dict, borrowed_keys: list[dict]) -> list[dict]:
+        key_ids = {key["id"] for key in keys}
+        borrowed = sorted({borrowed_key["key_id"] for borrowed_key in self.borrowed_keys.values()
+                           if borrowed_key["borrowed"] and borrowed_key["key_id"] in key_ids})
+        if borrowed:
+            raise KeysAlreadyBorrowed(borrowed)
+        for key in keys:
+            self.keys.setdefault(key["id"], dict(key))
+        self.borrowers.setdefault(borrower["id"], dict(borrower))
+        return [self._insert(self.borrowed_keys, {"returned_at": None, **borrowed_key}) for borrowed_key in borrowed_keys]
+
+    async def return_borrowed_keys(self, borrow_ids: list[str], returned_at: str) -> list[dict]:
+        return [
+            self._update(self.borrowed_keys, borrow_id, {"borrowed": False, "returned_at": returned_at})
+            for borrow_id in dict.fromkeys(borrow_ids)
+            if borrow_id in self.borrowed_keys and self.borrowed_keys[borrow_id]["borrowed"]
+        ]
+
+    # key_reservations
+    async def list_reservations(self, limit: int, offset: int, collected: bool = None, returned: bool = None, building_id: str = None, cursor: Tuple[str, str] = None, count: str = "exact") -> Tuple[list[dict], Optional[int]]:
+        reservations = [
+            self._joined(reservation) for reservation in self.key_reservations.values()
+            if (collected is None or reservation["collected"] == collected)
+            and (returned is None or reservation["returned"] == returned)
+            and (building_id is None or reservation["building_id"] == building_id)
+        ]
+        return _sorted_page(reservations, "created_at", limit, offset, cursor, count)
+
+    async def get_reservation(self, reservation_id: str) -> Optional[dict]:
+        return copy.copy(self.key_reservations.get(reservation_id))
+
+    async def get_open_reservation_for_key(self, key_id: str) -> Optional[dict]:
+        for reservation in self.key_reservations.values():
+            if reservation["key_id"] == key_id and not reservation["collected"]:
+                return self._joined(reservation)
+        return None
+
+    async def get_reservation_for_borrowed_key(self, borrowed_key_id: str) -> Optional[dict]:
+        for reservation in self.key_reservations.values():
+            if reservation["borrowed_key_id"] == borrowed_key_id:
+                return dict(reservation)
+        return None
+
+    async def list_open_reservations(self, key_id: str = None, building_id: str = None) -> list[dict]:
+        return [
+            dict(reservation) for reservation in self.key_reservations.values()
+            if not reservation["returned"]
+            and (key_id is None or reservation["key_id"] == key_id)
+            and (building_id is None or reservation["building_id"] == building_id)
+        ]
+
+    async def insert_reservation(self, row: dict) -> dict:
+        # the exclusion constraint on key_reservations
+        if row.get("collection_at"):
+            start, end = reservation_period(row["collection_at"], row.get("return_at"))
+            conflicts = []
+            for reservation in await self.list_open_reservations(key_id=row["key_id"]):
+                if reservation.get("collection_at"):
+                    other_start, other_end = reservation_period(reservation["collection_at"], reservation.get("return_at"))
+                    if other_start < end and start < other_end:
+                        conflicts.append(reservation["id"])
+            if conflicts:
+                raise ReservationConflict(conflicts)
+        # column defaults of the key_reservations table
+        return self._insert(self.key_reservations, {
+            "id": str(uuid4()),
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "collected": False,
+            "returned": False,
+            "borrowed_key_id": None,
+            **row,
+        })
+
+    async def update_reservation(self, reservation_id: str, values: dict) -> Optional[dict]:
+        return self._update(self.key_reservations, reservation_id, values)
+
+    async def update_reservations_for_borrowed_keys(self, borrowed_key_ids: list[str], values: dict) -> list[dict]:
+        return [
+            self._update(self.key_reservations, reservation["id"], values)
+            for reservation in list(self.key_reservations.values())
+            if reservation.get("borrowed_key_id") in borrowed_key_ids
+        ]
+
+    async def delete_reservation(self, reservation_id: str) -> Optional[dict]:
+        return self.key_reservations.pop(reservation_id, None)
+
+    async def ping(self):
+        pass
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.buckets: dict[str, dict[str, bytes]] = {}
+
+    async def download(self, bucket: str, filename: str) -> bytes:
+        try:
+            return self.buckets[bucket][filename]
+        except KeyError:
+            raise FileNotFoundError(f"{filename} not found in bucket {bucket}")
+
+    async def upload(self, bucket: str, filename: str, data: bytes, content_type: str):
+        self.buckets.setdefault(bucket, {})[filename] = data
+
+    async def ping(self, bucket: str):
+        pass
@@ -0,0 +1,135 @@
+import dataclasses
+import heapq
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from kapi.db.availability import ReservedPeriod, format_time, parse_time
+from kapi.db.reconciled import ReconciledIndex
+
+# a borrowed key without a reservation is due back this long after it was borrowed
+OVERDUE_HOURS = float(os.getenv("KAPI_OVERDUE_HOURS", "24"))
+# what /borrowed-keys/overdue lists as due soon by default
+DUE_SOON_HOURS = float(os.getenv("KAPI_DUE_SOON_HOURS", "2"))
+OVERDUE_RECONCILE_SECONDS = float(os.getenv("KAPI_OVERDUE_RECONCILE_SECONDS", "60"))
+# the heap is rebuilt once it holds this many more entries than there are borrows
+COMPACT_SLACK = 64
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class DueBorrow:
+    borrowed_key: object  # BorrowedKeyResponse
+    due_at: float
+    reservation_id: Optional[str] = None
+
+    @property
+    def id(self) -> str:
+        return self.borrowed_key.id
+
+    def to_json(self, now: float) -> dict:
+        return {
+            "borrowed_key": self.borrowed_key,
+            "reservation_id": self.reservation_id,
+            "due_at": format_time(self.due_at),
+            "overdue_seconds": max(0, round(now - self.due_at)),
+        }
+
+
+def due_borrow(borrowed_key, period: Optional[ReservedPeriod] = None) -> Optional[DueBorrow]:
+    """
+    Due at the end of the reservation it was collected for, otherwise OVERDUE_HOURS after it was borrowed. None when
+    it has neither, a borrowed_at that is missing or not a valid timestamp.
+    """
+    if period is not None:
+        return DueBorrow(borrowed_key, period.end, period.id)
+    try:
+        return DueBorrow(borrowed_key, parse_time(borrowed_key.borrowed_at) + OVERDUE_HOURS * 3600)
+    except (TypeError, ValueError):
+        return None
+
+
+class OverdueIndex(ReconciledIndex):
+    """
+    The borrowed keys that are out, in a heap on when they are due back, see ReconciledIndex.
+
+    Removing from the middle of a heap is expensive, so removed or changed borrows leave their old entry behind and
+    the lookups skip the entries that no longer match, until the heap is rebuilt. Everything due before a moment is
+    the top of the heap, found without looking at the rest: O(k) for k results instead of a scan over every borrow.
+    """
+
+    description = "the due borrowed keys"
+
+    def __init__(self, load: Callable[[], Awaitable[list]], reconcile_seconds: float = OVERDUE_RECONCILE_SECONDS):
+        self._by_id: dict[str, DueBorrow] = {}
+        self._heap: list[tuple[float, str]] = []
+        super().__init__(load, reconcile_seconds)
+
+    def _is_current(self, due_at: float, borrow_id: str) -> bool:
+        entry = self._by_id.get(borrow_id)
+        return entry is not None and entry.due_at == due_at
+
+    def _add(self, entry: DueBorrow):
+        current = self._by_id.get(entry.id)
+        self._by_id[entry.id] = entry
+        if current is None or current.due_at != entry.due_at:
+            heapq.heappush(self._heap, (entry.due_at, entry.id))
+            self._compact()
+
+    def _remove(self, borrow_id: str):
+        if self._by_id.pop(borrow_id, None) is not None:
+            self._compact()
+
+    def _clear(self):
+        self._by_id, self._heap = {}, []
+
+    def _ids(self):
+        return self._by_id.keys()
+
+    def release_reservation(self, borrow_id: str):
+        """The reservation the borrow was collected for is gone, it is due OVERDUE_HOURS after it was borrowed again."""
+        entry = self._by_id.get(borrow_id)
+        if entry is None or entry.reservation_id is None:
+            return
+        due = due_borrow(entry.borrowed_key)
+        if due is None:
+            self.remove(borrow_id)
+        else:
+            self.add(due)
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._by_id) + COMPACT_SLACK:
+            self._heap = [(entry.due_at, entry.id) for entry in self._by_id.values()]
+            heapq.heapify(self._heap)
+
+    def next_due(self) -> Optional[DueBorrow]:
+        while self._heap and not self._is_current(*self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._by_id[self._heap[0][1]] if self._heap else None
+
+    def due_before(self, moment: float, building_id: str = None) -> list[DueBorrow]:
+        """The borrows due at or before moment, soonest first."""
+        found = {}
+        # the children of an entry are never due earlier, so a branch ends at the first entry past moment
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            if index >= len(self._heap) or self._heap[index][0] > moment:
+                continue
+            due_at, borrow_id = self._heap[index]
+            if self._is_current(due_at, borrow_id):
+                found[borrow_id] = self._by_id[borrow_id]
+            stack += [2 * index + 1, 2 * index + 2]
+        entries = found.values()
+        if building_id is not None:
+            entries = [entry for entry in entries if entry.borrowed_key.building_id == building_id]
+        return sorted(entries, key=lambda entry: (entry.due_at, entry.id))
+
+    def stats(self) -> dict:
+        next_due = self.next_due()
+        return {
+            **super().stats(),
+            "borrowed": len(self._by_id),
+            "overdue": len(self.due_before(time.time())),
+            "next_due_at": format_time(next_due.due_at) if next_due is not None else None,
+            "heap_size": len(self._heap),
+        }
@@ -0,0 +1,35 @@
+import base64
+import datetime
+import json
+import uuid
+from typing import Optional, Tuple
+
+# exact counts every matching row on each page, planned/estimated use the planner statistics, none skips counting
+COUNT_METHODS = ("exact", "planned", "estimated", "none")
+
+
+def encode_cursor(sort_value: str, id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_value, id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    # both end up in a PostgREST filter, so only a timestamp and a uuid get through
+    try:
+        sort_value, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        datetime.datetime.fromisoformat(sort_value)
+        uuid.UUID(id)
+        return sort_value, id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def next_cursor(items: list, limit: int, sort_attribute: str) -> Optional[str]:
+    # a short page is the last one
+    if len(items) < limit or len(items) == 0:
+        return None
+    return encode_cursor(getattr(items[-1], sort_attribute), items[-1].id)
+
+
+def check_count_method(count: str):
+    if count not in COUNT_METHODS:
+        raise ValueError(f"Unknown count method {count}, expected one of {', '.join(COUNT_METHODS)}")
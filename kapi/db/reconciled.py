@@ -0,0 +1,116 @@
+import abc
+import asyncio
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+
+class ReconciledIndex(abc.ABC):
+    """
+    Base for the process-local indexes over a table: filled from load() at startup and every reconcile_seconds after
+    that, in between the write paths keep it up to date through add() and remove(). Changes made by other workers
+    only show up after the next reconcile, so these serve reads only, the database stays the authority on writes.
+    Until the first load succeeds the index is cold and callers fall back to the database.
+
+    Subclasses keep the actual index in _add, _remove and _clear.
+    """
+
+    # for the log lines, e.g. "the borrowed keys"
+    description = "the index"
+
+    def __init__(self, load: Callable[[], Awaitable[list]], reconcile_seconds: float):
+        self.load = load
+        self.reconcile_seconds = reconcile_seconds
+        self._loaded_at: Optional[float] = None
+        # changes made while a reconcile is loading, replayed on top of what it loaded
+        self._changes: Optional[list[tuple[str, object]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self.reconciles = 0
+        # entries the last reconciles found different from the index, mostly other workers
+        self.drift = 0
+
+    @abc.abstractmethod
+    def _add(self, entry): ...
+
+    @abc.abstractmethod
+    def _remove(self, entry_id: str): ...
+
+    @abc.abstractmethod
+    def _clear(self): ...
+
+    @abc.abstractmethod
+    def _ids(self) -> Iterable[str]: ...
+
+    @staticmethod
+    def _id_of(entry) -> str:
+        return entry.id
+
+    @property
+    def warm(self) -> bool:
+        return self._loaded_at is not None
+
+    def add(self, entry):
+        if self._changes is not None:
+            self._changes.append(("add", entry))
+        self._add(entry)
+
+    def remove(self, entry_id: str):
+        if self._changes is not None:
+            self._changes.append(("remove", entry_id))
+        self._remove(entry_id)
+
+    async def reconcile(self):
+        self._changes = []
+        try:
+            entries = await self.load()
+            changes = self._changes
+        finally:
+            self._changes = None
+
+        loaded = {self._id_of(entry) for entry in entries}
+        if self.warm:
+            self.drift += len(loaded.symmetric_difference(self._ids()))
+        self._clear()
+        for entry in entries:
+            self._add(entry)
+        for change, value in changes:
+            if change == "add":
+                self._add(value)
+            else:
+                self._remove(value)
+        self._loaded_at = time.monotonic()
+        self.reconciles += 1
+
+    async def start(self):
+        try:
+            await self.reconcile()
+        except Exception as e:
+            print(f"Could not load {self.description}, answering from the database for now: {e}")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # nothing keeps it in sync anymore
+        self.reset()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reconcile_seconds)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                print(f"Reconciling {self.description} failed: {e}")
+
+    def reset(self):
+        self._clear()
+        self._loaded_at = None
+
+    def stats(self) -> dict:
+        return {
+            "warm": self.warm,
+            "age_seconds": time.monotonic() - self._loaded_at if self.warm else None,
+            "reconciles": self.reconciles,
+            "drift": self.drift,
+        }
@@ -0,0 +1,230 @@
+import abc
+import asyncio
+import os
+import threading
+from typing import Optional, Tuple
+
+from kapi.metrics import instrument_repository, instrument_storage
+
+# "supabase" talks to PostgREST/storage, "memory" keeps everything in-process (tests, load tests, offline dev)
+DB_BACKEND = os.getenv("KAPI_DB_BACKEND", "supabase")
+
+
+class KeysAlreadyBorrowed(ValueError):
+    def __init__(self, key_ids: list[str]):
+        super().__init__("Key already borrowed")
+        self.key_ids = key_ids
+
+
+class ReservationConflict(ValueError):
+    def __init__(self, reservation_ids: list[str]):
+        super().__init__("Key already reserved in that period")
+        self.reservation_ids = reservation_ids
+
+
+class Repository(abc.ABC):
+    """
+    Data access for the keys, borrowers, buildings, borrowed_keys and key_reservations tables.
+
+    Rows go in and come out as plain dicts shaped like PostgREST responses, borrowed keys and reservations
+    have their key and borrower joined in under "keys" and "borrowers".
+    """
+
+    # keys
+    @abc.abstractmethod
+    async def get_key(self, key_id: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def insert_key(self, row: dict) -> dict: ...
+
+    @abc.abstractmethod
+    async def list_keys(self, building_id: str) -> list[dict]: ...
+
+    # borrowers
+    @abc.abstractmethod
+    async def get_borrower(self, borrower_id: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def insert_borrower(self, row: dict) -> dict: ...
+
+    # buildings
+    @abc.abstractmethod
+    async def get_building_by_name(self, name: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def list_buildings(self, limit: int, offset: int, search: str = None) -> Tuple[list[dict], int]: ...
+
+    @abc.abstractmethod
+    async def list_all_buildings(self) -> list[dict]: ...
+
+    @abc.abstractmethod
+    async def insert_building(self, row: dict) -> dict: ...
+
+    # borrowed_keys
+    @abc.abstractmethod
+    async def list_borrowed_keys(self, limit: int, offset: int, borrowed: bool = None, building_id: str = None, cursor: Tuple[str, str] = None, count: str = "exact") -> Tuple[list[dict], Optional[int]]:
+        """
+        Newest first, ordered by (borrowed_at, id). With a cursor, the (borrowed_at, id) of the last row of the previous
+        page, offset is ignored and the page starts right after that row. count is one of pagination.COUNT_METHODS,
+        the total is None for "none".
+        """
+
+    @abc.abstractmethod
+    async def get_borrowed_key(self, borrow_id: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def find_active_borrows(self, key_id: str) -> list[dict]: ...
+
+    @abc.abstractmethod
+    async def list_active_borrows(self) -> list[dict]:
+        """Every borrowed key that is currently out, joined like list_borrowed_keys."""
+
+    @abc.abstractmethod
+    async def insert_borrowed_key(self, row: dict) -> dict: ...
+
+    @abc.abstractmethod
+    async def update_borrowed_key(self, borrow_id: str, values: dict) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def borrow_key(self, key: dict, borrower: dict, borrowed_key: dict, reservation_id: str = None) -> dict:
+        """
+        Atomically creates the key and borrower if they are new, inserts the borrowed key and marks the reservation
+        (if any) as collected. Raises ValueError if the key is already borrowed.
+        """
+
+    @abc.abstractmethod
+    async def borrow_keys(self, keys: list[dict], borrower: dict, borrowed_keys: list[dict]) -> list[dict]:
+        """
+        borrow_key for a whole ring of keys with one borrower, all or nothing. Raises KeysAlreadyBorrowed with the
+        ids of the keys that are out.
+        """
+
+    @abc.abstractmethod
+    async def return_borrowed_keys(self, borrow_ids: list[str], returned_at: str) -> list[dict]:
+        """Closes the open borrows among borrow_ids in one update, returns the rows that were closed."""
+
+    # key_reservations
+    @abc.abstractmethod
+    async def list_reservations(self, limit: int, offset: int, collected: bool = None, returned: bool = None, building_id: str = None, cursor: Tuple[str, str] = None, count: str = "exact") -> Tuple[list[dict], Optional[int]]:
+        """Newest first, ordered by (created_at, id), cursor and count work like in list_borrowed_keys."""
+
+    @abc.abstractmethod
+    async def get_reservation(self, reservation_id: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def get_open_reservation_for_key(self, key_id: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def get_reservation_for_borrowed_key(self, borrowed_key_id: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def list_open_reservations(self, key_id: str = None, building_id: str = None) -> list[dict]:
+        """Every reservation that is not returned yet (of the key, in the building), without joins."""
+
+    @abc.abstractmethod
+    async def insert_reservation(self, row: dict) -> dict:
+        """Raises ReservationConflict when the key is already reserved for part of the period, see availability."""
+
+    @abc.abstractmethod
+    async def update_reservation(self, reservation_id: str, values: dict) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def update_reservations_for_borrowed_keys(self, borrowed_key_ids: list[str], values: dict) -> list[dict]: ...
+
+    @abc.abstractmethod
+    async def delete_reservation(self, reservation_id: str) -> Optional[dict]: ...
+
+    @abc.abstractmethod
+    async def ping(self):
+        """Cheapest possible round-trip, raises if the database cannot be reached."""
+
+    def connect(self):
+        """Builds the client up front instead of on the first query. Blocking, see connect_backend."""
+
+
+class Storage(abc.ABC):
+    """File buckets for the borrow photos and signatures."""
+
+    @abc.abstractmethod
+    async def download(self, bucket: str, filename: str) -> bytes: ...
+
+    @abc.abstractmethod
+    async def upload(self, bucket: str, filename: str, data: bytes, content_type: str): ...
+
+    @abc.abstractmethod
+    async def ping(self, bucket: str):
+        """Raises if the bucket cannot be reached."""
+
+    def connect(self):
+        """Builds the client up front instead of on the first download or upload. Blocking, see connect_backend."""
+
+
+_repository: Optional[Repository] = None
+_storage: Optional[Storage] = None
+# the backends are created on first use, which can be connect_backend's thread and a request at the same time
+_lock = threading.Lock()
+
+
+def get_repository() -> Repository:
+    global _repository
+    if _repository is not None:
+        return _repository
+    with _lock:
+        if _repository is not None:
+            return _repository
+        if DB_BACKEND == "memory":
+            from kapi.db.memory_backend import MemoryRepository
+            repository = MemoryRepository()
+        elif DB_BACKEND == "supabase":
+            from kapi.db.supabase_backend import SupabaseRepository
+            repository = SupabaseRepository()
+        else:
+            raise ValueError(f"Unknown database backend {DB_BACKEND}")
+        # timed and counted per request for /metrics and the Server-Timing header
+        _repository = instrument_repository(repository)
+    return _repository
+
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is not None:
+        return _storage
+    with _lock:
+        if _storage is not None:
+            return _storage
+        if DB_BACKEND == "memory":
+            from kapi.db.memory_backend import MemoryStorage
+            storage = MemoryStorage()
+        elif DB_BACKEND == "supabase":
+            from kapi.db.supabase_backend import SupabaseStorage
+            storage = SupabaseStorage()
+        else:
+            raise ValueError(f"Unknown database backend {DB_BACKEND}")
+        _storage = instrument_storage(storage)
+    return _storage
+
+
+async def connect_backend():
+    """
+    Imports the backend and builds its clients in a worker thread, started from the lifespan without waiting for it,
+    so the app answers /health right away and the first real request does not pay for it.
+    """
+
+    def connect():
+        get_repository().connect()
+        get_storage().connect()
+
+    try:
+        await asyncio.to_thread(connect)
+    except Exception as e:
+        print(f"Could not connect to the {DB_BACKEND} backend, trying again on first use: {e}")
+
+
+def set_repository(repository: Optional[Repository]):
+    global _repository
+    _repository = instrument_repository(repository)
+
+
+def set_storage(storage: Optional[Storage]):
+    global _storage
+    _storage = instrument_storage(storage)
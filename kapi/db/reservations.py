@@ -1,14 +1,15 @@
 import dataclasses
 from typing import Optional, Self, Tuple
 
-from postgrest.types import CountMethod
+from kapi.db.availability import ReservedPeriod, check_reservation_conflicts, reservation_index, reservation_period
+from kapi.db.borrowers import Borrower, does_borrower_exist, add_borrower, known_borrowers
+from kapi.db.keys import Key, does_key_exist, add_key, known_keys
+from kapi.db.pagination import decode_cursor, check_count_method
+from kapi.db.repository import get_repository, ReservationConflict
+from kapi.events import publish_event
 
-from kapi.db.borrowers import Borrower, does_borrower_exist, add_borrower
-from kapi.db.db import supabase
-from kapi.db.keys import Key, does_key_exist, add_key
 
-
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class KeyReservationResponse:
     id: str
     key: Key
@@ -29,11 +30,11 @@ class KeyReservationResponse:
         borrower = None
 
         if key_reservation.get("borrowers") is not None:
-            borrower = Borrower(key_reservation["borrowers"]["name"], key_reservation["borrowers"]["type"], key_reservation["borrowers"]["company"], key_reservation["borrower_id"])
+            borrower = Borrower.from_row(key_reservation["borrowers"], id=key_reservation["borrower_id"])
 
         return cls(
             id=key_reservation["id"],
-            key=Key(key_reservation["keys"]["room_number"], key_reservation["keys"]["building_id"], key_reservation["keys"]["type"], key_reservation["key_id"]),
+            key=Key.from_row(key_reservation["keys"], id=key_reservation["key_id"]),
             created_at=key_reservation["created_at"],
             borrower=borrower,
             collection_at=key_reservation.get("collection_at"),
@@ -47,15 +48,22 @@ class KeyReservationResponse:
         )
 
 
-def add_reservation(key: Key, borrower: Borrower, description: str, collection_at: str, reservation_by: str, return_at: str = None):
-    if not does_key_exist(key.id):
-        add_key(key)
+async def add_reservation(key: Key, borrower: Borrower, description: str, collection_at: str, reservation_by: str, return_at: str = None):
+    """Raises ReservationConflict when the key is already reserved for part of the period, ValueError for a bad period."""
+    start, end = reservation_period(collection_at, return_at)
+    # the constraint in the database catches two workers racing
+    conflicts = await check_reservation_conflicts(key.id, start, end)
+    if conflicts:
+        raise ReservationConflict([period.id for period in conflicts])
+
+    if not await does_key_exist(key.id):
+        await add_key(key)
 
-    if borrower and not does_borrower_exist(borrower.id):
-        add_borrower(borrower)
+    if borrower and not await does_borrower_exist(borrower.id):
+        await add_borrower(borrower)
 
-    reservation = supabase.table("key_reservations").insert([
-        {
+    try:
+        reservation = await get_repository().insert_reservation({
             "key_id": key.id,
             "description": description,
             "borrower_id": borrower.id if borrower is not None else None,
@@ -63,54 +71,65 @@ def add_reservation(key: Key, borrower: Borrower, description: str, collection_a
             "collection_at": collection_at,
             "reservation_by": reservation_by,
             "return_at": return_at
-        }
-    ]).execute().data[0]
+        })
+    except ReservationConflict:
+        raise
+    except Exception:
+        # the cached ids may be stale (e.g. rows deleted behind our back), check again next time
+        known_keys.discard(key.id)
+        if borrower:
+            known_borrowers.discard(borrower.id)
+        raise
 
     print("Created reservation", reservation)
+    period = ReservedPeriod.from_row(reservation)
+    if period is not None:
+        reservation_index.add(period)
+    publish_event("reservation.created", reservation)
     return reservation
 
 
-def get_reservations(limit: int = 20, offset: int = 0, collected: bool = None, returned: bool = None, building_id = None) -> Tuple[list[KeyReservationResponse], int]:
-    query = supabase.table("key_reservations").select("*", "keys(*)", "borrowers(*)", count=CountMethod.exact)
-
-    if collected is not None:
-        query = query.eq("collected", collected)
-    if returned is not None:
-        query = query.eq("returned", returned)
-    if building_id is not None:
-        query = query.eq("building_id", building_id)
-
-    query = query.order("created_at", desc=True)
+async def get_reservations(limit: int = 20, offset: int = 0, collected: bool = None, returned: bool = None, building_id = None, cursor: str = None, count: str = "exact") -> Tuple[list[KeyReservationResponse], Optional[int]]:
+    check_count_method(count)
+    reservations, total = await get_repository().list_reservations(
+        limit=limit, offset=offset, collected=collected, returned=returned, building_id=building_id,
+        cursor=decode_cursor(cursor) if cursor else None, count=count
+    )
 
-    reservations = query.limit(limit).offset(offset).execute()
+    return [KeyReservationResponse.from_supabase(reservation) for reservation in reservations], total
 
-    return [KeyReservationResponse.from_supabase(reservation) for reservation in reservations.data], reservations.count
 
-
-def does_reservation_exist(reservation_id: str):
-    reservation = supabase.table("key_reservations").select("*").eq("id", reservation_id).execute()
-    if len(reservation.data) == 0:
+async def does_reservation_exist(reservation_id: str):
+    reservation = await get_repository().get_reservation(reservation_id)
+    if reservation is None:
         return False
     return True
 
 
-def get_open_reservation_for_key(key_id: str, borrower_id: str = None):
+async def get_open_reservation_for_key(key_id: str, borrower_id: str = None):
     # TODO also infer date for the reservation or that's a filter in the frontend?
-    reservation = supabase.table("key_reservations").select("*").eq("key_id", key_id).eq("collected", False).execute()
-    if len(reservation.data) == 0:
+    reservation = await get_repository().get_open_reservation_for_key(key_id)
+    if reservation is None:
         return None
-    return KeyReservationResponse.from_supabase(reservation.data[0])
+    return KeyReservationResponse.from_supabase(reservation)
 
 
-def delete_reservation(reservation_id: str):
-    if not does_reservation_exist(reservation_id):
+async def delete_reservation(reservation_id: str):
+    if not await does_reservation_exist(reservation_id):
         raise ValueError("Reservation does not exist")
-    deleted_row = supabase.table("key_reservations").delete().eq("id", reservation_id).execute()
-    return deleted_row.data[0]
+    reservation = await get_repository().delete_reservation(reservation_id)
+    reservation_index.remove(reservation_id)
+    if reservation and reservation.get("borrowed_key_id"):
+        # borrowed_keys imports this module
+        from kapi.db.borrowed_keys import overdue_borrows
+        overdue_borrows.release_reservation(reservation["borrowed_key_id"])
+    publish_event("reservation.deleted", {
+        "id": reservation_id,
+        "key_id": reservation.get("key_id") if reservation else None,
+        "building_id": reservation.get("building_id") if reservation else None,
+    })
+    return reservation
 
 
-def get_reservation_for_borrow_key(borrowed_key_id: str):
-    reservation = supabase.table("key_reservations").select("*").eq("borrowed_key_id", borrowed_key_id).execute()
-    if len(reservation.data) == 0:
-        return None
-    return reservation.data[0]
+async def get_reservation_for_borrow_key(borrowed_key_id: str):
+    return await get_repository().get_reservation_for_borrowed_key(borrowed_key_id)
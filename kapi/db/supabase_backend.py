@@ -0,0 +1,256 @@
+from typing import Optional, Tuple
+
+from postgrest.exceptions import APIError
+from postgrest.types import CountMethod
+from supabase import Client
+
+from kapi.db.db import get_supabase, execute, run_sync
+from kapi.db.repository import Repository, Storage, KeysAlreadyBorrowed, ReservationConflict
+
+
+COUNT_METHODS = {
+    "exact": CountMethod.exact,
+    "planned": CountMethod.planned,
+    "estimated": CountMethod.estimated,
+    "none": None,
+}
+
+ACTIVE_BORROWS_PAGE_SIZE = 1000
+
+# exclusion_violation, see supabase/migrations/*_reservation_overlap.sql
+EXCLUSION_VIOLATION = "23P01"
+
+
+def _after_cursor(query, sort_column: str, cursor: Tuple[str, str]):
+    # keyset pagination on (sort_column, id) descending, values quoted as timestamps contain reserved characters
+    sort_value, id = cursor
+    return query.or_(f'{sort_column}.lt."{sort_value}",and({sort_column}.eq."{sort_value}",id.lt."{id}")')
+
+
+def _first(response) -> Optional[dict]:
+    if len(response.data) == 0:
+        return None
+    return response.data[0]
+
+
+class SupabaseRepository(Repository):
+    def __init__(self, client: Client = None):
+        self._client = client
+
+    @property
+    def client(self) -> Client:
+        if self._client is None:
+            self._client = get_supabase()
+        return self._client
+
+    def connect(self):
+        self.client
+
+    def table(self, name: str):
+        return self.client.table(name)
+
+    # keys
+    async def get_key(self, key_id: str) -> Optional[dict]:
+        return _first(await execute(self.table("keys").select("*").eq("id", key_id)))
+
+    async def insert_key(self, row: dict) -> dict:
+        return (await execute(self.table("keys").insert([row]))).data[0]
+
+    async def list_keys(self, building_id: str) -> list[dict]:
+        return (await execute(self.table("keys").select("*").eq("building_id", building_id).order("room_number"))).data
+
+    # borrowers
+    async def get_borrower(self, borrower_id: str) -> Optional[dict]:
+        return _first(await execute(self.table("borrowers").select("*").eq("id", borrower_id)))
+
+    async def insert_borrower(self, row: dict) -> dict:
+        return (await execute(self.table("borrowers").insert([row]))).data[0]
+
+    # buildings
+    async def get_building_by_name(self, name: str) -> Optional[dict]:
+        return _first(await execute(self.table("buildings").select("*").eq("name", name)))
+
+    async def list_buildings(self, limit: int, offset: int, search: str = None) -> Tuple[list[dict], int]:
+        query = self.table("buildings").select("*", count=CountMethod.exact)
+        if search is not None:
+            query = query.ilike("name", f"%{search}%")
+        buildings = await execute(query.limit(limit).offset(offset))
+        return buildings.data, buildings.count
+
+    async def list_all_buildings(self) -> list[dict]:
+        return (await execute(self.table("buildings").select("*"))).data
+
+    async def insert_building(self, row: dict) -> dict:
+        return (await execute(self.table("buildings").insert([row]))).data[0]
+
+    # borrowed_keys
+    async def list_borrowed_keys(self, limit: int, offset: int, borrowed: bool = None, building_id: str = None, cursor: Tuple[str, str] = None, count: str = "exact") -> Tuple[list[dict], Optional[int]]:
+        query = self.table("borrowed_keys").select("*", "keys(*)", "borrowers(*)", count=COUNT_METHODS[count])
+        if borrowed is not None:
+            query = query.eq("borrowed", borrowed)
+        if building_id is not None:
+            query = query.eq("building_id", building_id)
+        # sort by borrowed_at desc default, id breaks ties so the cursor is unambiguous
+        query = query.order("borrowed_at", desc=True).order("id", desc=True)
+        if cursor is not None:
+            query = _after_cursor(query, "borrowed_at", cursor)
+        else:
+            query = query.offset(offset)
+        borrowed_keys = await execute(query.limit(limit))
+        return borrowed_keys.data, borrowed_keys.count
+
+    async def get_borrowed_key(self, borrow_id: str) -> Optional[dict]:
+        return _first(await execute(self.table("borrowed_keys").select("*", "keys(*)", "borrowers(*)").eq("id", borrow_id)))
+
+    async def find_active_borrows(self, key_id: str) -> list[dict]:
+        return (await execute(self.table("borrowed_keys").select("*").eq("key_id", key_id).eq("borrowed", True))).data
+
+    async def list_active_borrows(self) -> list[dict]:
+        # PostgREST caps the rows per response, so page through on the primary key
+        borrowed_keys = []
+        while True:
+            query = self.table("borrowed_keys").select("*", "keys(*)", "borrowers(*)").eq("borrowed", True).order("id")
+            if borrowed_keys:
+                query = query.gt("id", borrowed_keys[-1]["id"])
+            page = (await execute(query.limit(ACTIVE_BORROWS_PAGE_SIZE))).data
+            borrowed_keys += page
+            if len(page) < ACTIVE_BORROWS_PAGE_SIZE:
+                return borrowed_keys
+
+    async def insert_borrowed_key(self, row: dict) -> dict:
+        return (await execute(self.table("borrowed_keys").insert([row]))).data[0]
+
+    async def update_borrowed_key(self, borrow_id: str, values: dict) -> Optional[dict]:
+        return _first(await execute(self.table("borrowed_keys").update(values).eq("id", borrow_id)))
+
+    async def borrow_key(self, key: dict, borrower: dict, borrowed_key: dict, reservation_id: str = None) -> dict:
+        # see supabase/migrations/*_borrow_key.sql
+        try:
+            response = await execute(self.client.rpc("borrow_key", {
+                "p_key": key,
+                "p_borrower": borrower,
+                "p_borrowed_key": borrowed_key,
+                "p_reservation_id": reservation_id,
+            }))
+        except APIError as e:
+            if e.message == "Key already borrowed":
+                raise ValueError("Key already borrowed")
+            raise
+        # a function returning a single row comes back as an object, not a list
+        if isinstance(response.data, list):
+            return response.data[0]
+        return response.data
+
+    async def borrow_keys(self, keys: list[dict], borrower: dict, borrowed_keys: list[dict]) -> list[dict]:
+        # see supabase/migrations/*_borrow_keys.sql
+        try:
+            response = await execute(self.client.rpc("borrow_keys", {
+                "p_keys": keys,
+                "p_borrower": borrower,
+                "p_borrowed_keys": borrowed_keys,
+            }))
+        except APIError as e:
+            if e.message == "Keys already borrowed":
+                raise KeysAlreadyBorrowed(e.details.split(",") if e.details else [])
+            raise
+        return response.data
+
+    async def return_borrowed_keys(self, borrow_ids: list[str], returned_at: str) -> list[dict]:
+        return (await execute(
+            self.table("borrowed_keys")
+            .update({"borrowed": False, "returned_at": returned_at})
+            .in_("id", borrow_ids)
+            .eq("borrowed", True)
+        )).data
+
+    # key_reservations
+    async def list_reservations(self, limit: int, offset: int, collected: bool = None, returned: bool = None, building_id: str = None, cursor: Tuple[str, str] = None, count: str = "exact") -> Tuple[list[dict], Optional[int]]:
+        query = self.table("key_reservations").select("*", "keys(*)", "borrowers(*)", count=COUNT_METHODS[count])
+        if collected is not None:
+            query = query.eq("collected", collected)
+        if returned is not None:
+            query = query.eq("returned", returned)
+        if building_id is not None:
+            query = query.eq("building_id", building_id)
+        query = query.order("created_at", desc=True).order("id", desc=True)
+        if cursor is not None:
+            query = _after_cursor(query, "created_at", cursor)
+        else:
+            query = query.offset(offset)
+        reservations = await execute(query.limit(limit))
+        return reservations.data, reservations.count
+
+    async def get_reservation(self, reservation_id: str) -> Optional[dict]:
+        return _first(await execute(self.table("key_reservations").select("*").eq("id", reservation_id)))
+
+    async def get_open_reservation_for_key(self, key_id: str) -> Optional[dict]:
+        return _first(await execute(self.table("key_reservations").select("*", "keys(*)", "borrowers(*)").eq("key_id", key_id).eq("collected", False)))
+
+    async def get_reservation_for_borrowed_key(self, borrowed_key_id: str) -> Optional[dict]:
+        return _first(await execute(self.table("key_reservations").select("*").eq("borrowed_key_id", borrowed_key_id)))
+
+    async def list_open_reservations(self, key_id: str = None, building_id: str = None) -> list[dict]:
+        # paged on the primary key like list_active_borrows
+        reservations = []
+        while True:
+            query = self.table("key_reservations").select("id", "key_id", "building_id", "collection_at", "return_at", "returned", "borrowed_key_id").eq("returned", False)
+            if key_id is not None:
+                query = query.eq("key_id", key_id)
+            if building_id is not None:
+                query = query.eq("building_id", building_id)
+            query = query.order("id")
+            if reservations:
+                query = query.gt("id", reservations[-1]["id"])
+            page = (await execute(query.limit(ACTIVE_BORROWS_PAGE_SIZE))).data
+            reservations += page
+            if len(page) < ACTIVE_BORROWS_PAGE_SIZE:
+                return reservations
+
+    async def insert_reservation(self, row: dict) -> dict:
+        try:
+            return (await execute(self.table("key_reservations").insert([row]))).data[0]
+        except APIError as e:
+            if e.code == EXCLUSION_VIOLATION:
+                # the ids are not in the error, the index knows them in the common case
+                raise ReservationConflict([])
+            raise
+
+    async def update_reservation(self, reservation_id: str, values: dict) -> Optional[dict]:
+        return _first(await execute(self.table("key_reservations").update(values).eq("id", reservation_id)))
+
+    async def update_reservations_for_borrowed_keys(self, borrowed_key_ids: list[str], values: dict) -> list[dict]:
+        return (await execute(self.table("key_reservations").update(values).in_("borrowed_key_id", borrowed_key_ids))).data
+
+    async def delete_reservation(self, reservation_id: str) -> Optional[dict]:
+        return _first(await execute(self.table("key_reservations").delete().eq("id", reservation_id)))
+
+
+    async def ping(self):
+        await execute(self.table("buildings").select("id").limit(1))
+
+
+class SupabaseStorage(Storage):
+    def __init__(self, client: Client = None):
+        self._client = client
+
+    @property
+    def client(self) -> Client:
+        if self._client is None:
+            self._client = get_supabase()
+        return self._client
+
+    def connect(self):
+        self.client
+
+    async def download(self, bucket: str, filename: str) -> bytes:
+        return await run_sync(self.client.storage.from_(bucket).download, filename)
+
+    async def upload(self, bucket: str, filename: str, data: bytes, content_type: str):
+        # upsert so a retried upload of a file that did make it the first time is not an error
+        return await run_sync(self.client.storage.from_(bucket).upload, file=data, path=filename, file_options={
+            "content-type": content_type,
+            "upsert": "true"
+        })
+
+    async def ping(self, bucket: str):
+        await run_sync(self.client.storage.get_bucket, bucket)
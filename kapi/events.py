@@ -0,0 +1,115 @@
+import asyncio
+import dataclasses
+import os
+from collections import deque
+from typing import AsyncIterator, Optional
+
+from kapi.serialization import dumps
+
+EVENT_HISTORY_SIZE = int(os.getenv("KAPI_EVENT_HISTORY_SIZE", "1000"))
+EVENT_QUEUE_SIZE = int(os.getenv("KAPI_EVENT_QUEUE_SIZE", "100"))
+EVENT_KEEPALIVE_SECONDS = float(os.getenv("KAPI_EVENT_KEEPALIVE_SECONDS", "15"))
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Event:
+    id: int
+    type: str
+    data: dict
+
+    def to_sse(self) -> str:
+        return f"id: {self.id}\nevent: {self.type}\ndata: {dumps(self.data).decode()}\n\n"
+
+
+class Subscriber:
+    def __init__(self, backlog: list[Event], maxsize: int):
+        # events from before the subscription (Last-Event-ID resume), then live ones
+        self.backlog = backlog
+        self.queue: asyncio.Queue[Event] = asyncio.Queue(maxsize=maxsize)
+        # set when the client fell too far behind, it gets what is queued and then has to reconnect
+        self.overflowed = False
+
+
+class EventBroker:
+    """
+    Fans out change events from the write paths to any number of /events streams.
+
+    Every subscriber has its own bounded queue, a client that cannot keep up is disconnected instead of holding up
+    the others or growing without bound. The last history_size events are kept, so a client that reconnects with
+    Last-Event-ID continues where it left off. Event ids are per process.
+    """
+
+    def __init__(self, history_size: int = EVENT_HISTORY_SIZE, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.history: deque[Event] = deque(maxlen=history_size)
+        self.subscribers: set[Subscriber] = set()
+        self.last_id = 0
+        self.published = 0
+        self.overflows = 0
+
+    def publish(self, type: str, data: dict) -> Event:
+        self.last_id += 1
+        event = Event(self.last_id, type, data)
+        self.history.append(event)
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+                self.subscribers.discard(subscriber)
+                self.overflows += 1
+        return event
+
+    def subscribe(self, last_event_id: Optional[int] = None) -> Subscriber:
+        backlog = []
+        if last_event_id is not None:
+            oldest = self.history[0].id if self.history else self.last_id + 1
+            if last_event_id > self.last_id or last_event_id < oldest - 1:
+                # unknown (other process, restart) or too old, the client has to refetch everything
+                backlog = [Event(self.last_id, "reset", {})]
+            else:
+                backlog = [event for event in self.history if event.id > last_event_id]
+        subscriber = Subscriber(backlog, self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def stream(self, subscriber: Subscriber, building_id: str = None, keepalive: float = EVENT_KEEPALIVE_SECONDS) -> AsyncIterator[str]:
+        """Server-sent events for the subscriber, with a comment line every keepalive seconds to keep proxies happy."""
+
+        def wanted(event: Event) -> bool:
+            return building_id is None or event.type == "reset" or event.data.get("building_id") == building_id
+
+        try:
+            for event in subscriber.backlog:
+                if wanted(event):
+                    yield event.to_sse()
+            subscriber.backlog = []
+            while not (subscriber.overflowed and subscriber.queue.empty()):
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if wanted(event):
+                    yield event.to_sse()
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "last_id": self.last_id,
+            "published": self.published,
+            "overflows": self.overflows,
+        }
+
+
+event_broker = EventBroker()
+
+
+def publish_event(type: str, data: dict) -> Event:
+    return event_broker.publish(type, data)
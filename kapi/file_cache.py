@@ -0,0 +1,105 @@
+import asyncio
+import os
+from collections import OrderedDict
+
+from kapi.images import VARIANT_WIDTHS, get_variant_path
+from kapi.uploads import upload_queue
+from kapi.util import UPLOAD_DIR, get_local_file_path, get_file_from_bucket
+
+FILE_CACHE_MAX_BYTES = int(os.getenv("KAPI_FILE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+
+class FileCache:
+    """
+    Treats UPLOAD_DIR as a cache in front of the bucket, bounded to max_bytes with LRU eviction.
+
+    Files that are still waiting to be uploaded are never evicted, the local copy is the only one. Concurrent misses
+    for the same file share a single download.
+    """
+
+    def __init__(self, max_bytes: int = FILE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._downloads: dict[str, asyncio.Task] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def scan(self):
+        """Indexes what is already on disk, least recently used first."""
+        self._files.clear()
+        self.size = 0
+        entries = [entry for entry in os.scandir(UPLOAD_DIR) if entry.is_file() and not entry.name.endswith(".part")]
+        entries.sort(key=lambda entry: entry.stat().st_atime)
+        for entry in entries:
+            self._track(entry.name, entry.stat().st_size)
+        self.evict()
+
+    def _track(self, filename: str, size: int):
+        self.size += size - self._files.get(filename, 0)
+        self._files[filename] = size
+        self._files.move_to_end(filename)
+
+    def add(self, filename: str):
+        """Accounts for a file that was written to UPLOAD_DIR outside of the cache, e.g. a new upload."""
+        self._track(filename, os.path.getsize(get_local_file_path(filename)))
+        self.evict()
+
+    async def get(self, filename: str) -> str:
+        """Returns the local path of the file, downloading it from the bucket on a miss."""
+        file_path = get_local_file_path(filename)
+        # not exists, UPLOAD_DIR holds the variants directory as well
+        if os.path.isfile(file_path):
+            self.hits += 1
+            if filename in self._files:
+                self._files.move_to_end(filename)
+            else:
+                self._track(filename, os.path.getsize(file_path))
+            return file_path
+
+        self.misses += 1
+        download = self._downloads.get(filename)
+        if download is None:
+            download = asyncio.create_task(self._download(filename))
+            self._downloads[filename] = download
+            download.add_done_callback(lambda _: self._downloads.pop(filename, None))
+        else:
+            self.coalesced += 1
+        # shielded so one cancelled request does not cancel the download for everyone waiting on it
+        await asyncio.shield(download)
+        return file_path
+
+    async def _download(self, filename: str):
+        await get_file_from_bucket(filename)
+        self.add(filename)
+
+    def evict(self):
+        for filename in list(self._files):
+            if self.size <= self.max_bytes:
+                break
+            if upload_queue.is_pending(filename) or filename in self._downloads:
+                continue
+            self._remove(filename)
+            self.evictions += 1
+
+    def _remove(self, filename: str):
+        self.size -= self._files.pop(filename)
+        for path in [get_local_file_path(filename)] + [get_variant_path(filename, size) for size in VARIANT_WIDTHS]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+file_cache = FileCache()
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from kapi.db.repository import get_repository, get_storage
+from kapi.util import BUCKET_NAME
+
+READY_INTERVAL = float(os.getenv("KAPI_READY_INTERVAL", "15"))
+READY_TIMEOUT = float(os.getenv("KAPI_READY_TIMEOUT", "5"))
+
+
+async def ping_database():
+    await get_repository().ping()
+
+
+async def ping_bucket():
+    await get_storage().ping(BUCKET_NAME)
+
+
+class ReadinessProbe:
+    """
+    Checks the database and the bucket every interval seconds in the background.
+
+    /ready only reads the last results, so a probe never waits on a dependency and a flood of probes never turns
+    into a flood of queries.
+    """
+
+    def __init__(self, checks: dict[str, Callable[[], Awaitable]] = None, interval: float = READY_INTERVAL, timeout: float = READY_TIMEOUT):
+        self.checks = checks if checks is not None else {"database": ping_database, "bucket": ping_bucket}
+        self.interval = interval
+        self.timeout = timeout
+        self.results: dict[str, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        results = await asyncio.gather(*[self._check(check) for check in self.checks.values()])
+        self.results = dict(zip(self.checks, results))
+
+    async def _check(self, check: Callable[[], Awaitable]) -> dict:
+        started = time.monotonic()
+        error = None
+        try:
+            await asyncio.wait_for(check(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            error = f"timed out after {self.timeout}s"
+        except Exception as e:
+            error = str(e)
+        return {
+            "ok": error is None,
+            "latency_ms": round((time.monotonic() - started) * 1000, 1),
+            "error": error,
+            "checked_at": time.time(),
+        }
+
+    def is_ready(self) -> bool:
+        return len(self.results) == len(self.checks) and all(result["ok"] for result in self.results.values())
+
+
+readiness_probe = ReadinessProbe()
@@ -0,0 +1,49 @@
+import os
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+# uploads are stored under a fresh uuid4 filename and never rewritten, so a filename always maps to the same bytes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def immutable_etag(filename: str) -> str:
+    # strong, and the same on every worker and after the file is evicted and downloaded again,
+    # unlike the mtime based default of FileResponse
+    return f'"{filename}"'
+
+
+def is_not_modified(request_headers: Headers, etag: str) -> bool:
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={"etag": etag, "cache-control": IMMUTABLE_CACHE_CONTROL})
+
+
+def immutable_file_response(path: str) -> FileResponse:
+    # FileResponse takes care of Range and If-Range requests
+    return FileResponse(path=path, headers={
+        "etag": immutable_etag(os.path.basename(path)),
+        "cache-control": IMMUTABLE_CACHE_CONTROL,
+    })
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles for the upload directory, with strong filename ETags and long lived caching."""
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        etag = immutable_etag(os.path.basename(full_path))
+        if is_not_modified(Headers(scope=scope), etag):
+            return not_modified_response(etag)
+        return FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers={
+            "etag": etag,
+            "cache-control": IMMUTABLE_CACHE_CONTROL,
+        })
@@ -0,0 +1,77 @@
+import asyncio
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from kapi.util import UPLOAD_DIR, get_local_file_path
+
+# Pillow is optional, without it /files always serves the original. Only the image workers import it, not startup.
+PILLOW_INSTALLED = importlib.util.find_spec("PIL") is not None
+
+VARIANT_DIR = os.path.join(UPLOAD_DIR, "variants")
+
+# name -> max width in pixels, "large" doubles as the compressed main image
+VARIANT_WIDTHS = {
+    "thumb": 160,
+    "medium": 640,
+    "large": 1600,
+}
+VARIANT_FORMAT = "WEBP"
+VARIANT_EXTENSION = ".webp"
+VARIANT_QUALITY = int(os.getenv("KAPI_VARIANT_QUALITY", "80"))
+
+# resizing is CPU bound, keep it on its own small pool so it never competes with the database threads
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("KAPI_IMAGE_WORKERS", "2")), thread_name_prefix="kapi-images")
+_in_flight: dict[str, asyncio.Future] = {}
+
+
+def images_enabled() -> bool:
+    return PILLOW_INSTALLED
+
+
+def get_variant_filename(filename: str, size: str) -> str:
+    return f"{os.path.splitext(filename)[0]}.{size}{VARIANT_EXTENSION}"
+
+
+def get_variant_path(filename: str, size: str) -> str:
+    return os.path.join(VARIANT_DIR, get_variant_filename(filename, size))
+
+
+def generate_variants(filename: str):
+    from PIL import Image, ImageOps
+
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+    with Image.open(get_local_file_path(filename)) as original:
+        # phone cameras store the orientation in EXIF rather than rotating the pixels
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for size, width in VARIANT_WIDTHS.items():
+            variant = image.copy()
+            variant.thumbnail((width, width * 10))
+            variant_path = get_variant_path(filename, size)
+            # write next to the final path and rename, a reader never sees a half written variant
+            variant.save(variant_path + ".part", VARIANT_FORMAT, quality=VARIANT_QUALITY)
+            os.replace(variant_path + ".part", variant_path)
+
+
+def schedule_variants(filename: str):
+    """Generates the variants for a stored image in the background, does nothing if they are already on their way."""
+    if not images_enabled() or filename in _in_flight:
+        return
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_executor, generate_variants, filename)
+    _in_flight[filename] = future
+
+    def done(f: asyncio.Future):
+        _in_flight.pop(filename, None)
+        if not f.cancelled() and f.exception() is not None:
+            print(f"Failed to generate variants for {filename}: {f.exception()}")
+
+    future.add_done_callback(done)
+
+
+async def wait_for_variants(filename: str):
+    future = _in_flight.get(filename)
+    if future is not None:
+        await asyncio.gather(future, return_exceptions=True)
@@ -0,0 +1,223 @@
+import bisect
+import contextvars
+import inspect
+import time
+from typing import Optional
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# seconds, from a cache hit to a slow storage upload
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# database calls per request, anything that grows with the page size shows up in the top buckets
+CALL_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, labels)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Prometheus histogram, per label combination a count for every bucket plus the sum.
+
+    Only touched from the event loop, so there is no lock.
+    """
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # per labels: the non-cumulative count of every bucket (+Inf last) and the sum
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels):
+        values = self._values.get(labels)
+        if values is None:
+            values = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = values
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def count(self, *labels) -> int:
+        values = self._values.get(labels)
+        return sum(values[0]) if values is not None else 0
+
+    def sum(self, *labels) -> float:
+        values = self._values.get(labels)
+        return values[1][0] if values is not None else 0.0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bucket)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "kapi_request_duration_seconds", "Time until the response is complete, by route.", ("method", "route", "status")))
+request_db_calls = registry.register(Histogram(
+    "kapi_request_db_calls", "Database round-trips made by a single request.", ("method", "route"), CALL_BUCKETS))
+db_call_duration = registry.register(Histogram(
+    "kapi_db_call_duration_seconds", "Database (PostgREST) calls by repository method.", ("method", "outcome")))
+storage_call_duration = registry.register(Histogram(
+    "kapi_storage_call_duration_seconds", "Bucket uploads and downloads.", ("method", "outcome")))
+notification_duration = registry.register(Histogram(
+    "kapi_notification_duration_seconds", "Push notification sends.", ("outcome",)))
+
+
+class RequestTimings:
+    """What one request spent outside of the app itself, the Server-Timing header."""
+
+    def __init__(self):
+        # per kind ("db", "storage"): number of calls and seconds spent in them
+        self.calls: dict[str, list] = {}
+
+    def add(self, kind: str, seconds: float):
+        entry = self.calls.get(kind)
+        if entry is None:
+            self.calls[kind] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, kind: str) -> int:
+        entry = self.calls.get(kind)
+        return entry[0] if entry is not None else 0
+
+    def server_timing(self, total: float) -> str:
+        # calls that ran concurrently all count in full, so db can add up to more than total
+        metrics = [f'{kind};desc="{count} calls";dur={seconds * 1000:.3f}' for kind, (count, seconds) in self.calls.items()]
+        metrics.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(metrics)
+
+
+# set for the duration of a request, tasks started by the request share the same RequestTimings
+current_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("current_timings", default=None)
+
+
+def _instrument(method, name: str, kind: str, histogram: Histogram):
+    async def instrumented(*args, **kwargs):
+        outcome = "error"
+        started = time.perf_counter()
+        try:
+            result = await method(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            seconds = time.perf_counter() - started
+            histogram.observe(seconds, name, outcome)
+            timings = current_timings.get()
+            if timings is not None:
+                timings.add(kind, seconds)
+
+    return instrumented
+
+
+class Instrumented:
+    """
+    Wraps a Repository or Storage, every coroutine method is timed into histogram and counted against the current
+    request. Everything else is passed through as is.
+    """
+
+    def __init__(self, wrapped, kind: str, histogram: Histogram):
+        self.wrapped = wrapped
+        self.kind = kind
+        self.histogram = histogram
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.wrapped, name)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
+        # looked up on every call, so patching the wrapped object (tests) still works
+        return _instrument(attribute, name, self.kind, self.histogram)
+
+
+def instrument_repository(repository):
+    if repository is None or isinstance(repository, Instrumented):
+        return repository
+    return Instrumented(repository, "db", db_call_duration)
+
+
+def instrument_storage(storage):
+    if storage is None or isinstance(storage, Instrumented):
+        return storage
+    return Instrumented(storage, "storage", storage_call_duration)
+
+
+def get_route(scope: Scope) -> str:
+    # the path template, not the path, so ids do not end up as labels
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Times every http request by route and adds a Server-Timing header with the database and storage calls it made,
+    e.g. "db;desc="3 calls";dur=12.5, total;dur=14.1". Plain ASGI like AuthMiddleware.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.server_timing(time.perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timings.reset(token)
+            route = get_route(scope)
+            request_duration.observe(time.perf_counter() - started, scope["method"], route, str(status))
+            request_db_calls.observe(timings.count("db"), scope["method"], route)
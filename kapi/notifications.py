@@ -1,37 +1,199 @@
+import asyncio
 import os
+import time
 from typing import Optional
 
-import requests
-import time
+import httpx
+
+from kapi.metrics import notification_duration
 
 PUSH_API_KEY = os.getenv("PUSH_API_KEY")
 PUSH_USER_KEY = os.getenv("PUSH_USER_KEY")
+PUSH_API_URL = os.getenv("PUSH_API_URL", "https://api.pushover.net/1/messages.json")
+
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("KAPI_NOTIFICATION_QUEUE_SIZE", "100"))
+NOTIFICATION_TIMEOUT = float(os.getenv("KAPI_NOTIFICATION_TIMEOUT", "10"))
+# messages of the same group within this window are sent as a single summary
+NOTIFICATION_COALESCE_SECONDS = float(os.getenv("KAPI_NOTIFICATION_COALESCE_SECONDS", "60"))
+HEARTBEAT_INTERVAL = float(os.getenv("KAPI_HEARTBEAT_HOURS", "6")) * 3600
+# pushover messages are limited to 1024 characters
+MAX_MESSAGE_LENGTH = 1024
+SUMMARY_MESSAGES = 5
+
+
+def describe_window(seconds: float) -> str:
+    if seconds == 60:
+        return "minute"
+    if seconds % 60 == 0:
+        return f"{int(seconds // 60)} minutes"
+    return f"{seconds:g} seconds"
+
+
+class NotificationDispatcher:
+    """
+    Sends push notifications in the background, so a slow push API never holds up a request.
+
+    The queue is bounded, when it is full new messages are dropped. Messages sent with a group are throttled: the
+    first one goes out right away, the ones following it within coalesce_seconds are sent together as one summary,
+    e.g. "5 keys borrowed in the last minute".
+    """
+
+    def __init__(self, url: str = PUSH_API_URL, maxsize: int = NOTIFICATION_QUEUE_SIZE,
+                 timeout: float = NOTIFICATION_TIMEOUT, coalesce_seconds: float = NOTIFICATION_COALESCE_SECONDS):
+        self.url = url
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.coalesce_seconds = coalesce_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._client: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        # per group: when the last message went out, the messages waiting for the summary and its timer
+        self._last_sent: dict[str, float] = {}
+        self._pending: dict[str, list[str]] = {}
+        self._flushes: dict[str, asyncio.TimerHandle] = {}
+        self._flushing: set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def send(self, message: str, group: str = None):
+        if self._queue is None:
+            print(f"Notifications are not running, dropping: {message}")
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait((message, group))
+        except asyncio.QueueFull:
+            print(f"Notification queue full, dropping: {message}")
+            self.dropped += 1
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        # building the client loads the CA bundle, which takes long enough to hold up startup, so it happens in a
+        # thread and the first send waits for it
+        self._client = asyncio.create_task(asyncio.to_thread(httpx.AsyncClient, timeout=self.timeout))
+        self._task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # whatever is still waiting gets one last try
+        for handle in self._flushes.values():
+            handle.cancel()
+        self._flushes.clear()
+        await asyncio.gather(*self._flushing, return_exceptions=True)
+        for group in list(self._pending):
+            await self._flush(group)
+        queue, self._queue = self._queue, None
+        while queue is not None and not queue.empty():
+            message, _ = queue.get_nowait()
+            await self._post(message)
+        if self._client is not None:
+            client, self._client = self._client, None
+            await (await client).aclose()
+
+    async def join(self):
+        await self._queue.join()
+        while self._flushes or self._flushing:
+            await asyncio.sleep(0.01)
 
+    async def _worker(self):
+        while True:
+            message, group = await self._queue.get()
+            try:
+                await self._dispatch(message, group)
+            finally:
+                self._queue.task_done()
 
-last_send: Optional[float] = None
+    async def _dispatch(self, message: str, group: Optional[str]):
+        if group is None:
+            await self._post(message)
+            return
 
+        if group in self._pending:
+            self._pending[group].append(message)
+            self.coalesced += 1
+            return
 
-def send_push_notification(message: str):
-    try:
+        since_last = time.monotonic() - self._last_sent.get(group, float("-inf"))
+        if since_last >= self.coalesce_seconds:
+            self._last_sent[group] = time.monotonic()
+            await self._post(message)
+            return
+
+        self._pending[group] = [message]
+        self.coalesced += 1
+        loop = asyncio.get_running_loop()
+
+        def flush():
+            task = asyncio.create_task(self._flush(group))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+
+        self._flushes[group] = loop.call_later(self.coalesce_seconds - since_last, flush)
+
+    def summarize(self, group: str, messages: list[str]) -> str:
+        if len(messages) == 1:
+            return messages[0]
+        lines = [f"{len(messages)} {group} in the last {describe_window(self.coalesce_seconds)}"] + messages[-SUMMARY_MESSAGES:]
+        if len(messages) > SUMMARY_MESSAGES:
+            lines.insert(1, "...")
+        return "\n".join(lines)[:MAX_MESSAGE_LENGTH]
+
+    async def _flush(self, group: str):
+        self._flushes.pop(group, None)
+        messages = self._pending.pop(group, None)
+        if not messages:
+            return
+        self._last_sent[group] = time.monotonic()
+        await self._post(self.summarize(group, messages))
+
+    async def _post(self, message: str):
         print(f"Sending push notification: {message}")
-        url = "https://api.pushover.net/1/messages.json"
-        requests.post(url, data={
-            'token': PUSH_API_KEY,
-            'user': PUSH_USER_KEY,
-            'message': message,
-        }, headers={
-            'Content-Type': 'application/x-www-form-urlencoded'
-        })
-        global last_send
-        last_send = time.time()
-    except Exception as e:
-        print(f"Failed to send push notification: {e}")
-
-def send_notification_if_needed():
-    if last_send is None:
-        send_push_notification('Service started')
-
-    if time.time() - last_send > 6 * 3600:
-        send_push_notification('Still going strong!')
+        started = time.perf_counter()
+        try:
+            if self._client is None:
+                raise RuntimeError("dispatcher is not running")
+            # shielded, a cancelled send must not cancel building the client for everyone else
+            client = await asyncio.shield(self._client)
+            response = await client.post(self.url, data={
+                'token': PUSH_API_KEY,
+                'user': PUSH_USER_KEY,
+                'message': message,
+            })
+            response.raise_for_status()
+            self.sent += 1
+            notification_duration.observe(time.perf_counter() - started, "sent")
+        except Exception as e:
+            print(f"Failed to send push notification: {e}")
+            self.failed += 1
+            notification_duration.observe(time.perf_counter() - started, "failed")
 
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "pending_summaries": sum(len(messages) for messages in self._pending.values()),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
 
+
+notification_dispatcher = NotificationDispatcher()
+
+
+def send_push_notification(message: str, group: str = None):
+    """Queues the message and returns right away, see NotificationDispatcher."""
+    notification_dispatcher.send(message, group=group)
+
+
+async def heartbeat(interval: float = HEARTBEAT_INTERVAL):
+    """Runs for the lifetime of the app, so we notice when it is gone."""
+    send_push_notification('Service started')
+    while True:
+        await asyncio.sleep(interval)
+        send_push_notification('Still going strong!')
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
+from kapi.db.borrowed_keys import get_due_borrowed_keys
+from kapi.db.overdue import DueBorrow
+from kapi.notifications import MAX_MESSAGE_LENGTH, send_push_notification
+
+# 0 turns the digest off
+OVERDUE_DIGEST_INTERVAL = float(os.getenv("KAPI_OVERDUE_DIGEST_MINUTES", "60")) * 60
+DIGEST_LINES = 10
+
+
+def describe(entry: DueBorrow) -> str:
+    key = entry.borrowed_key.key
+    hours = (time.time() - entry.due_at) / 3600
+    return f"{key.room_number} ({key.type}) in {entry.borrowed_key.building_id}, {entry.borrowed_key.borrower.name}, {hours:.0f}h late"
+
+
+class OverdueDigest:
+    """
+    Every interval seconds, sends a single push notification listing the borrowed keys that became overdue since the
+    last one, instead of a message per key. Nothing is sent when nothing new is overdue.
+
+    Every worker runs its own, like the heartbeat.
+    """
+
+    def __init__(self, interval: float = OVERDUE_DIGEST_INTERVAL):
+        self.interval = interval
+        # overdue at the last check, a key that is returned and overdue again later is reported again
+        self._reported: set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.digests = 0
+        self.reported = 0
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"Checking for overdue keys failed: {e}")
+
+    async def check(self):
+        overdue = await get_due_borrowed_keys()
+        new = [entry for entry in overdue if entry.id not in self._reported]
+        self._reported = {entry.id for entry in overdue}
+        if not new:
+            return
+        send_push_notification(self.summarize(new, len(overdue)))
+        self.digests += 1
+        self.reported += len(new)
+
+    @staticmethod
+    def summarize(new: list[DueBorrow], total: int) -> str:
+        lines = [f"{len(new)} {'keys' if len(new) > 1 else 'key'} overdue ({total} in total)"]
+        lines += [describe(entry) for entry in new[:DIGEST_LINES]]
+        if len(new) > DIGEST_LINES:
+            lines.append("...")
+        return "\n".join(lines)[:MAX_MESSAGE_LENGTH]
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "overdue": len(self._reported),
+            "digests": self.digests,
+            "reported": self.reported,
+        }
+
+
+overdue_digest = OverdueDigest()
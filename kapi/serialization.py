@@ -0,0 +1,31 @@
+import dataclasses
+import json
+from typing import Any
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+try:
+    import orjson
+except ImportError:  # falls back to the stdlib encoder, still without the asdict deep copy
+    orjson = None
+
+
+def _default(obj: Any):
+    # one level at a time, the encoder recurses into the nested models itself
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return {field.name: getattr(obj, field.name) for field in dataclasses.fields(obj)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """Encodes content, dataclass models included, straight to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class JSONResponse(StarletteJSONResponse):
+    """JSONResponse that takes the dataclass models as they are, no need for dataclasses.asdict first."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
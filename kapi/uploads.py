@@ -0,0 +1,118 @@
+import asyncio
+import os
+from typing import Optional
+
+from kapi.util import UPLOAD_DIR, upload_file_to_bucket
+
+# an empty marker file per local upload that has not reached the bucket yet, so a restart can pick them up again
+PENDING_DIR = os.path.join(UPLOAD_DIR, ".pending")
+
+UPLOAD_WORKERS = int(os.getenv("KAPI_UPLOAD_WORKERS", "4"))
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("KAPI_UPLOAD_MAX_ATTEMPTS", "6"))
+UPLOAD_RETRY_DELAY = float(os.getenv("KAPI_UPLOAD_RETRY_DELAY", "1"))
+UPLOAD_MAX_RETRY_DELAY = 60
+
+
+class UploadQueue:
+    """
+    Uploads files from UPLOAD_DIR to the bucket in the background.
+
+    Failed uploads are retried with exponential backoff. A file that still fails after UPLOAD_MAX_ATTEMPTS keeps its
+    pending marker and is retried on the next start.
+    """
+
+    def __init__(self, workers: int = UPLOAD_WORKERS, max_attempts: int = UPLOAD_MAX_ATTEMPTS, retry_delay: float = UPLOAD_RETRY_DELAY):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._retries: set[asyncio.TimerHandle] = set()
+        self.uploaded = 0
+        self.retried = 0
+        self.failed = 0
+
+    @staticmethod
+    def _marker_path(filename: str) -> str:
+        return os.path.join(PENDING_DIR, filename)
+
+    def is_pending(self, filename: str) -> bool:
+        return os.path.exists(self._marker_path(filename))
+
+    def pending_files(self) -> list[str]:
+        if not os.path.isdir(PENDING_DIR):
+            return []
+        return os.listdir(PENDING_DIR)
+
+    def enqueue(self, filename: str):
+        os.makedirs(PENDING_DIR, exist_ok=True)
+        open(self._marker_path(filename), "w").close()
+        # when not running yet the file gets picked up by the scan in start()
+        if self._queue is not None:
+            self._queue.put_nowait((filename, 1))
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        for filename in self.pending_files():
+            self._queue.put_nowait((filename, 1))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for handle in self._retries:
+            handle.cancel()
+        self._retries.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def join(self):
+        await self._queue.join()
+        while self._retries:
+            await asyncio.sleep(self.retry_delay)
+            await self._queue.join()
+
+    def _retry_later(self, filename: str, attempt: int):
+        delay = min(self.retry_delay * 2 ** (attempt - 1), UPLOAD_MAX_RETRY_DELAY)
+        loop = asyncio.get_running_loop()
+
+        def requeue():
+            self._retries.discard(handle)
+            self._queue.put_nowait((filename, attempt + 1))
+
+        handle = loop.call_later(delay, requeue)
+        self._retries.add(handle)
+
+    async def _worker(self):
+        while True:
+            filename, attempt = await self._queue.get()
+            try:
+                if not os.path.exists(os.path.join(UPLOAD_DIR, filename)):
+                    print(f"Dropping upload of {filename}, file no longer exists")
+                    os.remove(self._marker_path(filename))
+                    continue
+                await upload_file_to_bucket(filename)
+                os.remove(self._marker_path(filename))
+                self.uploaded += 1
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    print(f"Upload of {filename} failed (attempt {attempt}), retrying: {e}")
+                    self.retried += 1
+                    self._retry_later(filename, attempt)
+                else:
+                    print(f"Upload of {filename} failed {attempt} times, leaving it for the next start: {e}")
+                    self.failed += 1
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending_files()),
+            "uploaded": self.uploaded,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+upload_queue = UploadQueue()
@@ -1,22 +1,42 @@
 import base64
+import hashlib
 import os
+import re
 from uuid import uuid4
 
-from kapi.db.db import supabase
+from fastapi import UploadFile
+
+from kapi.db.db import run_sync
+from kapi.db.repository import get_storage
 
 UPLOAD_DIR = "uploads"
 
 BUCKET_NAME = os.getenv("SUPABASE_BUCKET_NAME", "image-uploads")
 
+MAX_UPLOAD_BYTES = int(os.getenv("KAPI_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+CHUNK_SIZE = 64 * 1024
+# what b64decode skips as well, e.g. the line breaks of Android's Base64.DEFAULT and base64.encodebytes
+NOT_BASE64 = re.compile(r"[^A-Za-z0-9+/=]")
+
 def get_local_file_path(filename):
     return os.path.join(UPLOAD_DIR, filename)
 
-def get_file_from_bucket(filename, bucket=BUCKET_NAME):
-    response = supabase.storage.from_(bucket).download(filename)
-    file_path = get_local_file_path(filename)
-    print('Download response from Supabase:', response)
-    with open(file_path, "wb+") as f:
-        f.write(response)
+def read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def write_file(file_path: str, data: bytes):
+    # written aside and renamed, so a concurrent reader never sees a partial file
+    with open(file_path + ".part", "wb+") as f:
+        f.write(data)
+    os.replace(file_path + ".part", file_path)
+
+async def get_file_from_bucket(filename, bucket=BUCKET_NAME):
+    response = await get_storage().download(bucket, filename)
+    # the disk off the event loop as well, on the same worker threads
+    await run_sync(write_file, get_local_file_path(filename), response)
 
 def get_mime_type_from_filename(filename):
     if filename.endswith(".png"):
@@ -27,41 +47,96 @@ def get_mime_type_from_filename(filename):
         return "image/jpeg"
     raise ValueError("Unsupported file extension")
 
-def upload_file_to_bucket(filename, bucket=BUCKET_NAME):
+async def upload_file_to_bucket(filename, bucket=BUCKET_NAME):
     print("Uploading file to bucket", filename)
-    file_path = get_local_file_path(filename)
-    with open(file_path, "rb") as f:
-        response = supabase.storage.from_(bucket).upload(file=f, path=filename, file_options={
-            "content-type": get_mime_type_from_filename(filename)
-        })
-        print('Upload response from Supabase:', response)
+    data = await run_sync(read_file, get_local_file_path(filename))
+    response = await get_storage().upload(bucket, filename, data, get_mime_type_from_filename(filename))
+    print('Upload response from Supabase:', response)
 
 def get_uuid4_filename_with_extension(filename: str) -> str:
     return str(uuid4()) + os.path.splitext(filename)[-1]
 
 
-def get_image_from_base64(image: str) -> dict:
-    prefix, contents = image.split(",", 1)
-    datatype = prefix.split(";")[0].split(":")[1]
-    if "image" in datatype:
-        extension = prefix.split(";")[0].split(":image/")[1]
-        return {
-            "data": base64.b64decode(contents),
-            "extension": extension,
-        }
-    if "application/octet-stream" in datatype:
-        extension = ".jpeg"
-        return {
-            "data": base64.b64decode(contents),
-            "extension": extension,
-        }
+def get_extension_from_magic_bytes(head: bytes) -> str:
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpeg"
+    raise ValueError("Unsupported file type, only PNG and JPEG images are accepted")
+
+
+def remove_local_file(filename):
+    file_path = get_local_file_path(filename)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+class ImageFileWriter:
+    """
+    Writes an image to UPLOAD_DIR chunk by chunk, hashing and checking it along the way.
+
+    The extension comes from the magic bytes of the content, not from what the client claims.
+    """
+
+    def __init__(self):
+        self.id = str(uuid4())
+        self.part_path = get_local_file_path(f"{self.id}.part")
+        self.file = open(self.part_path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > MAX_UPLOAD_BYTES:
+            raise ValueError(f"File is larger than {MAX_UPLOAD_BYTES} bytes")
+        if len(self.head) < 8:
+            self.head += chunk[:8]
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self) -> str:
+        self.file.close()
+        filename = self.id + get_extension_from_magic_bytes(self.head)
+        os.rename(self.part_path, get_local_file_path(filename))
+        print(f"Stored {filename} ({self.size} bytes, sha256 {self.sha256.hexdigest()})")
+        return filename
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+
+
+async def write_upload_file(upload: UploadFile) -> str:
+    with ImageFileWriter() as writer:
+        while chunk := await upload.read(CHUNK_SIZE):
+            writer.write(chunk)
+        return writer.finish()
 
 
 def write_base64_file(file_base64: str) -> str:
-    image_from_base64 = get_image_from_base64(file_base64)
-    filename = get_uuid4_filename_with_extension(f"file.{image_from_base64['extension']}")
-    filepath = get_local_file_path(filename)
-    with open(filepath, "wb") as buffer:
-        buffer.write(image_from_base64["data"])
-    return filename
+    # data:image/png;base64,<contents>, decoded a chunk at a time instead of all at once
+    start = file_base64.find(",") + 1
+    if start == 0 or ";base64" not in file_base64[:start]:
+        raise ValueError("Expected a base64 data URL")
+    with ImageFileWriter() as writer:
+        leftover = ""
+        for offset in range(start, len(file_base64), CHUNK_SIZE):
+            chunk = leftover + NOT_BASE64.sub("", file_base64[offset:offset + CHUNK_SIZE])
+            # only whole groups of 4 decode on their own, the rest goes with the next chunk
+            usable = len(chunk) - len(chunk) % 4
+            writer.write(base64.b64decode(chunk[:usable]))
+            leftover = chunk[usable:]
+        if leftover:
+            # incomplete, raises like decoding it all at once would
+            writer.write(base64.b64decode(leftover))
+        return writer.finish()
 
@@ -1,33 +1,79 @@
-from fastapi import FastAPI, Query
-from fastapi.responses import JSONResponse, FileResponse
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 import os
-from fastapi.staticfiles import StaticFiles
 
-from kapi.util import UPLOAD_DIR, get_file_from_bucket
+from kapi.util import UPLOAD_DIR
 
 from kapi.api.borrowed_keys import router as borrowed_keys_router
 from kapi.api.reservations import router as reservations_router
 from kapi.api.buildings import router as buildings_router
 from kapi.api.auth import router as auth_router
+from kapi.api.events import router as events_router
 
+from kapi.auth.auth import close_auth_http_client
 from kapi.auth.constants import API_KEY
-
-from kapi.notifications import send_notification_if_needed
-
-print(API_KEY)
-app = FastAPI()
-
-@app.middleware("http")
-async def api_key_middleware(request, call_next):
-    if not (request.url.path.startswith("/auth") or request.url.path.startswith("/health") or request.url.path.startswith("/files")):
-        api_key = request.headers.get("X-API-KEY")
-        if api_key != API_KEY:
-            return JSONResponse(content={"message": "Invalid API Key"}, status_code=403)
-    response = await call_next(request)
-    return response
-
+from kapi.auth.middleware import AuthMiddleware, verified_tokens
+
+from kapi.notifications import notification_dispatcher, heartbeat
+from kapi.db.repository import connect_backend
+from kapi.health import readiness_probe
+from kapi.db.keys import known_keys
+from kapi.db.borrowers import known_borrowers
+from kapi.db.buildings import buildings_cache
+from kapi.db.borrowed_keys import active_borrows, overdue_borrows
+from kapi.db.availability import reservation_index
+from kapi.overdue import overdue_digest
+from kapi.uploads import upload_queue
+from kapi.events import event_broker
+from kapi.metrics import CONTENT_TYPE, MetricsMiddleware, registry
+from kapi.images import VARIANT_DIR, VARIANT_WIDTHS, get_variant_path, schedule_variants
+from kapi.file_cache import file_cache
+from kapi.http_cache import ImmutableStaticFiles, immutable_etag, immutable_file_response, is_not_modified, \
+    not_modified_response
+
+async def start_backend():
+    # the clients are built in a thread first, a probe or a reconcile would otherwise build them on the event loop
+    await connect_backend()
+    await readiness_probe.start()
+    await active_borrows.start()
+    await reservation_index.start()
+    await overdue_borrows.start()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # nothing in here waits on the database or the bucket, the app answers /health as soon as it is up and /ready
+    # once the backend is
+    backend_task = asyncio.create_task(start_backend())
+    # picks up uploads that did not make it to the bucket before the last shutdown
+    await upload_queue.start()
+    file_cache.scan()
+    await notification_dispatcher.start()
+    heartbeat_task = asyncio.create_task(heartbeat())
+    await overdue_digest.start()
+    yield
+    backend_task.cancel()
+    await asyncio.gather(backend_task, return_exceptions=True)
+    await overdue_borrows.stop()
+    await reservation_index.stop()
+    await active_borrows.stop()
+    await readiness_probe.stop()
+    heartbeat_task.cancel()
+    await asyncio.gather(heartbeat_task, return_exceptions=True)
+    await overdue_digest.stop()
+    await notification_dispatcher.stop()
+    await upload_queue.stop()
+    await close_auth_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(AuthMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -35,13 +81,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-API-KEY"],
+    expose_headers=["X-API-KEY", "Server-Timing"],
 )
 
+# outermost, so the time spent in the other middleware (and the rejected requests) count as well
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(borrowed_keys_router, prefix="/borrowed-keys")
 app.include_router(reservations_router, prefix="/reservations")
 app.include_router(buildings_router, prefix="/buildings")
 app.include_router(auth_router, prefix="/auth")
+app.include_router(events_router, prefix="/events")
 
 # In-memory storage for form data
 
@@ -49,29 +99,79 @@ app.include_router(auth_router, prefix="/auth")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # Mount static files directory
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/uploads", ImmutableStaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 
 
 @app.get("/health")
 async def health_check():
-    send_notification_if_needed()
+    # liveness only, never touches the database or anything else outside the process
     return {"message": "Service is up and running"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    # results of the last background check, see ReadinessProbe
+    return JSONResponse(
+        content={"ready": readiness_probe.is_ready(), "checks": readiness_probe.results},
+        status_code=200 if readiness_probe.is_ready() else 503
+    )
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "known_keys": known_keys.stats(),
+        "known_borrowers": known_borrowers.stats(),
+        "buildings_cache": buildings_cache.stats(),
+        "active_borrows": active_borrows.stats(),
+        "reservations": reservation_index.stats(),
+        "overdue": overdue_borrows.stats(),
+        "overdue_digest": overdue_digest.stats(),
+        "uploads": upload_queue.stats(),
+        "file_cache": file_cache.stats(),
+        "notifications": notification_dispatcher.stats(),
+        "verified_tokens": verified_tokens.stats(),
+        "events": event_broker.stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format, scrape it with the X-API-KEY header or a bearer token
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+
 @app.get("/files/{filename}")
-async def get_file(filename: str, api_key: str = Query('')):
+async def get_file(request: Request, filename: str, api_key: str = Query(''), size: str = Query(None)):
     if api_key != API_KEY:
         return JSONResponse(content={"message": "Invalid API Key"}, status_code=403)
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if os.path.exists(file_path):
-        return FileResponse(path=file_path)
-    else:
-        try:
-            get_file_from_bucket(filename)
-            return FileResponse(path=file_path)
-        except Exception as e:
-            print("Error, file was not found on OS and in bucket", e)
-            return JSONResponse(content={"message": "File not found"}, status_code=404)
+    if filename.startswith(".") or os.sep in filename or filename == os.path.basename(VARIANT_DIR):
+        return JSONResponse(content={"message": "File not found"}, status_code=404)
+    if size is not None and size not in VARIANT_WIDTHS:
+        return JSONResponse(content={"message": f"Unknown size, expected one of {', '.join(VARIANT_WIDTHS)}"}, status_code=400)
+
+    # the content behind a name never changes, so a matching ETag needs neither the disk nor the bucket
+    etag = immutable_etag(filename if size is None else os.path.basename(get_variant_path(filename, size)))
+    if is_not_modified(request.headers, etag):
+        return not_modified_response(etag)
+
+    if size is not None:
+        variant_path = get_variant_path(filename, size)
+        if os.path.exists(variant_path):
+            return immutable_file_response(variant_path)
+
+    try:
+        file_path = await file_cache.get(filename)
+    except Exception as e:
+        print("Error, file was not found on OS and in bucket", e)
+        return JSONResponse(content={"message": "File not found"}, status_code=404)
+
+    if size is not None:
+        # serve the original this once (without letting it be cached as the variant), the variants are ready for the
+        # next request
+        schedule_variants(filename)
+        return FileResponse(path=file_path, headers={"cache-control": "no-cache"})
+    return immutable_file_response(file_path)
 
 
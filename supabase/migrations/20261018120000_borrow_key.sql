@@ -0,0 +1,59 @@
+-- Keys that were borrowed twice by racing checkouts before the index existed: the newest borrow stays open and the
+-- older ones are closed, otherwise the index below can not be built.
+update borrowed_keys
+set borrowed = false, returned_at = now()
+from (
+    select id, row_number() over (partition by key_id order by borrowed_at desc, id desc) as newest
+    from borrowed_keys
+    where borrowed
+) open_borrows
+where borrowed_keys.id = open_borrows.id and open_borrows.newest > 1;
+
+-- At most one open borrow per key, this is what actually stops a key from being borrowed twice
+-- when two checkouts race each other.
+create unique index if not exists borrowed_keys_one_open_borrow_per_key
+    on borrowed_keys (key_id)
+    where borrowed;
+
+-- Borrows a key in a single round-trip: creates the key and borrower if they are new (both have
+-- deterministic ids), inserts the borrowed key and marks the reservation as collected, all in one transaction.
+create or replace function borrow_key(
+    p_key jsonb,
+    p_borrower jsonb,
+    p_borrowed_key jsonb,
+    p_reservation_id uuid default null
+)
+returns borrowed_keys
+language plpgsql
+as $$
+declare
+    result borrowed_keys;
+begin
+    insert into keys (id, building_id, room_number, type)
+    select id, building_id, room_number, type
+    from jsonb_populate_record(null::keys, p_key)
+    on conflict (id) do nothing;
+
+    insert into borrowers (id, name, company, type, email, phone)
+    select id, name, company, type, email, phone
+    from jsonb_populate_record(null::borrowers, p_borrower)
+    on conflict (id) do nothing;
+
+    begin
+        insert into borrowed_keys (id, key_id, borrower_id, image_filename, signature_filename, borrowed, borrowed_at, building_id)
+        select id, key_id, borrower_id, image_filename, signature_filename, borrowed, borrowed_at, building_id
+        from jsonb_populate_record(null::borrowed_keys, p_borrowed_key)
+        returning * into result;
+    exception when unique_violation then
+        raise exception 'Key already borrowed';
+    end;
+
+    if p_reservation_id is not null then
+        update key_reservations
+        set collected = true, borrowed_key_id = result.id
+        where id = p_reservation_id;
+    end if;
+
+    return result;
+end;
+$$;
@@ -0,0 +1,7 @@
+-- Back the keyset pagination of the borrowed keys and reservations lists, a page is an index range scan
+-- instead of an offset scan over the whole history.
+create index if not exists borrowed_keys_borrowed_at_id_idx
+    on borrowed_keys (borrowed_at desc, id desc);
+
+create index if not exists key_reservations_created_at_id_idx
+    on key_reservations (created_at desc, id desc);
@@ -0,0 +1,43 @@
+-- borrow_key for a whole ring of keys with one borrower, in one round-trip and one transaction.
+-- Availability of every key is checked in a single query, then everything is inserted in bulk.
+create or replace function borrow_keys(
+    p_keys jsonb,
+    p_borrower jsonb,
+    p_borrowed_keys jsonb
+)
+returns setof borrowed_keys
+language plpgsql
+as $$
+declare
+    borrowed_key_ids text;
+begin
+    select string_agg(distinct key_id, ',' order by key_id) into borrowed_key_ids
+    from borrowed_keys
+    where borrowed and key_id in (select id from jsonb_populate_recordset(null::keys, p_keys));
+
+    if borrowed_key_ids is not null then
+        raise exception 'Keys already borrowed' using detail = borrowed_key_ids;
+    end if;
+
+    insert into keys (id, building_id, room_number, type)
+    select id, building_id, room_number, type
+    from jsonb_populate_recordset(null::keys, p_keys)
+    on conflict (id) do nothing;
+
+    insert into borrowers (id, name, company, type, email, phone)
+    select id, name, company, type, email, phone
+    from jsonb_populate_record(null::borrowers, p_borrower)
+    on conflict (id) do nothing;
+
+    begin
+        return query
+        insert into borrowed_keys (id, key_id, borrower_id, image_filename, signature_filename, borrowed, borrowed_at, building_id)
+        select id, key_id, borrower_id, image_filename, signature_filename, borrowed, borrowed_at, building_id
+        from jsonb_populate_recordset(null::borrowed_keys, p_borrowed_keys)
+        returning *;
+    exception when unique_violation then
+        -- lost a race with another borrow of one of the keys after the check above
+        raise exception 'Keys already borrowed';
+    end;
+end;
+$$;
@@ -0,0 +1,36 @@
+-- A key can only be reserved once at a time: no two reservations of the same key that are not returned yet may
+-- overlap. Backs the check in add_reservation when two workers race each other.
+create extension if not exists btree_gist;
+
+-- [collection_at, return_at), a reservation without return_at keeps the key for a day (DEFAULT_RESERVATION_SECONDS
+-- in kapi/db/availability.py). Declared immutable so it can be used in the constraint, which holds as the interval
+-- is in hours, not days, and so does not depend on the time zone setting.
+create or replace function reservation_period(collection_at timestamptz, return_at timestamptz)
+returns tstzrange
+language sql
+immutable
+as $$
+    select tstzrange(collection_at, coalesce(return_at, collection_at + interval '24 hours'), '[)');
+$$;
+
+-- Reservations that were double booked before the constraint existed: of two overlapping ones the collected one
+-- stays, otherwise the one that starts first (the one made first on a tie), the other is marked returned. Exclusion
+-- constraints can not be added not valid, without this the constraint below can not be built.
+update key_reservations
+set returned = true
+where not returned and collection_at is not null and exists (
+    select 1
+    from key_reservations earlier
+    where earlier.key_id = key_reservations.key_id
+      and earlier.id <> key_reservations.id
+      and not earlier.returned and earlier.collection_at is not null
+      and reservation_period(earlier.collection_at, earlier.return_at)
+          && reservation_period(key_reservations.collection_at, key_reservations.return_at)
+      and (earlier.collected, key_reservations.collection_at, key_reservations.created_at, key_reservations.id)
+          > (key_reservations.collected, earlier.collection_at, earlier.created_at, earlier.id)
+);
+
+alter table key_reservations
+    add constraint key_reservations_no_overlap
+    exclude using gist (key_id with =, reservation_period(collection_at, return_at) with &&)
+    where (not returned and collection_at is not null);
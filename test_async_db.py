@@ -0,0 +1,67 @@
+import asyncio
+import time
+import unittest
+
+from kapi.db import borrowed_keys, buildings
+from kapi.db.repository import set_repository
+from kapi.db.supabase_backend import SupabaseRepository
+
+ROUND_TRIP_SECONDS = 0.2
+
+
+class SlowResponse:
+    data = []
+    count = 0
+
+
+class SlowQuery:
+    """Stand-in for a postgrest request builder whose execute() blocks like a slow round-trip."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        time.sleep(ROUND_TRIP_SECONDS)
+        return SlowResponse()
+
+
+class SlowClient:
+    def table(self, name):
+        return SlowQuery()
+
+
+class TestAsyncDataLayer(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        set_repository(SupabaseRepository(SlowClient()))
+
+    def tearDown(self):
+        set_repository(None)
+
+    async def test_independent_queries_overlap(self):
+        start = time.perf_counter()
+        await asyncio.gather(
+            borrowed_keys.get_borrowed_keys(),
+            borrowed_keys.get_borrowed_key("borrow-id"),
+            borrowed_keys.is_key_borrowed("key-id"),
+            buildings.get_all_buildings(),
+        )
+        elapsed = time.perf_counter() - start
+
+        # run back to back these would take 4 round-trips
+        self.assertLess(elapsed, 2 * ROUND_TRIP_SECONDS)
+
+    async def test_event_loop_stays_responsive(self):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await borrowed_keys.is_key_borrowed("key-id")
+        task.cancel()
+
+        self.assertGreater(ticks, 5)
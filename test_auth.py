@@ -0,0 +1,104 @@
+import asyncio
+import time
+import unittest
+
+import jwt
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from benchmarks.auth_login import GoTrueStub
+from kapi.auth.auth import user_login, close_auth_http_client
+from kapi.auth.constants import API_KEY, KAPI_PRIVATE_KEY
+from kapi.auth.middleware import AuthMiddleware, verified_tokens
+
+
+def make_token(expires_in: float = 60, api_key: str = API_KEY, secret: str = KAPI_PRIVATE_KEY) -> str:
+    return jwt.encode({"email": "john@test.com", "api_key": api_key, "exp": int(time.time() + expires_in)}, secret, algorithm="HS256")
+
+
+class TestAuthMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        verified_tokens.clear()
+        app = FastAPI()
+        app.add_middleware(AuthMiddleware)
+
+        @app.get("/buildings")
+        async def buildings():
+            return {"data": []}
+
+        @app.get("/events")
+        async def events():
+            return {"message": "ok"}
+
+        @app.get("/health")
+        async def health():
+            return {"message": "ok"}
+
+        self.client = TestClient(app)
+
+    def test_api_key(self):
+        self.assertEqual(self.client.get("/buildings", headers={"X-API-KEY": API_KEY}).status_code, 200)
+        self.assertEqual(self.client.get("/buildings", headers={"X-API-KEY": "wrong"}).status_code, 403)
+        self.assertEqual(self.client.get("/buildings").status_code, 403)
+        self.assertEqual(self.client.get("/health").status_code, 200)
+
+    def test_bearer_token(self):
+        headers = {"Authorization": f"Bearer {make_token()}"}
+
+        self.assertEqual(self.client.get("/buildings", headers=headers).status_code, 200)
+        hits = verified_tokens.hits
+        self.assertEqual(self.client.get("/buildings", headers=headers).status_code, 200)
+        self.assertEqual(verified_tokens.hits, hits + 1)
+
+    def test_events_take_credentials_in_the_query(self):
+        # what EventSource does, no headers
+        self.assertEqual(self.client.get("/events", params={"api_key": API_KEY}).status_code, 200)
+        self.assertEqual(self.client.get("/events", params={"access_token": make_token()}).status_code, 200)
+        self.assertEqual(self.client.get("/events", params={"api_key": "wrong"}).status_code, 403)
+        self.assertEqual(self.client.get("/events", params={"access_token": make_token(expires_in=-1)}).status_code, 403)
+        self.assertEqual(self.client.get("/events").status_code, 403)
+        # only there
+        self.assertEqual(self.client.get("/buildings", params={"api_key": API_KEY}).status_code, 403)
+
+    def test_rejected_tokens(self):
+        for token in [make_token(expires_in=-1), make_token(secret="not the key"), make_token(api_key="old key"), "garbage"]:
+            response = self.client.get("/buildings", headers={"Authorization": f"Bearer {token}"})
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(verified_tokens.stats()["size"], 0)
+
+    def test_cached_token_expires(self):
+        token = make_token(expires_in=60)
+        verified_tokens.add(token, time.time() - 1)
+
+        # signature still checks out, so it is verified and cached again with the real exp
+        self.assertEqual(self.client.get("/buildings", headers={"Authorization": f"Bearer {token}"}).status_code, 200)
+        self.assertTrue(verified_tokens.is_verified(token))
+
+
+class TestUserLogin(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.stub = GoTrueStub().__enter__()
+        self.patch = self.stub.patch()
+        self.patch.start()
+
+    async def asyncTearDown(self):
+        await close_auth_http_client()
+        self.patch.stop()
+        self.stub.__exit__()
+
+    async def test_logins_share_connections(self):
+        responses = await asyncio.gather(*[user_login(f"user{i}@test.com", "password") for i in range(5)])
+        responses += [await user_login(f"user{i}@test.com", "password") for i in range(5, 10)]
+
+        self.assertEqual([response.user.email for response in responses], [f"user{i}@test.com" for i in range(10)])
+        self.assertLessEqual(self.stub.connections, 5)
+
+    async def test_wrong_password(self):
+        with self.assertRaises(Exception):
+            await user_login("user@test.com", "wrong")
+
+
+if __name__ == "__main__":
+    unittest.main()
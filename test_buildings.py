@@ -0,0 +1,41 @@
+import unittest
+
+from kapi.db.buildings import add_building, get_all_buildings, buildings_cache
+from kapi.db.memory_backend import MemoryRepository
+from kapi.db.repository import set_repository
+
+
+class TestBuildings(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        set_repository(MemoryRepository())
+        buildings_cache.invalidate()
+
+    def tearDown(self):
+        set_repository(None)
+
+    async def test_catalogue_is_served_from_memory(self):
+        for name in ["Santiago", "Aurora", "Sint-Pieters"]:
+            await add_building(name)
+        hits, misses = buildings_cache.hits, buildings_cache.misses
+
+        buildings, total = await get_all_buildings(limit=2)
+        self.assertEqual([building.name for building in buildings], ["Aurora", "Santiago"])
+        self.assertEqual(total, 3)
+
+        buildings, total = await get_all_buildings(search="SANT")
+        self.assertEqual([building.name for building in buildings], ["Santiago"])
+        self.assertEqual(buildings_cache.misses, misses + 1)
+        self.assertEqual(buildings_cache.hits, hits + 1)
+
+    async def test_add_building_invalidates(self):
+        await add_building("Santiago")
+        buildings, total = await get_all_buildings()
+        self.assertEqual(total, 1)
+
+        await add_building("Aurora")
+        buildings, total = await get_all_buildings()
+        self.assertEqual(total, 2)
+
+        with self.assertRaises(ValueError):
+            await add_building("Aurora")
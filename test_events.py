@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+
+from kapi.db.borrowed_keys import Files, add_borrowed_key, return_borrowed_key
+from kapi.db.borrowers import Borrower, known_borrowers
+from kapi.db.keys import Key, known_keys
+from kapi.db.memory_backend import MemoryRepository
+from kapi.db.repository import set_repository
+from kapi.events import EventBroker, event_broker
+
+
+async def take(stream, count: int) -> list[str]:
+    return [await anext(stream) for _ in range(count)]
+
+
+class TestEventBroker(unittest.IsolatedAsyncioTestCase):
+
+    async def test_fan_out(self):
+        broker = EventBroker()
+        streams = [broker.stream(broker.subscribe()) for _ in range(3)]
+
+        broker.publish("key.borrowed", {"borrow_id": "1", "building_id": "Building 1"})
+
+        for stream in streams:
+            self.assertEqual(await take(stream, 1), ['id: 1\nevent: key.borrowed\ndata: {"borrow_id":"1","building_id":"Building 1"}\n\n'])
+            await stream.aclose()
+        self.assertEqual(broker.stats()["subscribers"], 0)
+
+    async def test_resume_from_last_event_id(self):
+        broker = EventBroker(history_size=3)
+        for i in range(5):
+            broker.publish("key.borrowed", {"borrow_id": str(i)})
+
+        resumed = await take(broker.stream(broker.subscribe(last_event_id=3)), 2)
+        self.assertTrue(resumed[0].startswith("id: 4\n"))
+        self.assertTrue(resumed[1].startswith("id: 5\n"))
+
+        # older than the history, or from another process
+        for last_event_id in [1, 42]:
+            (reset,) = await take(broker.stream(broker.subscribe(last_event_id=last_event_id)), 1)
+            self.assertIn("event: reset", reset)
+
+    async def test_slow_subscriber_is_disconnected(self):
+        broker = EventBroker(queue_size=2)
+        slow = broker.subscribe()
+        fast = broker.stream(broker.subscribe())
+
+        for i in range(3):
+            broker.publish("key.borrowed", {"borrow_id": str(i)})
+            await take(fast, 1)
+
+        self.assertTrue(slow.overflowed)
+        self.assertEqual(broker.stats()["overflows"], 1)
+        # gets what was queued, then the stream ends and the client reconnects with Last-Event-ID
+        self.assertEqual(len([event async for event in broker.stream(slow)]), 2)
+
+    async def test_keepalive_and_building_filter(self):
+        broker = EventBroker()
+        stream = broker.stream(broker.subscribe(), building_id="Building 2", keepalive=0.01)
+
+        broker.publish("key.borrowed", {"building_id": "Building 1"})
+        broker.publish("key.borrowed", {"building_id": "Building 2"})
+
+        (event,) = await take(stream, 1)
+        self.assertIn('"building_id":"Building 2"', event)
+        self.assertEqual(await take(stream, 1), [": keepalive\n\n"])
+        await stream.aclose()
+
+
+class TestWritePathEvents(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        set_repository(MemoryRepository())
+        known_keys.clear()
+        known_borrowers.clear()
+
+    def tearDown(self):
+        set_repository(None)
+
+    async def test_borrow_and_return_are_published(self):
+        stream = event_broker.stream(event_broker.subscribe())
+
+        borrowed_key = await add_borrowed_key(
+            Key(room_number="Room 1", building_id="Building 1", type="Appartement"),
+            Borrower(name="John Doe", type="owner", email="john@test.com"),
+            Files(image_filename="image.jpg", signature_filename="signature.jpg")
+        )
+        await return_borrowed_key(borrowed_key.id)
+
+        borrowed, returned = await asyncio.wait_for(take(stream, 2), timeout=1)
+        await stream.aclose()
+        self.assertIn("event: key.borrowed", borrowed)
+        self.assertIn("event: key.returned", returned)
+        self.assertIn(borrowed_key.id, returned)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import asyncio
+import base64
+import io
+import os
+import tempfile
+import unittest
+
+from fastapi import UploadFile
+
+from kapi.db.memory_backend import MemoryStorage
+from kapi.db.repository import set_storage
+from kapi.file_cache import FileCache
+from kapi.images import VARIANT_DIR, VARIANT_WIDTHS, images_enabled, get_variant_path, schedule_variants, wait_for_variants
+from kapi.uploads import upload_queue
+from kapi.util import UPLOAD_DIR, BUCKET_NAME, CHUNK_SIZE, get_local_file_path, write_base64_file, write_upload_file
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 1000
+
+
+class TestFileIngest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def read(filename: str) -> bytes:
+        with open(get_local_file_path(filename), "rb") as f:
+            return f.read()
+
+    def test_base64_is_decoded_in_chunks(self):
+        self.assertGreater(len(PNG), 2 * CHUNK_SIZE)
+        filename = write_base64_file("data:image/png;base64," + base64.b64encode(PNG).decode())
+
+        self.assertTrue(filename.endswith(".png"))
+        self.assertEqual(self.read(filename), PNG)
+
+    def test_line_wrapped_base64(self):
+        # Android's Base64.DEFAULT wraps lines like this
+        filename = write_base64_file("data:image/png;base64," + base64.encodebytes(PNG).decode().replace("\n", "\r\n"))
+
+        self.assertEqual(self.read(filename), PNG)
+
+    def test_extension_comes_from_content(self):
+        jpeg = b"\xff\xd8\xff\xe0" + b"\x00" * 100
+        filename = write_base64_file("data:application/octet-stream;base64," + base64.b64encode(jpeg).decode())
+
+        self.assertTrue(filename.endswith(".jpeg"))
+
+    def test_rejects_unknown_content(self):
+        with self.assertRaises(ValueError):
+            write_base64_file("data:image/png;base64," + base64.b64encode(b"not an image").decode())
+        self.assertEqual(os.listdir(UPLOAD_DIR), [])
+
+    async def test_upload_file_is_streamed_to_disk(self):
+        filename = await write_upload_file(UploadFile(io.BytesIO(PNG), filename="photo.png"))
+
+        self.assertTrue(filename.endswith(".png"))
+        self.assertEqual(self.read(filename), PNG)
+
+    @unittest.skipUnless(images_enabled(), "Pillow is not installed")
+    async def test_variants_are_generated_in_the_background(self):
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (3000, 2000), "red").save(buffer, "JPEG")
+        filename = write_base64_file("data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode())
+
+        schedule_variants(filename)
+        await wait_for_variants(filename)
+
+        for size, width in VARIANT_WIDTHS.items():
+            with Image.open(get_variant_path(filename, size)) as variant:
+                self.assertEqual(variant.size, (width, round(width * 2 / 3)))
+        self.assertLess(os.path.getsize(get_variant_path(filename, "thumb")), len(buffer.getvalue()))
+
+
+class SlowStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.downloads = 0
+
+    async def download(self, bucket: str, filename: str) -> bytes:
+        self.downloads += 1
+        await asyncio.sleep(0.05)
+        return await super().download(bucket, filename)
+
+
+class TestFileCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+        self.storage = SlowStorage()
+        set_storage(self.storage)
+
+    def tearDown(self):
+        set_storage(None)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    async def test_concurrent_misses_share_one_download(self):
+        await self.storage.upload(BUCKET_NAME, "photo.png", PNG, "image/png")
+        cache = FileCache()
+
+        paths = await asyncio.gather(*[cache.get("photo.png") for _ in range(10)])
+
+        self.assertEqual(self.storage.downloads, 1)
+        self.assertEqual(set(paths), {get_local_file_path("photo.png")})
+        self.assertEqual(cache.coalesced, 9)
+        await cache.get("photo.png")
+        self.assertEqual(cache.hits, 1)
+
+    async def test_directories_are_not_hits(self):
+        os.makedirs(VARIANT_DIR)
+
+        with self.assertRaises(Exception):
+            await FileCache().get("variants")
+        self.assertEqual(self.storage.downloads, 1)
+
+    async def test_evicts_least_recently_used_uploaded_files(self):
+        for filename in ["a.png", "b.png", "c.png"]:
+            await self.storage.upload(BUCKET_NAME, filename, PNG, "image/png")
+        cache = FileCache(max_bytes=2 * len(PNG))
+
+        await cache.get("a.png")
+        await cache.get("b.png")
+        await cache.get("a.png")
+        await cache.get("c.png")
+
+        self.assertFalse(os.path.exists(get_local_file_path("b.png")))
+        self.assertTrue(os.path.exists(get_local_file_path("a.png")))
+        self.assertEqual(cache.evictions, 1)
+
+    async def test_never_evicts_files_waiting_for_upload(self):
+        with open(get_local_file_path("new.png"), "wb") as f:
+            f.write(PNG)
+        upload_queue.enqueue("new.png")
+        cache = FileCache(max_bytes=1)
+
+        cache.add("new.png")
+
+        self.assertTrue(os.path.exists(get_local_file_path("new.png")))
+
+
+class TestFileCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+
+        from fastapi.testclient import TestClient
+        import main
+
+        with open(get_local_file_path("photo.png"), "wb") as f:
+            f.write(PNG)
+        self.client = TestClient(main.app)
+        self.params = {"api_key": main.API_KEY}
+        self.headers = {"X-API-KEY": main.API_KEY}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_files_are_served_immutable_with_a_strong_etag(self):
+        response = self.client.get("/files/photo.png", params=self.params)
+
+        self.assertEqual(response.headers["etag"], '"photo.png"')
+        self.assertIn("immutable", response.headers["cache-control"])
+
+        response = self.client.get("/files/photo.png", params=self.params, headers={"if-none-match": '"photo.png"'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_variants_directory_is_not_a_file(self):
+        os.makedirs(VARIANT_DIR)
+
+        self.assertEqual(self.client.get("/files/variants", params=self.params).status_code, 404)
+
+    def test_range_requests(self):
+        response = self.client.get("/files/photo.png", params=self.params, headers={"range": "bytes=0-7"})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, PNG[:8])
+
+    def test_static_mount_uses_the_same_etag(self):
+        response = self.client.get("/uploads/photo.png", headers=self.headers)
+        self.assertEqual(response.headers["etag"], '"photo.png"')
+        self.assertIn("immutable", response.headers["cache-control"])
+
+        response = self.client.get("/uploads/photo.png", headers={**self.headers, "if-none-match": '"photo.png"'})
+        self.assertEqual(response.status_code, 304)
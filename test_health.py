@@ -0,0 +1,88 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from kapi.db.memory_backend import MemoryRepository, MemoryStorage
+from kapi.db.repository import set_repository, set_storage
+from kapi.health import ReadinessProbe
+from kapi.util import UPLOAD_DIR
+
+
+class TestReadinessProbe(unittest.IsolatedAsyncioTestCase):
+
+    async def test_reports_latency_and_failures(self):
+        async def ok():
+            pass
+
+        async def hanging():
+            await asyncio.sleep(10)
+
+        async def broken():
+            raise ConnectionError("connection refused")
+
+        probe = ReadinessProbe({"database": ok, "bucket": hanging, "other": broken}, timeout=0.05)
+        self.assertFalse(probe.is_ready())
+
+        await probe.refresh()
+
+        self.assertTrue(probe.results["database"]["ok"])
+        self.assertIn("timed out", probe.results["bucket"]["error"])
+        self.assertGreaterEqual(probe.results["bucket"]["latency_ms"], 50)
+        self.assertEqual(probe.results["other"]["error"], "connection refused")
+        self.assertFalse(probe.is_ready())
+
+    async def test_background_refresh(self):
+        calls = []
+
+        async def check():
+            calls.append(1)
+
+        probe = ReadinessProbe({"database": check}, interval=0.01)
+        await probe.start()
+        await asyncio.sleep(0.05)
+        await probe.stop()
+
+        self.assertGreater(len(calls), 1)
+        self.assertTrue(probe.is_ready())
+
+
+class TestHealthEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+        set_repository(MemoryRepository())
+        set_storage(MemoryStorage())
+
+    def tearDown(self):
+        set_repository(None)
+        set_storage(None)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_health_and_ready(self):
+        from fastapi.testclient import TestClient
+        import main
+
+        dispatcher = main.notification_dispatcher
+        # nothing listens there, keeps the startup heartbeat from reaching the real push API
+        dispatcher.url = "http://127.0.0.1:9/"
+        with mock.patch.object(dispatcher, "send", wraps=dispatcher.send) as send, TestClient(main.app) as client:
+            for _ in range(10):
+                self.assertEqual(client.get("/health").status_code, 200)
+            # the startup heartbeat at most, nothing on behalf of the probes
+            self.assertLessEqual(send.call_count, 1)
+
+            for _ in range(50):
+                response = client.get("/ready")
+                if response.status_code == 200:
+                    break
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.json()["checks"]), {"database", "bucket"})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,80 +1,339 @@
+import asyncio
+import dataclasses
+import os
+import tempfile
 import unittest
+from unittest import mock
 
-from kapi.db.db import get_currently_borrowed_keys, get_all_borrow_events, borrowed_keys
-from kapi.db.borrowed_keys import Files, get_borrowed_key, add_borrowed_key, is_key_borrowed, return_borrowed_key
-from kapi.db.borrowers import Borrower
-from kapi.db.keys import Key
+from kapi.db.borrowed_keys import Files, get_borrowed_key, get_borrowed_keys, add_borrowed_key, is_key_borrowed, return_borrowed_key, \
+    add_borrowed_keys, return_borrowed_keys, active_borrows, get_out_borrowed_keys
+from kapi.db.borrowers import Borrower, known_borrowers
+from kapi.db.keys import Key, known_keys
+from kapi.db.memory_backend import MemoryRepository
+from kapi.db.repository import set_repository, KeysAlreadyBorrowed
+from kapi.db.pagination import encode_cursor, next_cursor
+from kapi.db.reservations import add_reservation, get_reservation_for_borrow_key
+from kapi.util import UPLOAD_DIR
 
 
-class TestKeys(unittest.TestCase):
+class TestKeys(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
-        borrowed_keys.clear()
+        set_repository(MemoryRepository())
+        known_keys.clear()
+        known_borrowers.clear()
 
-    def test_borrow_key(self):
-        key_id = "1"
+    def tearDown(self):
+        set_repository(None)
+
+    async def test_borrow_key(self):
         key_building = "Building 1"
         key_room = "Room 1"
+        key_type = "Appartement"
         borrower_name = "John Doe"
         borrower_company = "Company 1"
-        borrower_type = "Employee"
+        borrower_type = "company"
         image_filename = "image.jpg"
         signature_filename = "signature.jpg"
 
-        add_borrowed_key(
-            Key(id=key_id, building=key_building, room=key_room),
+        key = Key(room_number=key_room, building_id=key_building, type=key_type)
+        await add_borrowed_key(
+            key,
             Borrower(name=borrower_name, company=borrower_company, type=borrower_type),
             Files(image_filename=image_filename, signature_filename=signature_filename)
         )
 
-        self.assertTrue(is_key_borrowed(key_id))
+        self.assertTrue(await is_key_borrowed(key.id))
 
-    def test_return_key(self):
-        key_id = "1"
+    async def test_return_key(self):
         key_building = "Building 1"
         key_room = "Room 1"
+        key_type = "Appartement"
         borrower_name = "John Doe"
         borrower_company = "Company 1"
-        borrower_type = "Employee"
+        borrower_type = "company"
         image_filename = "image.jpg"
         signature_filename = "signature.jpg"
 
-        borrow = add_borrowed_key(
-            Key(id=key_id, building=key_building, room=key_room),
+        borrow = await add_borrowed_key(
+            Key(room_number=key_room, building_id=key_building, type=key_type),
             Borrower(name=borrower_name, company=borrower_company, type=borrower_type),
             Files(image_filename=image_filename, signature_filename=signature_filename)
         )
 
-        return_borrowed_key(borrow.id)
-        borrowed_key = get_borrowed_key(borrow.id)
+        await return_borrowed_key(borrow.id)
+        borrowed_key = await get_borrowed_key(borrow.id)
         self.assertIsNotNone(borrowed_key)
         self.assertFalse(borrowed_key.borrowed)
 
-        borrowed_keys = get_currently_borrowed_keys()
+        borrowed_keys, total = await get_borrowed_keys(borrowed=True)
         self.assertEqual(len(borrowed_keys), 0)
 
-        all_borrowed_events = get_all_borrow_events(20, 0)
+        all_borrowed_events, total = await get_borrowed_keys(limit=20, offset=0)
         self.assertEqual(len(all_borrowed_events), 1)
+        self.assertEqual(total, 1)
 
-    def test_duplicate_borrow(self):
-        key_id = "1"
+    async def test_duplicate_borrow(self):
         key_building = "Building 1"
         key_room = "Room 1"
+        key_type = "Appartement"
         borrower_name = "John Doe"
         borrower_company = "Company 1"
-        borrower_type = "Employee"
+        borrower_type = "company"
         image_filename = "image.jpg"
         signature_filename = "signature.jpg"
 
-        add_borrowed_key(
-            Key(id=key_id, building=key_building, room=key_room),
+        await add_borrowed_key(
+            Key(room_number=key_room, building_id=key_building, type=key_type),
             Borrower(name=borrower_name, company=borrower_company, type=borrower_type),
             Files(image_filename=image_filename, signature_filename=signature_filename)
         )
 
         with self.assertRaises(ValueError):
-            add_borrowed_key(
-                Key(id=key_id, building=key_building, room=key_room),
+            await add_borrowed_key(
+                Key(room_number=key_room, building_id=key_building, type=key_type),
                 Borrower(name=borrower_name, company=borrower_company, type=borrower_type),
                 Files(image_filename=image_filename, signature_filename=signature_filename)
             )
+
+    async def test_concurrent_borrows_only_one_succeeds(self):
+        key = Key(room_number="Room 1", building_id="Building 1", type="Appartement")
+        files = Files(image_filename="image.jpg", signature_filename="signature.jpg")
+
+        results = await asyncio.gather(*[
+            add_borrowed_key(key, Borrower(name=f"Borrower {i}", type="owner", email=f"{i}@test.com"), files)
+            for i in range(5)
+        ], return_exceptions=True)
+
+        self.assertEqual(len([result for result in results if not isinstance(result, Exception)]), 1)
+        borrowed_keys, total = await get_borrowed_keys(borrowed=True)
+        self.assertEqual(total, 1)
+
+    async def test_borrow_collects_reservation(self):
+        key = Key(room_number="Room 1", building_id="Building 1", type="Appartement")
+        borrower = Borrower(name="John Doe", type="owner", email="john@test.com")
+        reservation = await add_reservation(key, borrower, description="Painting", collection_at="2026-10-19T09:00:00", reservation_by="Jane")
+
+        borrow = await add_borrowed_key(key, borrower, Files(image_filename="image.jpg", signature_filename="signature.jpg"), reservation_id=reservation["id"])
+
+        reservation = await get_reservation_for_borrow_key(borrow.id)
+        self.assertIsNotNone(reservation)
+        self.assertTrue(reservation["collected"])
+
+    async def test_known_ids_skip_existence_checks(self):
+        key = Key(room_number="Room 1", building_id="Building 1", type="Appartement")
+        borrower = Borrower(name="John Doe", type="owner", email="john@test.com")
+
+        await add_reservation(key, borrower, description="Painting", collection_at="2026-10-19T09:00:00", reservation_by="Jane")
+        hits = known_keys.hits
+        await add_reservation(key, borrower, description="Cleaning", collection_at="2026-10-20T09:00:00", reservation_by="Jane")
+
+        self.assertEqual(known_keys.hits, hits + 1)
+        self.assertTrue(known_borrowers.is_known(borrower.id))
+
+    async def test_keyset_pagination(self):
+        for room in range(5):
+            await add_borrowed_key(
+                Key(room_number=str(room), building_id="Building 1", type="Appartement"),
+                Borrower(name="John Doe", type="owner", email="john@test.com"),
+                Files(image_filename="image.jpg", signature_filename="signature.jpg")
+            )
+        everything, total = await get_borrowed_keys(limit=10)
+
+        seen = []
+        cursor = None
+        while True:
+            page, total = await get_borrowed_keys(limit=2, cursor=cursor, count="none")
+            self.assertIsNone(total)
+            seen += [borrowed_key.id for borrowed_key in page]
+            cursor = next_cursor(page, 2, "borrowed_at")
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, [borrowed_key.id for borrowed_key in everything])
+        self.assertEqual(total, None)
+
+        # the count of a cursor page is what is left after the cursor, in every counting mode
+        cursor = next_cursor(everything[:2], 2, "borrowed_at")
+        for count in ["exact", "planned", "none"]:
+            page, total = await get_borrowed_keys(limit=2, cursor=cursor, count=count)
+            self.assertEqual([borrowed_key.id for borrowed_key in page], seen[2:4])
+            self.assertEqual(total, None if count == "none" else 3)
+
+        for cursor in ["not base64", encode_cursor('2026-10-18","id.gt."0', everything[0].id), encode_cursor(everything[0].borrowed_at, "1,id.gt.0")]:
+            with self.assertRaises(ValueError):
+                await get_borrowed_keys(cursor=cursor)
+
+    async def test_hydration_trusts_stored_ids(self):
+        borrower = Borrower(name="John Doe", type="owner", email="john@test.com")
+        await add_borrowed_key(
+            Key(room_number="Room 1", building_id="Building 1", type="Appartement"),
+            borrower,
+            Files(image_filename="image.jpg", signature_filename="signature.jpg")
+        )
+
+        stored = Borrower.from_row({"name": "John Doe", "type": "owner", "email": "changed@test.com"}, id=borrower.id)
+        (borrowed_key,), _ = await get_borrowed_keys()
+
+        self.assertEqual(stored.id, borrower.id)
+        self.assertEqual(borrowed_key.borrower, borrower)
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            borrowed_key.borrowed = False
+
+    async def test_borrow_and_return_a_ring_of_keys(self):
+        borrower = Borrower(name="John Doe", type="company", company="Painters", email="john@test.com")
+        files = Files(image_filename="image.jpg", signature_filename="signature.jpg")
+        keys = [Key(room_number=str(room), building_id="Building 1", type="Appartement") for room in range(3)]
+        await add_reservation(keys[0], borrower, description="Painting", collection_at="2026-10-19T09:00:00", reservation_by="Jane")
+
+        borrowed_keys = await add_borrowed_keys(keys + [keys[0]], borrower, files)
+
+        self.assertEqual(len(borrowed_keys), 3)
+        for key in keys:
+            self.assertTrue(await is_key_borrowed(key.id))
+            self.assertTrue(known_keys.is_known(key.id))
+
+        with self.assertRaises(KeysAlreadyBorrowed) as e:
+            await add_borrowed_keys([keys[1], Key(room_number="9", building_id="Building 1", type="Appartement")], borrower, files)
+        self.assertEqual(e.exception.key_ids, [keys[1].id])
+        # all or nothing
+        self.assertFalse(await is_key_borrowed("Building 1-9-Appartement"))
+
+        returned = await return_borrowed_keys([borrowed_keys[0].id, borrowed_keys[1].id, "unknown"])
+        self.assertEqual(returned, [borrowed_keys[0].id, borrowed_keys[1].id])
+        self.assertFalse(await is_key_borrowed(keys[0].id))
+        self.assertTrue(await is_key_borrowed(keys[2].id))
+        with self.assertNoLogs("kapi.db.borrowed_keys"):
+            self.assertEqual(await return_borrowed_keys([borrowed_keys[0].id]), [])
+
+
+class TestBatchEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+        set_repository(MemoryRepository())
+
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app, headers={"X-API-KEY": main.API_KEY})
+
+    def tearDown(self):
+        set_repository(None)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def borrow(self, rooms: list[str]):
+        png = b"\x89PNG\r\n\x1a\n" + bytes(256)
+        return self.client.post("/borrowed-keys/batch", data={
+            "building_id": "Building 1",
+            "borrower_name": "John Doe",
+            "borrower_type": "owner",
+            "borrower_email": "john@test.com",
+            "key_room_number": rooms,
+            "key_type": ["Appartement"] * len(rooms),
+        }, files={"image": ("image.png", png, "image/png"), "signature": ("signature.png", png, "image/png")})
+
+    def test_batch_borrow_and_return(self):
+        response = self.borrow(["1", "2", "3"])
+        self.assertEqual(response.status_code, 200, response.text)
+        borrow_ids = response.json()["borrow_ids"]
+        self.assertEqual(len(borrow_ids), 3)
+        # one photo and one signature for the whole ring
+        self.assertEqual(len([name for name in os.listdir(UPLOAD_DIR) if name.endswith(".png")]), 2)
+
+        response = self.borrow(["3", "4"])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["key_ids"], ["Building 1-3-Appartement"])
+        self.assertEqual(len([name for name in os.listdir(UPLOAD_DIR) if name.endswith(".png")]), 2)
+
+        response = self.client.post("/borrowed-keys/return", json={"borrow_ids": borrow_ids[:2] + ["unknown"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["returned"], borrow_ids[:2])
+        self.assertEqual(response.json()["not_returned"], ["unknown"])
+
+    def test_key_status(self):
+        params = {"building_id": "Building 1", "key_room_number": "1", "key_type": "Appartement"}
+        self.assertEqual(self.client.get("/borrowed-keys/status", params=params).json(), {"key_id": "Building 1-1-Appartement", "borrowed": False, "borrow_id": None})
+
+        borrow_ids = self.borrow(["1"]).json()["borrow_ids"]
+        self.assertEqual(self.client.get("/borrowed-keys/status", params=params).json()["borrow_id"], borrow_ids[0])
+
+    def test_files_are_removed_when_the_borrow_fails(self):
+        with mock.patch.object(MemoryRepository, "borrow_keys", side_effect=RuntimeError("connection reset")):
+            with self.assertRaises(RuntimeError):
+                self.borrow(["1", "2"])
+        self.assertEqual([name for name in os.listdir(UPLOAD_DIR) if name.endswith(".png")], [])
+
+
+
+class TestActiveBorrows(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.repository = MemoryRepository()
+        set_repository(self.repository)
+        known_keys.clear()
+        known_borrowers.clear()
+
+    async def asyncTearDown(self):
+        await active_borrows.stop()
+        set_repository(None)
+
+    async def borrow(self, room: str, building: str = "Building 1"):
+        return await add_borrowed_key(
+            Key(room_number=room, building_id=building, type="Appartement"),
+            Borrower(name="John Doe", type="owner", email="john@test.com"),
+            Files(image_filename="image.jpg", signature_filename="signature.jpg")
+        )
+
+    async def test_served_from_memory_once_warm(self):
+        first = await self.borrow("1")
+        await active_borrows.start()
+        self.assertTrue(active_borrows.warm)
+
+        second = await self.borrow("2", building="Building 2")
+        with mock.patch.object(self.repository, "find_active_borrows") as find_active_borrows:
+            self.assertTrue(await is_key_borrowed(first.key_id))
+            self.assertTrue(await is_key_borrowed(second.key_id))
+            self.assertFalse(await is_key_borrowed("Building 1-3-Appartement"))
+        find_active_borrows.assert_not_called()
+
+        self.assertEqual([borrowed_key.id for borrowed_key in await get_out_borrowed_keys()], [second.id, first.id])
+        self.assertEqual([borrowed_key.id for borrowed_key in await get_out_borrowed_keys("Building 2")], [second.id])
+
+        await return_borrowed_key(second.id)
+        self.assertFalse(await is_key_borrowed(second.key_id))
+        self.assertEqual(await get_out_borrowed_keys("Building 2"), [])
+
+    async def test_reconcile_picks_up_other_workers(self):
+        await active_borrows.start()
+        borrowed_key = await self.borrow("1")
+
+        # returned by another worker, straight in the database
+        self.repository.borrowed_keys[borrowed_key.id]["borrowed"] = False
+        self.assertTrue(await is_key_borrowed(borrowed_key.key_id))
+
+        drift = active_borrows.drift
+        await active_borrows.reconcile()
+        self.assertFalse(await is_key_borrowed(borrowed_key.key_id))
+        self.assertEqual(active_borrows.drift, drift + 1)
+
+    async def test_changes_during_reconcile_are_kept(self):
+        await active_borrows.start()
+        load = active_borrows.load
+
+        async def slow_load():
+            borrowed_keys = await load()
+            await asyncio.sleep(0.05)
+            return borrowed_keys
+
+        with mock.patch.object(active_borrows, "load", slow_load):
+            reconcile = asyncio.create_task(active_borrows.reconcile())
+            await asyncio.sleep(0.01)
+            borrowed_key = await self.borrow("1")
+            await reconcile
+
+        self.assertTrue(await is_key_borrowed(borrowed_key.key_id))
@@ -0,0 +1,91 @@
+import asyncio
+import contextlib
+import io
+import os
+import random
+import tempfile
+import unittest
+
+from benchmarks.bruno import load_collection, parse
+from benchmarks.load_test import COLLECTION, MIX, SKIPPED, run, seed, with_id
+from kapi.db.memory_backend import MemoryRepository
+from kapi.db.repository import set_repository, set_storage
+
+
+class TestBruno(unittest.TestCase):
+
+    def test_parse(self):
+        request = parse("""meta {
+  name: Borrow Keys
+  seq: 15
+}
+
+post {
+  url: http://localhost:8000/borrowed-keys/batch?dry=1
+  body: multipartForm
+}
+
+headers {
+  X-API-KEY: secret
+  ~X-Disabled: 1
+}
+
+body:multipart-form {
+  key_room_number: 7B
+  key_room_number: 7C
+  collection_at: 2024-11-15T23:34:25Z
+}
+""")
+        self.assertEqual((request.name, request.seq, request.method, request.path), ("Borrow Keys", 15, "POST", "/borrowed-keys/batch"))
+        self.assertEqual(request.query, {"dry": "1"})
+        self.assertEqual(request.headers, {"X-API-KEY": "secret"})
+        self.assertEqual(request.form, [("key_room_number", "7B"), ("key_room_number", "7C"), ("collection_at", "2024-11-15T23:34:25Z")])
+
+    def test_collection(self):
+        collection = load_collection(COLLECTION)
+
+        self.assertEqual(collection["Return borrowed keys"].json["borrow_ids"][0], "d03dbb96-69f4-457f-a24a-f0b97ef28b06")
+        # collection.bru headers apply to every request
+        self.assertIn("X-API-KEY", collection["Return borrowed key"].headers)
+        self.assertTrue(collection["Create data entry"].files)
+        self.assertEqual(set(collection) - set(MIX) - set(SKIPPED), set())
+
+    def test_with_id(self):
+        self.assertEqual(with_id("/borrowed-keys/return/d03dbb96-69f4-457f-a24a-f0b97ef28b06", "1"), "/borrowed-keys/return/1")
+        self.assertEqual(with_id("/borrowed-keys/", "1"), "/borrowed-keys/1")
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+        set_repository(None)
+        set_storage(None)
+
+    def test_seed_returns_most_borrows(self):
+        repository = MemoryRepository()
+        set_repository(repository)
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(seed(repository, buildings=2, borrows=50, reservations=0, files=1, rng=random.Random(0)))
+
+        out = [row for row in repository.borrowed_keys.values() if row["borrowed"]]
+        self.assertEqual(len(out), 5)
+        self.assertTrue(all(row["returned_at"] is None for row in out))
+
+    def test_run(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = asyncio.run(run(total=100, concurrency=5, warmup=10, borrows=50, reservations=20, files=5))
+
+        self.assertGreater(results["total"]["requests"], 90)
+        self.assertEqual(results["total"]["errors"], 0)
+        for name, endpoint in results["endpoints"].items():
+            self.assertLessEqual(endpoint["p50_ms"], endpoint["p99_ms"], name)
+            self.assertNotIn("403", endpoint["statuses"], name)
+        # every borrow is a single round-trip
+        self.assertEqual(results["endpoints"]["Borrow Key"]["db_calls_per_request"], 1)
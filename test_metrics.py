@@ -0,0 +1,87 @@
+import unittest
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from kapi.db.memory_backend import MemoryRepository, MemoryStorage
+from kapi.db.repository import get_repository, get_storage, set_repository, set_storage
+from kapi.metrics import Histogram, MetricsMiddleware, db_call_duration, request_db_calls, request_duration, \
+    storage_call_duration
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_render(self):
+        histogram = Histogram("kapi_test_seconds", "Test.", ("route",), buckets=(0.1, 1))
+        histogram.observe(0.05, "/a")
+        histogram.observe(0.5, "/a")
+        histogram.observe(5, "/a")
+
+        self.assertEqual(histogram.render(), [
+            "# HELP kapi_test_seconds Test.",
+            "# TYPE kapi_test_seconds histogram",
+            'kapi_test_seconds_bucket{route="/a",le="0.1"} 1',
+            'kapi_test_seconds_bucket{route="/a",le="1"} 2',
+            'kapi_test_seconds_bucket{route="/a",le="+Inf"} 3',
+            'kapi_test_seconds_sum{route="/a"} 5.55',
+            'kapi_test_seconds_count{route="/a"} 3',
+        ])
+
+
+class TestMetricsMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        set_repository(MemoryRepository())
+        set_storage(MemoryStorage())
+        app = FastAPI()
+        app.add_middleware(MetricsMiddleware)
+
+        @app.get("/things/{thing_id}")
+        async def get_thing(thing_id: str):
+            # one of those N+1 loops
+            for key_id in ["1", "2", "3"]:
+                await get_repository().get_key(key_id)
+            await get_storage().upload("bucket", thing_id, b"data", "text/plain")
+            return {"id": thing_id}
+
+        self.client = TestClient(app)
+
+    def tearDown(self):
+        set_repository(None)
+        set_storage(None)
+
+    def test_server_timing(self):
+        response = self.client.get("/things/42")
+
+        metrics = dict(metric.split(";", 1) for metric in response.headers["server-timing"].split(", "))
+        self.assertEqual(set(metrics), {"db", "storage", "total"})
+        self.assertTrue(metrics["db"].startswith('desc="3 calls";dur='))
+        self.assertTrue(metrics["storage"].startswith('desc="1 calls";dur='))
+
+    def test_histograms(self):
+        requests = request_duration.count("GET", "/things/{thing_id}", "200")
+        get_key_calls = db_call_duration.count("get_key", "ok")
+        uploads = storage_call_duration.count("upload", "ok")
+
+        self.client.get("/things/1")
+        self.client.get("/things/2")
+        self.client.get("/nothing")
+
+        # by route, the ids do not end up in the labels
+        self.assertEqual(request_duration.count("GET", "/things/{thing_id}", "200"), requests + 2)
+        self.assertGreaterEqual(request_duration.count("GET", "unmatched", "404"), 1)
+        self.assertEqual(db_call_duration.count("get_key", "ok"), get_key_calls + 6)
+        self.assertEqual(storage_call_duration.count("upload", "ok"), uploads + 2)
+        self.assertGreaterEqual(request_db_calls.count("GET", "/things/{thing_id}"), 2)
+
+    def test_metrics_endpoint(self):
+        import main
+        client = TestClient(main.app)
+
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        response = client.get("/metrics", headers={"X-API-KEY": main.API_KEY})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain; version=0.0.4"))
+        # turned away before routing
+        self.assertIn('kapi_request_duration_seconds_count{method="GET",route="unmatched",status="403"}', response.text)
+        self.assertIn("server-timing", response.headers)
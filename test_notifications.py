@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from kapi.notifications import NotificationDispatcher
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.messages.append(parse_qs(body.decode())["message"][0])
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{"status":1}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestNotificationDispatcher(unittest.IsolatedAsyncioTestCase):
+    """Runs the dispatcher against a local stand-in for the push API."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), PushHandler)
+        self.server.messages = []
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/1/messages.json"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    async def test_send_does_not_wait_for_the_api(self):
+        self.server.delay = 0.3
+        dispatcher = NotificationDispatcher(url=self.url)
+        await dispatcher.start()
+
+        started = time.monotonic()
+        dispatcher.send("User logged in")
+        self.assertLess(time.monotonic() - started, 0.05)
+
+        await dispatcher.join()
+        await dispatcher.stop()
+        self.assertEqual(self.server.messages, ["User logged in"])
+        self.assertEqual(dispatcher.sent, 1)
+
+    async def test_coalesces_bursts(self):
+        dispatcher = NotificationDispatcher(url=self.url, coalesce_seconds=0.2)
+        await dispatcher.start()
+
+        for i in range(5):
+            dispatcher.send(f"Key borrowed by {i}", group="keys borrowed")
+        dispatcher.send("Reservation created", group="reservations created")
+        await dispatcher.join()
+        await dispatcher.stop()
+
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.messages[0], "Key borrowed by 0")
+        self.assertIn("Reservation created", self.server.messages)
+        self.assertTrue(self.server.messages[2].startswith("4 keys borrowed in the last 0.2 seconds"))
+        self.assertEqual(dispatcher.coalesced, 4)
+
+    async def test_bounded_queue_and_timeout(self):
+        self.server.delay = 1
+        dispatcher = NotificationDispatcher(url=self.url, maxsize=2, timeout=0.1)
+        await dispatcher.start()
+
+        for i in range(5):
+            dispatcher.send(f"Message {i}")
+        await asyncio.sleep(0)
+        await dispatcher.join()
+        await dispatcher.stop()
+
+        self.assertGreaterEqual(dispatcher.dropped, 2)
+        self.assertEqual(dispatcher.sent, 0)
+        self.assertEqual(dispatcher.failed, 5 - dispatcher.dropped)
+
+
+if __name__ == "__main__":
+    unittest.main()
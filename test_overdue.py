@@ -0,0 +1,213 @@
+import datetime
+import os
+import random
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from kapi.db.availability import format_time, parse_time, reservation_index
+from kapi.db.borrowed_keys import Files, add_borrowed_key, get_due_borrowed_keys, overdue_borrows, return_borrowed_key
+from kapi.db.borrowers import Borrower, known_borrowers
+from kapi.db.keys import Key, known_keys
+from kapi.db.memory_backend import MemoryRepository
+from kapi.db.overdue import OVERDUE_HOURS, DueBorrow, OverdueIndex
+from kapi.db.repository import set_repository
+from kapi.db.reservations import add_reservation, delete_reservation
+from kapi.overdue import OverdueDigest
+from kapi.util import UPLOAD_DIR
+
+BORROWER = Borrower(name="John Doe", type="owner", email="john@test.com")
+FILES = Files(image_filename="image.jpg", signature_filename="signature.jpg")
+
+
+def hours_ago(hours: float) -> str:
+    return format_time(time.time() - hours * 3600)
+
+
+class TestOverdueIndex(unittest.IsolatedAsyncioTestCase):
+
+    async def test_matches_a_linear_scan(self):
+        async def load():
+            return []
+
+        rng = random.Random(1)
+        index = OverdueIndex(load)
+        await index.reconcile()
+        due = {}
+        for _ in range(2000):
+            borrow_id = str(rng.randrange(300))
+            if rng.random() < 0.3:
+                index.remove(borrow_id)
+                due.pop(borrow_id, None)
+            else:
+                entry = DueBorrow(SimpleNamespace(id=borrow_id, building_id=rng.choice(["A", "B"])), rng.randrange(1000))
+                index.add(entry)
+                due[borrow_id] = entry
+
+        for moment in [-1, 0, 250, 500, 999, 1000]:
+            expected = sorted((entry for entry in due.values() if entry.due_at <= moment), key=lambda entry: (entry.due_at, entry.id))
+            self.assertEqual(index.due_before(moment), expected)
+            self.assertEqual(index.due_before(moment, building_id="A"), [entry for entry in expected if entry.borrowed_key.building_id == "A"])
+        self.assertEqual(index.next_due(), min(due.values(), key=lambda entry: entry.due_at))
+        # removed and changed borrows do not pile up
+        self.assertLessEqual(index.stats()["heap_size"], 2 * len(due) + 64)
+
+
+class TestOverdueBorrows(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.repository = MemoryRepository()
+        set_repository(self.repository)
+        known_keys.clear()
+        known_borrowers.clear()
+
+    async def asyncTearDown(self):
+        await overdue_borrows.stop()
+        await reservation_index.stop()
+        set_repository(None)
+
+    async def borrow(self, room: str, reservation_id: str = None):
+        return await add_borrowed_key(Key(room_number=room, building_id="Building 1", type="Kelder"), BORROWER, FILES, reservation_id=reservation_id)
+
+    async def test_due_borrows(self):
+        for warm in [False, True]:
+            with self.subTest(warm=warm):
+                self.repository.borrowed_keys.clear()
+                self.repository.key_reservations.clear()
+                if warm:
+                    await reservation_index.start()
+                    await overdue_borrows.start()
+
+                late = await self.borrow("1")
+                # borrowed by another worker a while ago
+                self.repository.borrowed_keys[late.id]["borrowed_at"] = hours_ago(OVERDUE_HOURS + 1)
+                if warm:
+                    await overdue_borrows.reconcile()
+                on_time = await self.borrow("2")
+                reservation = await add_reservation(Key(room_number="3", building_id="Building 1", type="Kelder"), BORROWER, "Werken", hours_ago(3), "Laurent", return_at=hours_ago(1))
+                reserved = await self.borrow("3", reservation_id=reservation["id"])
+
+                overdue = await get_due_borrowed_keys()
+                self.assertEqual([entry.id for entry in overdue], [late.id, reserved.id])
+                self.assertEqual(overdue[1].reservation_id, reservation["id"])
+                self.assertAlmostEqual(overdue[1].due_at, parse_time(reservation["return_at"]))
+
+                due = await get_due_borrowed_keys(time.time() + OVERDUE_HOURS * 3600)
+                self.assertEqual([entry.id for entry in due], [late.id, reserved.id, on_time.id])
+
+                await return_borrowed_key(reserved.id)
+                self.assertEqual([entry.id for entry in await get_due_borrowed_keys()], [late.id])
+                await overdue_borrows.stop()
+                await reservation_index.stop()
+
+    async def test_deleting_the_reservation_makes_the_borrow_due_by_default(self):
+        await reservation_index.start()
+        await overdue_borrows.start()
+        reservation = await add_reservation(Key(room_number="1", building_id="Building 1", type="Kelder"), BORROWER, "Werken", hours_ago(3), "Laurent", return_at=hours_ago(1))
+        borrowed_key = await self.borrow("1", reservation_id=reservation["id"])
+        self.assertEqual([entry.id for entry in await get_due_borrowed_keys()], [borrowed_key.id])
+
+        await delete_reservation(reservation["id"])
+
+        self.assertEqual(await get_due_borrowed_keys(), [])
+        (entry,) = await get_due_borrowed_keys(time.time() + OVERDUE_HOURS * 3600)
+        self.assertIsNone(entry.reservation_id)
+        self.assertAlmostEqual(entry.due_at, parse_time(borrowed_key.borrowed_at) + OVERDUE_HOURS * 3600)
+
+    async def test_borrows_with_a_bad_borrowed_at_are_skipped(self):
+        late = await self.borrow("1")
+        self.repository.borrowed_keys[late.id]["borrowed_at"] = hours_ago(OVERDUE_HOURS + 1)
+        bad = await self.borrow("2")
+        self.repository.borrowed_keys[bad.id]["borrowed_at"] = "yesterday"
+
+        with self.assertLogs("kapi.db.borrowed_keys", "WARNING") as logs:
+            await overdue_borrows.start()
+        self.assertTrue(overdue_borrows.warm)
+        self.assertEqual([entry.id for entry in await get_due_borrowed_keys()], [late.id])
+        self.assertIn(bad.id, logs.output[0])
+
+    async def test_due_times_do_not_depend_on_the_local_timezone(self):
+        tz = os.environ.get("TZ")
+        os.environ["TZ"] = "America/New_York"
+        time.tzset()
+        try:
+            borrowed_key = await self.borrow("1")
+            (entry,) = await get_due_borrowed_keys(time.time() + 2 * OVERDUE_HOURS * 3600)
+        finally:
+            if tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = tz
+            time.tzset()
+
+        self.assertEqual(entry.id, borrowed_key.id)
+        self.assertAlmostEqual(entry.due_at, time.time() + OVERDUE_HOURS * 3600, delta=60)
+
+    async def test_digest(self):
+        await overdue_borrows.start()
+        late = await self.borrow("1")
+        self.repository.borrowed_keys[late.id]["borrowed_at"] = hours_ago(OVERDUE_HOURS + 2)
+        await overdue_borrows.reconcile()
+        digest = OverdueDigest(interval=3600)
+
+        with mock.patch("kapi.overdue.send_push_notification") as send_push_notification:
+            await digest.check()
+            send_push_notification.assert_called_once()
+            self.assertTrue(send_push_notification.call_args.args[0].startswith("1 key overdue (1 in total)\n1 (Kelder) in Building 1, John Doe, 2h late"))
+
+            # nothing new, nothing sent
+            await digest.check()
+            send_push_notification.assert_called_once()
+
+            later = await self.borrow("2")
+            self.repository.borrowed_keys[later.id]["borrowed_at"] = hours_ago(OVERDUE_HOURS + 1)
+            await overdue_borrows.reconcile()
+            await digest.check()
+            self.assertEqual(send_push_notification.call_count, 2)
+            self.assertTrue(send_push_notification.call_args.args[0].startswith("1 key overdue (2 in total)\n2 (Kelder)"))
+        self.assertEqual(digest.stats()["reported"], 2)
+
+
+class TestOverdueEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+        self.repository = MemoryRepository()
+        set_repository(self.repository)
+        known_keys.clear()
+
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app, headers={"X-API-KEY": main.API_KEY})
+
+    def tearDown(self):
+        set_repository(None)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_overdue_and_due_soon(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for room, borrowed_hours_ago in [("1", OVERDUE_HOURS + 5), ("2", OVERDUE_HOURS - 1), ("3", 0)]:
+            self.repository.borrowed_keys[room] = {
+                "id": room, "key_id": f"Building 1-{room}-Kelder", "borrower_id": "LVA", "building_id": "Building 1",
+                "image_filename": "image.jpg", "signature_filename": "signature.jpg", "borrowed": True,
+                "borrowed_at": (now - datetime.timedelta(hours=borrowed_hours_ago)).isoformat(), "returned_at": None,
+            }
+            self.repository.keys[f"Building 1-{room}-Kelder"] = {"id": f"Building 1-{room}-Kelder", "room_number": room, "building_id": "Building 1", "type": "Kelder"}
+        self.repository.borrowers["LVA"] = {"id": "LVA", "name": "LVA", "type": "owner"}
+
+        response = self.client.get("/borrowed-keys/overdue")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry["borrowed_key"]["id"] for entry in response.json()["overdue"]], ["1"])
+        self.assertAlmostEqual(response.json()["overdue"][0]["overdue_seconds"], 5 * 3600, delta=60)
+        self.assertEqual([entry["borrowed_key"]["id"] for entry in response.json()["due_soon"]], ["2"])
+
+        response = self.client.get("/borrowed-keys/overdue", params={"building_id": "Building 2"})
+        self.assertEqual(response.json(), {"overdue": [], "due_soon": []})
+        self.assertEqual(self.client.get("/borrowed-keys/overdue", params={"due_within_hours": -1}).status_code, 400)
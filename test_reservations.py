@@ -0,0 +1,185 @@
+import os
+import random
+import tempfile
+import unittest
+
+from kapi.db.availability import KeyPeriods, ReservedPeriod, free_periods, get_key_availability, parse_time, \
+    reservation_index
+from kapi.db.borrowed_keys import Files, add_borrowed_key, return_borrowed_key
+from kapi.db.borrowers import Borrower, known_borrowers
+from kapi.db.keys import Key, known_keys
+from kapi.db.memory_backend import MemoryRepository
+from kapi.db.repository import ReservationConflict, set_repository
+from kapi.db.reservations import add_reservation, delete_reservation
+from kapi.util import UPLOAD_DIR
+
+KEY = Key(room_number="7A", building_id="Building 1", type="Kelder")
+BORROWER = Borrower(name="John Doe", type="owner", email="john@test.com")
+
+
+class TestKeyPeriods(unittest.TestCase):
+
+    def test_matches_a_linear_scan(self):
+        rng = random.Random(1)
+        key_periods = KeyPeriods()
+        periods = []
+        for i in range(200):
+            start = rng.randrange(1000)
+            period = ReservedPeriod(str(i), "key", None, start, start + rng.randrange(1, 50))
+            periods.append(period)
+            key_periods.add(period)
+        for period in rng.sample(periods, 50):
+            periods.remove(period)
+            key_periods.remove(period)
+
+        for _ in range(500):
+            start = rng.randrange(1100)
+            end = start + rng.randrange(1, 30)
+            expected = {period.id for period in periods if period.start < end and start < period.end}
+            self.assertEqual({period.id for period in key_periods.overlapping(start, end)}, expected)
+            self.assertEqual(key_periods.is_free(start, end), not expected)
+
+    def test_free_periods(self):
+        periods = [ReservedPeriod("1", "key", None, 10, 20), ReservedPeriod("2", "key", None, 15, 30), ReservedPeriod("3", "key", None, 40, 50)]
+
+        self.assertEqual(free_periods(periods, 0, 45), [(0, 10), (30, 40)])
+        self.assertEqual(free_periods(periods, 12, 28), [])
+        self.assertEqual(free_periods([], 0, 5), [(0, 5)])
+
+
+class TestReservationAvailability(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.repository = MemoryRepository()
+        set_repository(self.repository)
+        known_keys.clear()
+        known_borrowers.clear()
+
+    async def asyncTearDown(self):
+        await reservation_index.stop()
+        set_repository(None)
+
+    async def reserve(self, collection_at: str, return_at: str = None, key: Key = KEY):
+        return await add_reservation(key, BORROWER, "Werken in kelder", collection_at, "Laurent", return_at=return_at)
+
+    async def test_overlapping_reservations_are_rejected(self):
+        for warm in [False, True]:
+            with self.subTest(warm=warm):
+                self.repository.key_reservations.clear()
+                if warm:
+                    await reservation_index.start()
+                first = await self.reserve("2026-11-03T09:00:00Z", "2026-11-03T17:00:00Z")
+
+                with self.assertRaises(ReservationConflict) as conflict:
+                    await self.reserve("2026-11-03T16:00:00Z", "2026-11-03T18:00:00Z")
+                self.assertEqual(conflict.exception.reservation_ids, [first["id"]])
+                # back to back is fine, as is another key
+                await self.reserve("2026-11-03T17:00:00Z", "2026-11-03T18:00:00Z")
+                await self.reserve("2026-11-03T09:00:00Z", "2026-11-03T17:00:00Z", key=Key(room_number="7B", building_id="Building 1", type="Kelder"))
+
+        with self.assertRaises(ValueError):
+            await self.reserve("2026-11-03T17:00:00Z", "2026-11-03T09:00:00Z")
+
+    async def test_reservations_removed_by_other_workers_do_not_conflict(self):
+        await reservation_index.start()
+        reservation = await self.reserve("2026-11-03T09:00:00Z", "2026-11-03T17:00:00Z")
+        # deleted by another worker, this index only finds out on the next reconcile
+        del self.repository.key_reservations[reservation["id"]]
+
+        await self.reserve("2026-11-03T09:00:00Z", "2026-11-03T17:00:00Z")
+        self.assertIsNone(reservation_index.get(reservation["id"]))
+
+    async def test_without_return_at_the_key_is_reserved_for_a_day(self):
+        await self.reserve("2026-11-03T09:00:00Z")
+
+        with self.assertRaises(ReservationConflict):
+            await self.reserve("2026-11-04T08:00:00Z", "2026-11-04T10:00:00Z")
+        await self.reserve("2026-11-04T09:00:00Z", "2026-11-04T10:00:00Z")
+
+    async def test_deleted_and_returned_reservations_free_the_key(self):
+        await reservation_index.start()
+        reservation = await self.reserve("2026-11-03T09:00:00Z", "2026-11-03T17:00:00Z")
+        await delete_reservation(reservation["id"])
+        reservation = await self.reserve("2026-11-03T09:00:00Z", "2026-11-03T17:00:00Z")
+
+        borrowed_key = await add_borrowed_key(KEY, BORROWER, Files("image.jpg", "signature.jpg"), reservation_id=reservation["id"])
+        # collected, the key stays reserved until it is back
+        with self.assertRaises(ReservationConflict):
+            await self.reserve("2026-11-03T10:00:00Z", "2026-11-03T11:00:00Z")
+        await return_borrowed_key(borrowed_key.id)
+        await self.reserve("2026-11-03T10:00:00Z", "2026-11-03T11:00:00Z")
+
+    async def test_key_availability(self):
+        await reservation_index.start()
+        reservation = await self.reserve("2026-11-03T09:00:00Z", "2026-11-03T12:00:00Z")
+
+        availability = await get_key_availability(KEY.id, parse_time("2026-11-03T08:00:00Z"), parse_time("2026-11-03T17:00:00Z"))
+
+        self.assertFalse(availability["free"])
+        self.assertEqual([period["id"] for period in availability["reservations"]], [reservation["id"]])
+        self.assertEqual(availability["free_slots"], [
+            {"start": "2026-11-03T08:00:00+00:00", "end": "2026-11-03T09:00:00+00:00"},
+            {"start": "2026-11-03T12:00:00+00:00", "end": "2026-11-03T17:00:00+00:00"},
+        ])
+
+
+class TestAvailabilityEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+        set_repository(MemoryRepository())
+        known_keys.clear()
+
+        from fastapi.testclient import TestClient
+        import main
+
+        self.client = TestClient(main.app, headers={"X-API-KEY": main.API_KEY})
+
+    def tearDown(self):
+        set_repository(None)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def reserve(self, room: str, collection_at: str, return_at: str):
+        return self.client.post("/reservations", data={
+            "building_id": "Building 1",
+            "key_room_number": room,
+            "key_type": "Kelder",
+            "borrower_type": "owner",
+            "borrower_name": "LVA",
+            "description": "Werken in kelder",
+            "collection_at": collection_at,
+            "return_at": return_at,
+            "reservation_by": "Laurent",
+        })
+
+    def test_reserve_and_query(self):
+        self.assertEqual(self.reserve("7A", "2026-11-03T09:00:00Z", "2026-11-03T17:00:00Z").status_code, 200)
+        self.assertEqual(self.reserve("7B", "2026-11-05T09:00:00Z", "2026-11-05T17:00:00Z").status_code, 200)
+
+        response = self.reserve("7A", "2026-11-03T12:00:00Z", "2026-11-03T13:00:00Z")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(len(response.json()["reservation_ids"]), 1)
+        self.assertEqual(self.reserve("7A", "not a date", "2026-11-03T13:00:00Z").status_code, 400)
+
+        response = self.client.get("/reservations/availability", params={
+            "building_id": "Building 1", "key_room_number": "7A", "key_type": "Kelder",
+            "start": "2026-11-03T16:00:00Z", "end": "2026-11-03T18:00:00Z",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()["free"])
+        self.assertEqual(response.json()["free_slots"], [{"start": "2026-11-03T17:00:00+00:00", "end": "2026-11-03T18:00:00+00:00"}])
+
+        # Tuesday 9 to 17: 7B is free, 7A is not
+        response = self.client.get("/reservations/free-keys", params={
+            "building_id": "Building 1", "start": "2026-11-03T09:00:00Z", "end": "2026-11-03T17:00:00Z",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([key["room_number"] for key in response.json()["free"]], ["7B"])
+        self.assertEqual([reserved["key"]["room_number"] for reserved in response.json()["reserved"]], ["7A"])
+
+        response = self.client.get("/reservations/free-keys", params={"building_id": "Building 1", "start": "2026-11-04", "end": "2026-11-03"})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,32 @@
+import dataclasses
+import json
+import unittest
+from unittest import mock
+
+from benchmarks.serialization import make_page
+from kapi import serialization
+from kapi.serialization import JSONResponse
+
+
+class TestSerialization(unittest.TestCase):
+    def test_matches_asdict(self):
+        page = make_page(3)
+        expected = {"data": [dataclasses.asdict(borrowed_key) for borrowed_key in page], "count": 3}
+
+        response = JSONResponse(content={"data": page, "count": 3})
+
+        self.assertEqual(json.loads(response.body), expected)
+        self.assertEqual(response.headers["content-type"], "application/json")
+
+    def test_stdlib_fallback_matches_asdict(self):
+        page = make_page(3)
+        expected = [dataclasses.asdict(borrowed_key) for borrowed_key in page]
+
+        with mock.patch.object(serialization, "orjson", None):
+            body = serialization.dumps(page)
+
+        self.assertEqual(json.loads(body), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from kapi.db.memory_backend import MemoryStorage
+from kapi.db.repository import set_storage
+from kapi.uploads import UploadQueue
+from kapi.util import UPLOAD_DIR, BUCKET_NAME, get_local_file_path
+
+
+class FlakyStorage(MemoryStorage):
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    async def upload(self, bucket: str, filename: str, data: bytes, content_type: str):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("bucket unavailable")
+        await super().upload(bucket, filename, data, content_type)
+
+
+class TestUploadQueue(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(UPLOAD_DIR)
+
+    def tearDown(self):
+        set_storage(None)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def write_file(filename: str):
+        with open(get_local_file_path(filename), "wb") as f:
+            f.write(b"image")
+
+    async def test_retries_until_uploaded(self):
+        storage = FlakyStorage(failures=2)
+        set_storage(storage)
+        queue = UploadQueue(workers=2, retry_delay=0.01)
+        await queue.start()
+
+        self.write_file("photo.png")
+        queue.enqueue("photo.png")
+        self.assertTrue(queue.is_pending("photo.png"))
+        await queue.join()
+        await queue.stop()
+
+        self.assertEqual(storage.buckets[BUCKET_NAME]["photo.png"], b"image")
+        self.assertFalse(queue.is_pending("photo.png"))
+        self.assertEqual(queue.retried, 2)
+
+    async def test_resumes_pending_uploads_on_start(self):
+        storage = FlakyStorage(failures=0)
+        set_storage(storage)
+        # enqueued while nothing was running, e.g. the process died before the upload
+        self.write_file("signature.png")
+        UploadQueue().enqueue("signature.png")
+
+        queue = UploadQueue(retry_delay=0.01)
+        await queue.start()
+        await queue.join()
+        await queue.stop()
+
+        self.assertIn("signature.png", storage.buckets[BUCKET_NAME])
+        self.assertEqual(queue.pending_files(), [])